@@ -134,3 +134,130 @@ STATIC_URL = '/static/'
 REST_FRAMEWORK = {
     'DEFAULT_FILTER_BACKENDS': ('django_filters.rest_framework.DjangoFilterBackend',)
 }
+
+# Markdown rendering
+
+# How long (in seconds) rendered HTML bodies are kept in the cache
+MARKDOWN_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+
+# Number of worker processes used to render large batches of markdown bodies
+# for list endpoints, 0 renders them serially in the request thread
+MARKDOWN_RENDER_PROCESSES = 0
+
+# Smallest number of uncached bodies worth sending to the render processes
+MARKDOWN_RENDER_POOL_THRESHOLD = 16
+
+# GraphQL
+
+# How many comments CommentsList returns for a sitewide listing with no limit
+COMMENTS_LIST_DEFAULT_LIMIT = 50
+# Page sizes of ConversationsList and MessagesList when no limit is given
+CONVERSATIONS_LIST_DEFAULT_LIMIT = 50
+MESSAGES_LIST_DEFAULT_LIMIT = 50
+
+# Search
+
+# Dotted path of the search backend class, e.g 'lw2.search.LikeBackend'. When
+# unset the database's full text search is used if the search index exists.
+SEARCH_BACKEND = None
+
+# How many search results are returned when the client doesn't give a limit,
+# and the most a client can ask for
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+
+# Authorization header sessions
+
+# How many resolved sessions each process keeps, and for how many seconds it
+# trusts one before checking back with the shared cache
+SESSION_USER_CACHE_SIZE = 1024
+SESSION_USER_CACHE_TTL = 60
+
+# How many seconds the shared cache keeps each user's login generation before
+# reading it from the database again
+AUTH_GENERATION_CACHE_TTL = 300
+
+# How many seconds the signed access tokens handed out by Login stay valid,
+# defaults to SESSION_COOKIE_AGE
+ACCESS_TOKEN_AGE = 60 * 60 * 24 * 14
+
+# Comment threads
+
+# The most comments a CommentsTree query or thread request returns at once
+COMMENT_THREAD_MAX_SIZE = 500
+
+# How many seconds a cached thread response lives, bounding how stale it can be
+# to changes that don't bump its post's version, like an author's new name
+THREAD_CACHE_TIMEOUT = 300
+
+# Votes
+
+# Save votes as pending and add them to scores in batches, which requires
+# running the flush_votes management command periodically
+VOTE_WRITE_BEHIND = False
+# The most pending votes flush_votes applies in one transaction
+VOTE_FLUSH_BATCH_SIZE = 1000
+
+# View counts
+
+# Seconds before the same viewer's view of a post is counted again
+VIEW_DEDUPE_WINDOW = 30 * 60
+# Each process writes its buffered views out every this many seconds, from a
+# background thread if it isn't serving views, or sooner once it has views
+# buffered for VIEW_BUFFER_SIZE posts
+VIEW_FLUSH_INTERVAL = 30
+VIEW_BUFFER_SIZE = 1000
+
+# Feeds
+
+# Seconds of newness worth a tenfold higher score in the hot and frontpage
+# feeds, run the rebuild_feeds command after changing it
+FEED_HOT_DECAY = 45000
+
+# Notifications
+
+# Leave queued notification events to the deliver_notifications command. Off,
+# the request that queued them delivers the whole queue after it commits, which
+# is only meant for development setups with no worker running
+NOTIFICATION_WORKER = True
+# The most events deliver_notifications handles in one transaction
+NOTIFICATION_BATCH_SIZE = 500
+
+# Broker relaying new comments and notifications to event streams. LocalBroker
+# only reaches subscribers in the same process, with several processes use
+# lw2.pubsub.CacheBroker over a shared cache
+EVENT_BROKER = "lw2.pubsub.LocalBroker"
+# How often CacheBroker subscribers check for messages, and how many seconds
+# messages are kept for them
+EVENT_POLL_INTERVAL = 0.5
+EVENT_RETENTION = 60
+# Seconds before an event stream is closed for the client to reconnect, and
+# between heartbeats on an idle stream
+EVENT_STREAM_TIMEOUT = 300
+EVENT_STREAM_HEARTBEAT = 15
+# Each stream holds a worker while it's open, so serve /events with threaded or
+# gevent workers. This is the most streams each process keeps open at once,
+# keep it below its worker threads so regular requests still get served
+EVENT_STREAM_MAX_STREAMS = 10
+
+# Invites
+
+# The most descendants the users lineage API lists
+INVITE_LINEAGE_MAX_SIZE = 1000
+
+# Annotations
+
+# Base URL of the hypothes.is API that annotation searches are proxied to
+HYPOTHESIS_API_URL = "https://hypothes.is/api"
+# Seconds to wait for it to connect and to respond, and how many connections to
+# keep open to it
+ANNOTATION_TIMEOUT = 5
+ANNOTATION_POOL_SIZE = 10
+# Seconds a search result is served from the cache, and how long after that it's
+# still served while being refreshed in the background
+ANNOTATION_CACHE_TTL = 60
+ANNOTATION_STALE_TTL = 24 * 60 * 60
+# Failures in a row before searches stop calling the API, and seconds before it's
+# tried again
+ANNOTATION_BREAKER_THRESHOLD = 5
+ANNOTATION_BREAKER_RESET = 30
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""Benchmark the vote lookups accordius makes against a synthetic vote table,
+before and after adding the indexes from migration 0029.
+
+Builds an in-memory SQLite copy of lw2_vote with a million rows spread over
+100,000 documents and 10,000 users, then times the queries used by NewVote,
+VoteSerializer.create and the GraphQL vote resolvers.
+
+Usage: python benchmarks/vote_indexes.py [rows]"""
+
+import random
+import sqlite3
+import string
+import sys
+import time
+
+ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+DOCUMENTS = max(1, ROWS // 10)
+USERS = max(1, ROWS // 100)
+LOOKUPS = 200
+
+def document_id(n):
+    return "doc" + str(n).zfill(14)
+
+def build(connection):
+    connection.execute("""CREATE TABLE lw2_vote (
+    id integer PRIMARY KEY AUTOINCREMENT,
+    document_id varchar(17) NOT NULL,
+    voted_at datetime NOT NULL,
+    vote_type varchar(25) NOT NULL,
+    power integer NOT NULL,
+    user_id integer NOT NULL)""")
+    rng = random.Random(0)
+    seen = set()
+    rows = []
+    while len(rows) < ROWS:
+        vote = (document_id(rng.randrange(DOCUMENTS)), rng.randrange(USERS))
+        if vote in seen:
+            continue
+        seen.add(vote)
+        rows.append((vote[0], "2019-01-01 00:00:00", "smallUpvote", 1, vote[1]))
+    connection.executemany(
+        "INSERT INTO lw2_vote (document_id, voted_at, vote_type, power, user_id) "
+        "VALUES (?, ?, ?, ?, ?)", rows)
+    connection.commit()
+
+QUERIES = {
+    "votes on document":
+    "SELECT id FROM lw2_vote WHERE document_id = ?",
+    "user voted on document":
+    "SELECT id FROM lw2_vote WHERE document_id = ? AND user_id = ?",
+    "vote count per document":
+    "SELECT COUNT(id) FROM lw2_vote WHERE document_id = ?",
+    "latest votes by user":
+    "SELECT id FROM lw2_vote WHERE user_id = ? ORDER BY voted_at DESC LIMIT 20",
+}
+
+def time_queries(connection):
+    rng = random.Random(1)
+    timings = {}
+    for name, sql in QUERIES.items():
+        parameters = []
+        for i in range(LOOKUPS):
+            if sql.count("?") == 2:
+                parameters.append((document_id(rng.randrange(DOCUMENTS)),
+                                   rng.randrange(USERS)))
+            elif "user_id" in sql:
+                parameters.append((rng.randrange(USERS),))
+            else:
+                parameters.append((document_id(rng.randrange(DOCUMENTS)),))
+        start = time.perf_counter()
+        for parameter in parameters:
+            connection.execute(sql, parameter).fetchall()
+        timings[name] = (time.perf_counter() - start) / LOOKUPS
+    return timings
+
+def main():
+    connection = sqlite3.connect(":memory:")
+    print("Building {} votes over {} documents and {} users...".format(
+        ROWS, DOCUMENTS, USERS))
+    build(connection)
+    before = time_queries(connection)
+    connection.execute("CREATE UNIQUE INDEX lw2_vote_document_id_user_id_uniq "
+                       "ON lw2_vote (document_id, user_id)")
+    connection.execute("CREATE INDEX lw2_vote_user_id_097217_idx "
+                       "ON lw2_vote (user_id, voted_at)")
+    after = time_queries(connection)
+    print("{:<28}{:>14}{:>14}{:>10}".format("query", "before (ms)", "after (ms)", "speedup"))
+    for name in QUERIES:
+        print("{:<28}{:>14.3f}{:>14.3f}{:>9.0f}x".format(
+            name, before[name] * 1000, after[name] * 1000, before[name] / after[name]))
+
+if __name__ == '__main__':
+    main()
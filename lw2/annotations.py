@@ -0,0 +1,135 @@
+from django.conf import settings
+from django.core.cache import cache
+from requests.adapters import HTTPAdapter
+import hashlib
+import requests
+import threading
+import time
+
+"""Cached access to the hypothes.is annotation search API.
+
+Searches go through one pooled HTTP session with connect and read timeouts, so
+a slow upstream holds a worker for at most ANNOTATION_TIMEOUT seconds. Results
+are cached per (user, group, limit) for ANNOTATION_CACHE_TTL seconds. For
+ANNOTATION_STALE_TTL seconds after that they are still served while a
+background thread fetches a fresh copy.
+
+A circuit breaker stops calling upstream after ANNOTATION_BREAKER_THRESHOLD
+failures in a row. After ANNOTATION_BREAKER_RESET seconds it lets one request
+through to test whether upstream has recovered. Meanwhile searches with nothing
+cached fail at once instead of waiting out the timeout.
+
+HYPOTHESIS_API_URL sets the upstream, e.g. to a local stub server in tests."""
+
+class AnnotationsUnavailable(Exception):
+    """Raised when a search can't be answered, with whether it's worth
+    retrying later."""
+    def __init__(self, message, retry=True):
+        super().__init__(message)
+        self.retry = retry
+
+class CircuitBreaker(object):
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """Whether a call should be made now."""
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at >= getattr(settings,
+                                                       "ANNOTATION_BREAKER_RESET", 30):
+                # Let this call through as a trial and keep failing the rest
+                self.opened_at = time.time()
+                return True
+            return False
+
+    def succeeded(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= getattr(settings, "ANNOTATION_BREAKER_THRESHOLD", 5):
+                self.opened_at = time.time()
+
+breaker = CircuitBreaker()
+
+session = requests.Session()
+adapter = HTTPAdapter(pool_maxsize=getattr(settings, "ANNOTATION_POOL_SIZE", 10))
+session.mount("https://", adapter)
+session.mount("http://", adapter)
+
+def fetch(api_key, **params):
+    """Search upstream for annotations and return the response body."""
+    if not breaker.allow():
+        raise AnnotationsUnavailable("The annotation server is not responding.")
+    headers = {"Accept":"application/json"}
+    if api_key:
+        headers["Authorization"] = "Bearer {}".format(api_key)
+    timeout = getattr(settings, "ANNOTATION_TIMEOUT", 5)
+    try:
+        response = session.get(
+            getattr(settings, "HYPOTHESIS_API_URL", "https://hypothes.is/api") + "/search",
+            params=params, headers=headers, timeout=(timeout, timeout))
+    except requests.RequestException:
+        breaker.failed()
+        raise AnnotationsUnavailable("The annotation server is not responding.")
+    if response.status_code >= 500:
+        breaker.failed()
+        raise AnnotationsUnavailable("The annotation server returned an error.")
+    breaker.succeeded()
+    if response.status_code != 200:
+        raise AnnotationsUnavailable(
+            "The annotation server refused the search ({}).".format(response.status_code),
+            retry=False)
+    return response.text
+
+def search_key(user, group, limit, api_key):
+    raw = "{}|{}|{}|{}".format(user, group, limit, api_key)
+    return "lw2:annotations:{}".format(hashlib.md5(raw.encode()).hexdigest())
+
+def store(key, text):
+    cache.set(key, (time.time(), text),
+              getattr(settings, "ANNOTATION_CACHE_TTL", 60) +
+              getattr(settings, "ANNOTATION_STALE_TTL", 24 * 60 * 60))
+
+def revalidate(key, api_key, params):
+    """Refresh a cached search in the background, unless another process or
+    thread already is."""
+    if not cache.add(key + ":refreshing", 1,
+                     getattr(settings, "ANNOTATION_TIMEOUT", 5) * 2):
+        return None
+    def refresh():
+        try:
+            store(key, fetch(api_key, **params))
+        except AnnotationsUnavailable:
+            pass
+        finally:
+            cache.delete(key + ":refreshing")
+    thread = threading.Thread(target=refresh, name="annotation-refresh", daemon=True)
+    thread.start()
+    return thread
+
+def search(profile, limit):
+    """The annotations of the hypothes.is account on profile as a JSON string,
+    from the cache where possible. Raises AnnotationsUnavailable when there's
+    nothing cached and upstream can't be reached."""
+    params = {"user":profile.hypothesis_user,
+              "group":profile.hypothesis_group,
+              "limit":limit}
+    key = search_key(profile.hypothesis_user, profile.hypothesis_group, limit,
+                     profile.hypothesis_api_key)
+    cached = cache.get(key)
+    if cached:
+        fetched_at, text = cached
+        if time.time() - fetched_at >= getattr(settings, "ANNOTATION_CACHE_TTL", 60):
+            revalidate(key, profile.hypothesis_api_key, params)
+        return text
+    text = fetch(profile.hypothesis_api_key, **params)
+    store(key, text)
+    return text
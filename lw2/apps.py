@@ -3,3 +3,12 @@ from django.apps import AppConfig
 
 class Lw2Config(AppConfig):
     name = 'lw2'
+
+    def ready(self):
+        # Connects the signal receivers that revoke cached sessions and keep
+        # the feeds current, publish new comments and notifications, and
+        # forget cached invite lineages
+        import lw2.auth_header
+        import lw2.feeds
+        import lw2.pubsub
+        import lw2.lineage
@@ -1,7 +1,239 @@
+from collections import OrderedDict
+from django.conf import settings
+from django.contrib.auth import HASH_SESSION_KEY, SESSION_KEY
 from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_out
 from django.contrib.sessions.backends.db import SessionStore
+from django.core import signing
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+from .models import Ban, TokenGeneration
+import copy
+import threading
+import time
 import pdb
 
+"""Resolving the session key in an Authorization header to a user normally takes
+two queries, one for the session and one for the user. Resolved sessions are
+kept in a small per-process LRU and in the shared cache so most requests take
+none.
+
+Entries carry the expiry of their session, so expired sessions are turned away
+without a lookup. Each user also has a generation number, kept in the database
+and read through the shared cache. It is bumped whenever the user is saved
+(which includes password changes) or banned, and entries from an older
+generation are ignored. The bumped generation is written to the shared cache
+once it commits, and readers only fill in a missing entry, so a reader that
+loaded the old generation can't put it back over the new one. Cached generations also
+expire after AUTH_GENERATION_CACHE_TTL seconds in case one is. The per-process LRU
+only checks with the shared cache once its TTL runs out, so another process
+may keep accepting a revoked session for up to SESSION_USER_CACHE_TTL seconds.
+
+Login also hands out signed access tokens, which the header accepts in place
+of a session key. A token is an HMAC signed (user id, expiry, generation) and is
+checked against the cached generation alone, so it never touches the sessions
+table. Logging out can't take back a single token, only bumping the user's
+generation revokes them."""
+
+TOKEN_SALT = "lw2.auth_header.access_token"
+
+def generation_key(user_id):
+    return "lw2:auth-generation:{}".format(user_id)
+
+def session_key_entry(session_key):
+    return "lw2:session-user:{}".format(session_key)
+
+def token_user_key(user_id):
+    return "lw2:token-user:{}".format(user_id)
+
+def generation_ttl():
+    return getattr(settings, "AUTH_GENERATION_CACHE_TTL", 300)
+
+def load_generation(user_id):
+    return (TokenGeneration.objects.filter(user_id=user_id)
+            .values_list("generation", flat=True).first()) or 0
+
+def user_generation(user_id):
+    generation = cache.get(generation_key(user_id))
+    if generation is None:
+        generation = load_generation(user_id)
+        # Never overwrites, a revocation may have stored a newer one meanwhile
+        cache.add(generation_key(user_id), generation, generation_ttl())
+    return generation
+
+def store_generation(user_id):
+    # Read after commit, so concurrent revocations all store the newest
+    cache.set(generation_key(user_id), load_generation(user_id), generation_ttl())
+
+def revoke_user_sessions(user_id):
+    """Stop honoring this user's access tokens and cached sessions, in this
+    process right away and in others once their local entries expire."""
+    with transaction.atomic():
+        TokenGeneration.objects.get_or_create(user_id=user_id)
+        TokenGeneration.objects.filter(user_id=user_id).update(
+            generation=F("generation") + 1)
+        transaction.on_commit(lambda: store_generation(user_id))
+    # A reader may add the old generation back before the commit, the new one
+    # stored after it replaces that
+    cache.delete_many([generation_key(user_id), token_user_key(user_id)])
+    session_users.remove_user(user_id)
+
+def revoke_session(session_key):
+    cache.delete(session_key_entry(session_key))
+    session_users.remove(session_key)
+
+class SessionUserCache(object):
+    """Least recently used map of session key to (user, session expiry, time
+    cached), holding at most size entries for at most ttl seconds each."""
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, session_key):
+        with self.lock:
+            try:
+                user, expires, cached_at = self.entries[session_key]
+            except KeyError:
+                return None
+            if time.time() - cached_at > self.ttl or expires <= time.time():
+                del self.entries[session_key]
+                return None
+            self.entries.move_to_end(session_key)
+            return user, expires
+
+    def set(self, session_key, user, expires):
+        with self.lock:
+            self.entries[session_key] = (user, expires, time.time())
+            self.entries.move_to_end(session_key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def remove(self, session_key):
+        with self.lock:
+            self.entries.pop(session_key, None)
+
+    def remove_user(self, user_id):
+        with self.lock:
+            for session_key in [session_key for session_key, entry in self.entries.items()
+                                if entry[0].id == user_id]:
+                del self.entries[session_key]
+
+session_users = SessionUserCache(getattr(settings, "SESSION_USER_CACHE_SIZE", 1024),
+                                 getattr(settings, "SESSION_USER_CACHE_TTL", 60))
+
+def load_session_user(session_key):
+    """Resolve a session key to (user, expiry timestamp) from the database, or
+    None if the session doesn't exist, has expired, belongs to a user whose
+    password has changed since login, or belongs to a banned user."""
+    session = SessionStore(session_key=session_key)
+    # Expired and unknown sessions load as empty
+    user_id = session.get(SESSION_KEY)
+    if user_id is None:
+        return None
+    try:
+        user = User.objects.get(id=user_id)
+    except User.DoesNotExist:
+        return None
+    session_hash = session.get(HASH_SESSION_KEY)
+    if not (session_hash and
+            constant_time_compare(session_hash, user.get_session_auth_hash())):
+        return None
+    if Ban.objects.filter(user=user, until__gt=timezone.now()).exists():
+        return None
+    return user, session.get_expiry_date().timestamp()
+
+def get_session_user(session_key):
+    """Return the user a session key belongs to, or None if it doesn't resolve
+    to an active session."""
+    local = session_users.get(session_key)
+    if local:
+        return copy.copy(local[0])
+    shared = cache.get(session_key_entry(session_key))
+    if shared:
+        user, expires, generation = shared
+        if expires > time.time() and generation == user_generation(user.id):
+            session_users.set(session_key, user, expires)
+            return copy.copy(user)
+    loaded = load_session_user(session_key)
+    if loaded is None:
+        return None
+    user, expires = loaded
+    generation = user_generation(user.id)
+    cache.set(session_key_entry(session_key), (user, expires, generation),
+              max(1, int(expires - time.time())))
+    session_users.set(session_key, user, expires)
+    return copy.copy(user)
+
+def access_token_age():
+    return getattr(settings, "ACCESS_TOKEN_AGE", settings.SESSION_COOKIE_AGE)
+
+def make_access_token(user):
+    """Return a signed access token for user and the timestamp it expires at."""
+    expires = int(time.time()) + access_token_age()
+    token = signing.dumps({"u":user.id, "e":expires, "g":user_generation(user.id)},
+                          salt=TOKEN_SALT)
+    return token, expires
+
+def read_access_token(token):
+    """Return the id of the user an access token was issued to, or None if it's
+    forged, expired or revoked."""
+    try:
+        payload = signing.loads(token, salt=TOKEN_SALT)
+        user_id, expires, generation = payload["u"], payload["e"], payload["g"]
+    except (signing.BadSignature, KeyError, TypeError):
+        return None
+    if expires <= time.time() or generation != user_generation(user_id):
+        return None
+    return user_id
+
+def get_token_user(token):
+    """Return the user an access token belongs to, or None if it isn't valid."""
+    user_id = read_access_token(token)
+    if user_id is None:
+        return None
+    user = cache.get(token_user_key(user_id))
+    if user is None:
+        user = User.objects.filter(id=user_id, is_active=True).first()
+        if (user is None or
+            Ban.objects.filter(user=user, until__gt=timezone.now()).exists()):
+            return None
+        cache.set(token_user_key(user_id), user, access_token_age())
+    return copy.copy(user)
+
+def is_access_token(authorization):
+    # Session keys are alphanumeric, signed values always contain a colon
+    return ":" in authorization
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, update_fields=None, **kwargs):
+    if created:
+        return
+    cache.delete(token_user_key(instance.id))
+    # Logging in saves last_login alone, which shouldn't revoke other sessions
+    if update_fields is None or "password" in update_fields:
+        revoke_user_sessions(instance.id)
+
+@receiver(post_save, sender=Ban)
+def user_banned(sender, instance, **kwargs):
+    revoke_user_sessions(instance.user_id)
+
+@receiver(user_logged_out)
+def user_logged_out_handler(sender, request, user, **kwargs):
+    authorization = request.META.get("HTTP_AUTHORIZATION")
+    if authorization and not is_access_token(authorization):
+        # Logging out only flushes the cookie session, not the header's one
+        SessionStore(session_key=authorization).delete()
+    session_key = authorization or request.session.session_key
+    if session_key:
+        revoke_session(session_key)
+
 class AuthHeaderMiddleware(object):
     def __init__(self, get_response):
         self.get_response = get_response
@@ -10,9 +242,12 @@ class AuthHeaderMiddleware(object):
         if not authorization:
             response = self.get_response(request)
             return response
-        # TODO: Add code to handle session expiration
-        request.user = User.objects.get(
-            id = SessionStore(session_key = authorization).get('_auth_user_id')
-        )
+        if is_access_token(authorization):
+            user = get_token_user(authorization)
+        else:
+            user = get_session_user(authorization)
+        # Requests with an expired or revoked login carry on anonymously
+        if user is not None:
+            request.user = user
         response = self.get_response(request)
         return response
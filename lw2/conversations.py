@@ -0,0 +1,167 @@
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models import F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from datetime import datetime
+from .models import Conversation, Message, Participant
+from .pagination import keyset_paginate
+from .notifications import emit, emit_all
+
+"""Private conversations.
+
+Messages are paged by cursor over the (conversation, created_at, id) index, so
+opening a long conversation reads one page of it rather than its whole
+history.
+
+Each participant has a last_read_at marker and an unread_count of the messages
+others have sent since. Sending a message adds one to the other participants'
+counts in a single UPDATE and reading up to a message recounts the reader's, so
+the inbox reads the count off the participant row. The inbox joins in each
+conversation's latest message with subqueries, one query for the whole
+page.
+
+Conversations and moderator broadcasts are created in one transaction with a
+bulk insert per table, so a failure part way leaves nothing behind."""
+
+def get_participant(user, conversation_id):
+    """Return user's Participant in the conversation with conversation_id,
+    raising ValueError unless they're logged in and taking part in it."""
+    if not user.is_authenticated:
+        raise ValueError("Need to be logged in to read private messages!")
+    try:
+        participant = (Participant.objects.select_related("conversation")
+                       .filter(user=user, conversation_id=int(conversation_id))
+                       .first())
+    except (TypeError, ValueError):
+        participant = None
+    if participant is None:
+        raise ValueError("No conversation with id '{}'".format(conversation_id))
+    return participant
+
+def latest_message(field):
+    return Subquery(Message.objects.filter(conversation=OuterRef("conversation"))
+                    .order_by("-created_at", "-id")
+                    .values(field)[:1])
+
+def inbox(user, after=None, before=None, limit=None):
+    """user's Participant rows, with their conversations, most recently active
+    first. Each is annotated with the latest_message_id, _user_id, _body and _at
+    of its conversation's newest message and the last_activity used as the
+    cursor time."""
+    participants = (Participant.objects.filter(user=user)
+                    .select_related("conversation")
+                    .annotate(latest_message_id=latest_message("id"),
+                              latest_message_user_id=latest_message("user"),
+                              latest_message_body=latest_message("body"),
+                              latest_message_at=latest_message("created_at"))
+                    .annotate(last_activity=Coalesce("latest_message_at",
+                                                     "conversation__created_at")))
+    return keyset_paginate(participants, "last_activity",
+                           after=after, before=before, limit=limit)
+
+def inbox_message(participant):
+    """The latest message annotated on an inbox row, None if there isn't one."""
+    if participant.latest_message_id is None:
+        return None
+    return Message(id=participant.latest_message_id,
+                   conversation_id=participant.conversation_id,
+                   user_id=participant.latest_message_user_id,
+                   body=participant.latest_message_body,
+                   created_at=participant.latest_message_at)
+
+def conversation_messages(participant, after=None, before=None, limit=None):
+    """A page of the messages in participant's conversation, found newest first
+    from the cursors like other lists but returned oldest first for reading.
+    Reading the newest page marks the conversation read."""
+    page = list(keyset_paginate(
+        Message.objects.filter(conversation_id=participant.conversation_id),
+        "created_at", after=after, before=before, limit=limit))
+    if page and not after and not before:
+        mark_read(participant, page[0].created_at)
+    page.reverse()
+    return page
+
+def mark_read(participant, read_at):
+    """Move participant's read marker up to read_at and recount their unread
+    messages."""
+    if participant.last_read_at and participant.last_read_at >= read_at:
+        return
+    participant.last_read_at = read_at
+    participant.unread_count = (Message.objects
+                                .filter(conversation_id=participant.conversation_id,
+                                        created_at__gt=read_at)
+                                .exclude(user_id=participant.user_id)
+                                .count())
+    Participant.objects.filter(id=participant.id).update(
+        last_read_at=participant.last_read_at,
+        unread_count=participant.unread_count)
+
+def send_message(user, conversation_id, body):
+    """Post a message from user to a conversation they take part in and return
+    it."""
+    participant = get_participant(user, conversation_id)
+    message = Message(user=user,
+                      conversation_id=participant.conversation_id,
+                      body=body)
+    with transaction.atomic():
+        message.save()
+        (Participant.objects.filter(conversation_id=participant.conversation_id)
+         .exclude(user=user)
+         .update(unread_count=F("unread_count") + 1))
+        emit("message", message.id)
+    return message
+
+def create_all(model, objects):
+    """Insert objects, in one statement where the database can set the ids of a
+    bulk insert on them and one at a time where it can't."""
+    if connection.features.can_return_ids_from_bulk_insert:
+        return model.objects.bulk_create(objects)
+    for instance in objects:
+        instance.save()
+    return objects
+
+def get_users(user_ids):
+    """The users with user_ids, raising ValueError if any don't exist."""
+    try:
+        user_ids = {int(user_id) for user_id in user_ids}
+    except (TypeError, ValueError):
+        raise ValueError("'{}' are not valid user ids".format(user_ids))
+    users = User.objects.in_bulk(user_ids)
+    missing = user_ids - set(users)
+    if missing:
+        raise ValueError("No users with ids {}".format(sorted(missing)))
+    return users
+
+def create_conversation(title, user_ids):
+    """Create a conversation between the users with user_ids and return it."""
+    users = get_users(user_ids)
+    with transaction.atomic():
+        conversation = Conversation.objects.create(title=title)
+        Participant.objects.bulk_create([Participant(user_id=user_id,
+                                                     conversation=conversation)
+                                         for user_id in users])
+    return conversation
+
+def broadcast(sender, user_ids, title, body):
+    """Send each user with user_ids the same message from sender, each in a
+    conversation of their own with sender, and return the messages."""
+    recipients = [user_id for user_id in get_users(user_ids) if user_id != sender.id]
+    sent_at = datetime.today()
+    with transaction.atomic():
+        conversations = create_all(Conversation,
+                                   [Conversation(title=title, created_at=sent_at)
+                                    for user_id in recipients])
+        Participant.objects.bulk_create(
+            [participant
+             for user_id, conversation in zip(recipients, conversations)
+             for participant in (
+                     Participant(user=sender, conversation=conversation,
+                                 last_read_at=sent_at),
+                     Participant(user_id=user_id, conversation=conversation,
+                                 unread_count=1))])
+        messages = create_all(Message,
+                              [Message(user=sender, conversation=conversation,
+                                       created_at=sent_at, body=body)
+                               for conversation in conversations])
+        emit_all("message", [message.id for message in messages])
+    return messages
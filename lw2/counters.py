@@ -0,0 +1,73 @@
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Subquery, Value, When
+from django.db.models.functions import Coalesce
+from .models import Post, Comment
+from .thread_cache import bump_thread
+from .feeds import refresh_feeds
+
+"""Maintenance of the denormalized counters on posts and comments.
+
+base_score, Post.vote_count and Post.comment_count are changed with F()
+expressions, so the arithmetic happens in the database and two requests
+updating the same row at once can't overwrite each other's change. Each update
+shares a transaction with the row it counts. The recount_counters management
+command rebuilds them from scratch if they ever drift, and migration 0040 ran
+the same recount to fill in the counts of posts from before they were kept."""
+
+def per_document(values, key="id"):
+    """An expression that's the value given for each document id in values, for
+    adding to a counter in a single UPDATE over many documents. key names the
+    column values is keyed by."""
+    return Case(*[When(**{key:document_id, "then":Value(value)})
+                  for document_id, value in values.items()],
+                default=Value(0),
+                output_field=IntegerField())
+
+def subquery_total(queryset, group_field, aggregate):
+    """Wrap a per-row aggregate over queryset in a Subquery that's 0 when there
+    are no rows to aggregate."""
+    totals = (queryset.order_by()
+              .values(group_field)
+              .annotate(total=aggregate)
+              .values('total'))
+    return Coalesce(Subquery(totals, output_field=IntegerField()), Value(0))
+
+def vote_post_id(document_model, document_id):
+    """The id of the post whose thread a vote on the document belongs to."""
+    if document_model is Post:
+        return document_id
+    return (Comment.objects.filter(id=document_id)
+            .values_list("post_id", flat=True).first())
+
+def apply_vote(vote, document_model, delta):
+    """Save a vote and add delta to the score of the document it's on."""
+    counters = {"base_score":F("base_score") + delta}
+    if document_model is Post:
+        counters["vote_count"] = F("vote_count") + 1
+    post_id = vote_post_id(document_model, vote.document_id)
+    with transaction.atomic():
+        vote.save()
+        document_model.objects.filter(id=vote.document_id).update(**counters)
+        if document_model is Post:
+            refresh_feeds([vote.document_id])
+        bump_thread(post_id)
+
+def create_comment(comment):
+    """Save a new comment and count it on its post."""
+    with transaction.atomic():
+        comment.save()
+        if comment.post_id:
+            Post.objects.filter(id=comment.post_id).update(
+                comment_count=F("comment_count") + 1)
+
+def delete_comment(comment):
+    """Hide a comment from public view and stop counting it on its post."""
+    with transaction.atomic():
+        # Only the request that actually flips is_deleted gets to decrement
+        deleted = Comment.objects.filter(id=comment.id,
+                                         is_deleted=False).update(is_deleted=True)
+        if deleted and comment.post_id:
+            Post.objects.filter(id=comment.post_id).update(
+                comment_count=F("comment_count") - 1)
+            bump_thread(comment.post_id)
+    comment.is_deleted = True
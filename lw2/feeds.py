@@ -0,0 +1,85 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from .models import Post, FeedEntry
+import math
+
+"""Precomputed post feeds for the PostsList views.
+
+Every published post has a FeedEntry in each feed it belongs to, holding its
+score in that feed, and a feed is read newest or best first off the (feed,
+score) index rather than sorted over the whole post table per request. Entries
+are refreshed whenever a post is saved or its score changes.
+
+The hot score adds log10 of the post's score to its post time divided by
+FEED_HOT_DECAY, so a post needs ten times the score to keep up with one posted
+FEED_HOT_DECAY seconds after it. Because the decay is part of the score itself
+rather than applied at read time, scores never need recomputing as time passes.
+Changing FEED_HOT_DECAY needs a run of the rebuild_feeds command."""
+
+def hot_score(post):
+    score = post.base_score
+    order = math.log10(max(abs(score), 1))
+    sign = (score > 0) - (score < 0)
+    return (sign * order +
+            post.posted_at.timestamp() / getattr(settings, "FEED_HOT_DECAY", 45000))
+
+def new_score(post):
+    return post.posted_at.timestamp()
+
+def top_score(post):
+    return post.base_score
+
+def curated_score(post):
+    return post.curated_date.timestamp()
+
+# Feed name: (whether a post belongs in the feed, the post's score in it)
+FEEDS = {
+    "new":(lambda post: True, new_score),
+    "top":(lambda post: True, top_score),
+    "hot":(lambda post: True, hot_score),
+    # Nothing promotes posts to the front page yet, so it shows every published
+    # post as the hot feed does
+    "frontpage":(lambda post: True, hot_score),
+    "curated":(lambda post: post.curated_date is not None, curated_score),
+}
+
+def feed_scores(post):
+    """The (feed, score) of every feed post belongs in."""
+    if post.draft:
+        return []
+    return [(feed, score(post)) for feed, (included, score) in FEEDS.items()
+            if included(post)]
+
+SCORED_FIELDS = ("posted_at", "frontpage_date", "curated_date", "base_score", "draft")
+
+def write_feed_entries(posts):
+    post_ids = [post.id for post in posts]
+    with transaction.atomic():
+        FeedEntry.objects.filter(post_id__in=post_ids).delete()
+        FeedEntry.objects.bulk_create([FeedEntry(feed=feed, post_id=post.id, score=score)
+                                       for post in posts
+                                       for feed, score in feed_scores(post)])
+
+def refresh_feeds(post_ids):
+    """Recompute the feed entries of the posts with post_ids."""
+    post_ids = list(post_ids)
+    if post_ids:
+        write_feed_entries(list(Post.objects.filter(id__in=post_ids)
+                                .only("id", *SCORED_FIELDS)))
+
+def feed(name, posts=None):
+    """Order posts, or all posts, as in the named feed, leaving out those that
+    aren't in it."""
+    if posts is None:
+        posts = Post.objects.all()
+    return (posts.filter(feed_entries__feed=name)
+            .order_by("-feed_entries__score", "-id"))
+
+@receiver(post_save, sender=Post)
+def post_saved(sender, instance, **kwargs):
+    if instance.get_deferred_fields().intersection(SCORED_FIELDS):
+        refresh_feeds([instance.id])
+    else:
+        write_feed_entries([instance])
@@ -0,0 +1,66 @@
+import os
+import random
+import threading
+import time
+
+"""Document ids for posts and comments.
+
+An id is 17 characters from the URL safe base64 characters, like the hashed ids
+it replaced, but laid out like a Snowflake id:
+
+- 8 characters (48 bits) of milliseconds since the Unix epoch
+- 5 characters (30 bits) identifying the process, chosen at random
+- 4 characters (24 bits) counting ids made in the same millisecond
+
+The characters are put in ASCII order, so ids sort by when they were made and
+new rows land at the end of the primary key index rather than all over it. A
+process never repeats an id, even if the clock steps back, since it then keeps
+counting from the last millisecond it used. Two processes would have to draw
+the same random identifier to collide."""
+
+DIGITS = "-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz"
+TIME_WIDTH = 8
+NODE_WIDTH = 5
+SEQUENCE_WIDTH = 4
+MAX_SEQUENCE = 64 ** SEQUENCE_WIDTH - 1
+
+def encode(number, width):
+    digits = []
+    for i in range(width):
+        number, digit = divmod(number, 64)
+        digits.append(DIGITS[digit])
+    return "".join(reversed(digits))
+
+class IdGenerator(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.node = None
+        self.last_time = 0
+        self.sequence = 0
+
+    def new_id(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                # A forked child must not share its parent's identifier
+                self.pid = os.getpid()
+                self.node = encode(random.SystemRandom().getrandbits(6 * NODE_WIDTH),
+                                   NODE_WIDTH)
+            now = int(time.time() * 1000)
+            if now > self.last_time:
+                self.last_time = now
+                self.sequence = 0
+            elif self.sequence < MAX_SEQUENCE:
+                self.sequence += 1
+            else:
+                # Out of ids for this millisecond, borrow the next one
+                self.last_time += 1
+                self.sequence = 0
+            return (encode(self.last_time, TIME_WIDTH) + self.node +
+                    encode(self.sequence, SEQUENCE_WIDTH))
+
+generator = IdGenerator()
+
+def new_id():
+    """Return a new, unique document id."""
+    return generator.new_id()
@@ -0,0 +1,62 @@
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from .models import InviteTreeNode
+
+"""Invite lineage.
+
+Each InviteTreeNode stores the path of user ids from the root of its tree down
+to the invited account, e.g. "1/5/9/" for user 9 invited by 5 who was invited
+by 1. A user with no node is the root of their own tree, with the path "1/".
+So a user's ancestors are read off their path, and everyone descended from them
+is every node whose path starts with theirs, a single range scan on the path
+index however deep the tree goes.
+
+Paths never change once a node is saved, so each user's is kept in the shared
+cache indefinitely."""
+
+def lineage_key(user_id):
+    return "lw2:lineage:{}".format(user_id)
+
+def lineage_path(user_id):
+    """The path from the root of user_id's invite tree down to them."""
+    path = cache.get(lineage_key(user_id))
+    if path is None:
+        path = (InviteTreeNode.objects.filter(child_id=user_id)
+                .values_list("path", flat=True).first()
+                or "{}/".format(user_id))
+        cache.set(lineage_key(user_id), path, None)
+    return path
+
+def path_ids(path):
+    return [int(user_id) for user_id in path.split("/") if user_id]
+
+def lineage_depth(user_id):
+    """How many users are above user_id in their invite tree."""
+    return len(path_ids(lineage_path(user_id))) - 1
+
+def ancestors(user_id):
+    """The users who invited user_id, who invited them and so on, root first."""
+    ids = path_ids(lineage_path(user_id))[:-1]
+    users = User.objects.in_bulk(ids)
+    return [users[id] for id in ids if id in users]
+
+def descendants(user_id, max_depth=None):
+    """The InviteTreeNodes of everyone below user_id in their invite tree, down
+    to max_depth levels below them if given, in depth first order."""
+    nodes = (InviteTreeNode.objects
+             .filter(path__startswith=lineage_path(user_id))
+             .exclude(child_id=user_id))
+    if max_depth is not None:
+        nodes = nodes.filter(depth__lte=lineage_depth(user_id) + max_depth)
+    return nodes.order_by("path")
+
+def subtree_size(user_id):
+    """How many users are below user_id in their invite tree."""
+    return descendants(user_id).count()
+
+@receiver(post_save, sender=InviteTreeNode)
+def node_saved(sender, instance, **kwargs):
+    # The user may have been cached as a root before their node was saved
+    cache.delete(lineage_key(instance.child_id))
@@ -0,0 +1,125 @@
+from collections import defaultdict
+from django.contrib.auth.models import User
+from django.db.models import Count
+from promise import Promise
+from promise.dataloader import DataLoader
+from .models import Participant, Profile, Vote
+
+"""Request scoped DataLoaders for the GraphQL schema.
+
+Resolvers that would otherwise run one query per object (vote counts, authors, 
+profiles) ask a loader for the value instead. The loader
+collects every key requested while a list is being resolved and fetches them
+all with a single IN (...) query. Loaders live on the request, so their caches
+never outlive it."""
+
+class VoteCountLoader(DataLoader):
+    """Number of votes on each document id."""
+    def batch_load_fn(self, document_ids):
+        counts = dict(Vote.objects.filter(document_id__in=document_ids)
+                      .order_by()
+                      .values_list('document_id')
+                      .annotate(Count('id')))
+        return Promise.resolve([counts.get(document_id, 0)
+                                for document_id in document_ids])
+
+class UserVotesLoader(DataLoader):
+    """The votes a given user has cast on each document id."""
+    def __init__(self, user, *args, **kwargs):
+        self.user = user
+        super().__init__(*args, **kwargs)
+
+    def batch_load_fn(self, document_ids):
+        if not self.user.is_authenticated:
+            return Promise.resolve([[] for document_id in document_ids])
+        votes = defaultdict(list)
+        for vote in Vote.objects.filter(user=self.user,
+                                        document_id__in=document_ids):
+            votes[vote.document_id].append(vote)
+        return Promise.resolve([votes[document_id]
+                                for document_id in document_ids])
+
+class UserLoader(DataLoader):
+    """User objects by id."""
+    def batch_load_fn(self, user_ids):
+        users = User.objects.in_bulk(user_ids)
+        return Promise.resolve([users.get(user_id) for user_id in user_ids])
+
+class ProfileLoader(DataLoader):
+    """Profile objects by the id of the user they belong to, None if the user
+    has no profile."""
+    def batch_load_fn(self, user_ids):
+        profiles = {profile.user_id:profile
+                    for profile in Profile.objects.filter(user_id__in=user_ids)}
+        return Promise.resolve([profiles.get(user_id) for user_id in user_ids])
+
+class ParticipantsLoader(DataLoader):
+    """The participants in each conversation id."""
+    def batch_load_fn(self, conversation_ids):
+        participants = defaultdict(list)
+        for participant in Participant.objects.filter(
+                conversation_id__in=conversation_ids).order_by("id"):
+            participants[participant.conversation_id].append(participant)
+        return Promise.resolve([participants[conversation_id]
+                                for conversation_id in conversation_ids])
+
+class ViewerParticipantLoader(DataLoader):
+    """The Participant of the requesting user in each conversation id, None if
+    they aren't taking part in it."""
+    def __init__(self, user, *args, **kwargs):
+        self.user = user
+        super().__init__(*args, **kwargs)
+
+    def batch_load_fn(self, conversation_ids):
+        if not self.user.is_authenticated:
+            return Promise.resolve([None for conversation_id in conversation_ids])
+        participants = {participant.conversation_id:participant
+                        for participant in Participant.objects.filter(
+                                user=self.user, conversation_id__in=conversation_ids)}
+        return Promise.resolve([participants.get(conversation_id)
+                                for conversation_id in conversation_ids])
+
+class Loaders(object):
+    """The set of loaders belonging to one request."""
+    def __init__(self, user):
+        self.vote_counts = VoteCountLoader()
+        self.user_votes = UserVotesLoader(user)
+        self.users = UserLoader()
+        self.profiles = ProfileLoader()
+        self.participants = ParticipantsLoader()
+        self.viewer_participants = ViewerParticipantLoader(user)
+
+def load_user(info, document):
+    """Return the author of a post or comment, using the one joined in by
+    select_related if it's there and the request's user loader otherwise."""
+    if document.user_id is None:
+        return None
+    if type(document).user.is_cached(document):
+        return document.user
+    return get_loaders(info).users.load(document.user_id)
+
+def load_profile(info, user):
+    """Return a user's profile, using the one joined in by select_related if 
+    it's there and the request's profile loader otherwise."""
+    if User.profile.related.is_cached(user):
+        # A user without a profile raises RelatedObjectDoesNotExist, an AttributeError
+        return Promise.resolve(getattr(user, "profile", None))
+    return get_loaders(info).profiles.load(user.id)
+
+def load_viewer(info, conversation):
+    """Return the requesting user's Participant in a conversation, using the one
+    set as its viewer if it's there and the request's loader otherwise."""
+    viewer = getattr(conversation, "viewer", None)
+    if viewer is not None:
+        return Promise.resolve(viewer)
+    return get_loaders(info).viewer_participants.load(conversation.id)
+
+def get_loaders(info):
+    """Return the loaders for the request being resolved, creating them on first
+    use."""
+    context = info.context
+    try:
+        return context.lw2_loaders
+    except AttributeError:
+        context.lw2_loaders = Loaders(context.user)
+        return context.lw2_loaders
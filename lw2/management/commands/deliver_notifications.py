@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from lw2.notifications import deliver_notifications
+import time
+
+class Command(BaseCommand):
+    help = """Turn queued notification events into notifications for the users 
+    they concern. Run it from cron or keep it running with --interval, along 
+    with NOTIFICATION_WORKER on."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=None,
+                            help="Keep running, delivering every this many seconds.")
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help="Deliver at most this many events per transaction.")
+
+    def handle(self, *args, **options):
+        while True:
+            delivered = 0
+            # Drain the queue before sleeping
+            while True:
+                events = deliver_notifications(options['batch_size'])
+                delivered += events
+                if not events:
+                    break
+            if options['verbosity'] > 1 or options['interval'] is None:
+                self.stdout.write("Delivered {} events".format(delivered))
+            if options['interval'] is None:
+                return
+            time.sleep(options['interval'])
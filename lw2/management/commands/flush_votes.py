@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from lw2.votes import flush_votes
+import time
+
+class Command(BaseCommand):
+    help = """Add pending votes to the scores of the posts and comments they were 
+    cast on. Only needed with VOTE_WRITE_BEHIND on, run it from cron or keep it 
+    running with --interval."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=None,
+                            help="Keep running, flushing every this many seconds.")
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help="Apply at most this many votes per transaction.")
+
+    def handle(self, *args, **options):
+        while True:
+            flushed = 0
+            # Drain the backlog before sleeping
+            while True:
+                applied = flush_votes(options['batch_size'])
+                flushed += applied
+                if not applied:
+                    break
+            if options['verbosity'] > 1 or options['interval'] is None:
+                self.stdout.write("Flushed {} votes".format(flushed))
+            if options['interval'] is None:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from lw2.feeds import write_feed_entries, SCORED_FIELDS
+from lw2.models import Post
+
+class Command(BaseCommand):
+    help = """Recompute every post's entries in the precomputed feeds, e.g. after 
+    changing FEED_HOT_DECAY."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="How many posts to recompute per transaction.")
+
+    def handle(self, *args, **options):
+        batch = []
+        rebuilt = 0
+        for post in Post.objects.only("id", *SCORED_FIELDS).iterator():
+            batch.append(post)
+            if len(batch) == options['batch_size']:
+                write_feed_entries(batch)
+                rebuilt += len(batch)
+                batch = []
+        write_feed_entries(batch)
+        rebuilt += len(batch)
+        self.stdout.write("Rebuilt feeds for {} posts".format(rebuilt))
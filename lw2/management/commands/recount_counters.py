@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Case, Count, IntegerField, OuterRef, Sum
+from django.db.models import Value, When
+from lw2.counters import subquery_total
+from lw2.models import Post, Comment, Vote
+
+class Command(BaseCommand):
+    help = """Recompute the denormalized comment counts, vote counts and scores 
+    of posts and comments from the comment and vote tables, repairing any drift.
+    Scores are rebuilt as 1 plus one point per upvote minus one per downvote."""
+
+    def add_arguments(self, parser):
+        parser.add_argument('--no-scores', action='store_true',
+                            help="Only recount comment_count and vote_count, leave base_score alone.")
+
+    def handle(self, *args, **options):
+        score = Sum(Case(When(vote_type__contains="Upvote", then=Value(1)),
+                         When(vote_type__contains="Downvote", then=Value(-1)),
+                         default=Value(0),
+                         output_field=IntegerField()))
+        # Pending votes are added by flush_votes, counting them here would count them twice
+        votes = Vote.objects.filter(document_id=OuterRef('pk'), pending=False)
+        post_counters = {
+            "comment_count":subquery_total(
+                Comment.objects.filter(post=OuterRef('pk'), is_deleted=False),
+                'post', Count('id')),
+            "vote_count":subquery_total(votes, 'document_id', Count('id')),
+        }
+        comment_counters = {}
+        if not options['no_scores']:
+            post_counters["base_score"] = subquery_total(votes, 'document_id', score) + 1
+            comment_counters["base_score"] = subquery_total(votes, 'document_id', score) + 1
+        with transaction.atomic():
+            posts = Post.objects.update(**post_counters)
+            comments = 0
+            if comment_counters:
+                comments = Comment.objects.update(**comment_counters)
+        self.stdout.write("Recounted {} posts and {} comments".format(posts, comments))
@@ -1,4 +1,9 @@
 import markdown
+import hashlib
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from django.core.cache import cache
 import pdb
 
 extensions_list = [
@@ -43,4 +48,138 @@ ALLOWED_ATTRIBUTES.update({"div":['class="toc"']})
 bleach = BleachExtension(tags=tags, )
 #extensions_list.append(bleach)
 # Disable bleach extension because it's broken
-md = markdown.Markdown(extensions=extensions_list)
+
+# Markdown instances carry per-document state (toc, Meta, etc) and aren't safe
+# to share between threads, so each thread gets its own renderer. Extension setup
+# is paid once per thread rather than once per document.
+_renderers = threading.local()
+
+def get_renderer():
+    """Return the markdown renderer belonging to the current thread, building 
+    it on first use."""
+    try:
+        return _renderers.md
+    except AttributeError:
+        _renderers.md = markdown.Markdown(extensions=extensions_list)
+        return _renderers.md
+
+def render(text):
+    """Render markdown text to HTML with the current thread's renderer, 
+    resetting it afterwards so no state leaks into the next document."""
+    renderer = get_renderer()
+    try:
+        return renderer.convert(text)
+    finally:
+        renderer.reset()
+
+
+def extensions_fingerprint(extensions):
+    """Hash the names of the enabled markdown extensions along with the markdown
+    version, so that rendered HTML cached under one configuration is never served
+    under another."""
+    names = [markdown.__version__]
+    for extension in extensions:
+        if isinstance(extension, str):
+            names.append(extension)
+        else:
+            names.append(type(extension).__module__ + "." + type(extension).__name__)
+    return hashlib.md5(",".join(names).encode()).hexdigest()[:8]
+
+EXTENSIONS_FINGERPRINT = extensions_fingerprint(extensions_list)
+
+def render_cache_key(document_id, text):
+    body_hash = hashlib.md5(text.encode()).hexdigest()
+    return "lw2:html:{}:{}:{}".format(EXTENSIONS_FINGERPRINT,
+                                      document_id,
+                                      body_hash)
+
+def cached_render(document_id, text):
+    """Render markdown text to HTML, using Django's cache framework to skip the
+    conversion when this exact body of this document has been rendered before.
+
+    Because the key includes a hash of the body, editing a document makes its
+    old entry unreachable and the next read (or save) renders the new body."""
+    key = render_cache_key(document_id, text)
+    html = cache.get(key)
+    if html is None:
+        html = render(text)
+        cache.set(key, html, cache_timeout())
+    return html
+
+def current_render_key(document_id):
+    return "lw2:html-current:{}:{}".format(EXTENSIONS_FINGERPRINT, document_id)
+
+def get_current_renders(document_ids):
+    """Fetch the renderings recorded as current for each of document_ids, for 
+    readers that haven't loaded the bodies and so can't compute render_cache_key. 
+    Returns a dictionary of document id to HTML, missing ids were not cached."""
+    keys = {current_render_key(document_id):document_id
+            for document_id in document_ids}
+    return {keys[key]:html
+            for key, html in cache.get_many(list(keys.keys())).items()}
+
+def set_current_renders(renders):
+    """Record a dictionary of document id to HTML as the current renderings."""
+    cache.set_many({current_render_key(document_id):html
+                    for document_id, html in renders.items()},
+                   cache_timeout())
+
+def add_current_renders(renders):
+    """Record a dictionary of document id to HTML as the current renderings of
+    documents that have none. For readers, whose bodies may be older than one
+    just saved, so they never replace a rendering recorded by save."""
+    for document_id, html in renders.items():
+        cache.add(current_render_key(document_id), html, cache_timeout())
+
+def cache_timeout():
+    return getattr(settings, "MARKDOWN_CACHE_TIMEOUT", 60 * 60 * 24 * 7)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_render_pool():
+    """Return the process pool used for batch rendering, or None if it's been
+    disabled by setting MARKDOWN_RENDER_PROCESSES to 0."""
+    global _pool
+    processes = getattr(settings, "MARKDOWN_RENDER_PROCESSES", 0)
+    if not processes:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=processes)
+    return _pool
+
+def render_batch(documents):
+    """Render many markdown documents at once, given as (document_id, text) 
+    pairs. Returns a dictionary mapping document ids to their HTML.
+
+    Cache hits are fetched in one round trip, and the misses are spread across 
+    the render process pool when there are enough of them to be worth the
+    overhead. Otherwise (or with the pool disabled) they're rendered serially."""
+    documents = list(documents)
+    keys = {document_id:render_cache_key(document_id, text)
+            for document_id, text in documents}
+    cached = cache.get_many(list(keys.values()))
+    rendered = {}
+    misses = []
+    for document_id, text in documents:
+        html = cached.get(keys[document_id])
+        if html is None:
+            misses.append((document_id, text))
+        else:
+            rendered[document_id] = html
+    if not misses:
+        return rendered
+    pool = get_render_pool()
+    texts = [text for document_id, text in misses]
+    if pool and len(misses) >= getattr(settings, "MARKDOWN_RENDER_POOL_THRESHOLD", 16):
+        chunksize = max(1, len(texts) // (4 * settings.MARKDOWN_RENDER_PROCESSES))
+        htmls = list(pool.map(render, texts, chunksize=chunksize))
+    else:
+        htmls = [render(text) for text in texts]
+    new_entries = {}
+    for (document_id, text), html in zip(misses, htmls):
+        rendered[document_id] = html
+        new_entries[keys[document_id]] = html
+    cache.set_many(new_entries, cache_timeout())
+    return rendered
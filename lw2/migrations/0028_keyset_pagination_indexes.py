@@ -0,0 +1,59 @@
+# Generated by Django 2.1.7 on 2026-10-18 16:46
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lw2', '0027_auto_20190216_0628'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='hypothesis_api_key',
+            field=models.CharField(default=None, max_length=512, null=True),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='hypothesis_group',
+            field=models.CharField(default=None, max_length=512, null=True),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='hypothesis_user',
+            field=models.CharField(default=None, max_length=512, null=True),
+        ),
+        migrations.AlterField(
+            model_name='profile',
+            name='user',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='profile', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['posted_at', 'id'], name='lw2_comment_posted__2f93af_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', 'posted_at', 'id'], name='lw2_comment_post_id_05cc48_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['user', 'posted_at', 'id'], name='lw2_comment_user_id_655c3d_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['user', 'created_at', 'id'], name='lw2_notific_user_id_0eebbb_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['posted_at', 'id'], name='lw2_post_posted__fc4dd2_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['user', 'posted_at', 'id'], name='lw2_post_user_id_740657_idx'),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 2.1.7 on 2026-10-18 16:46
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicate_votes(apps, schema_editor):
+    """Keep only the first vote each user cast on a document so the unique
+    constraint can be created."""
+    Vote = apps.get_model('lw2', 'Vote')
+    duplicates = (Vote.objects.values('document_id', 'user')
+                  .annotate(first_id=Min('id'), votes=Count('id'))
+                  .filter(votes__gt=1)
+                  .order_by())
+    for duplicate in duplicates:
+        (Vote.objects.filter(document_id=duplicate['document_id'],
+                             user=duplicate['user'])
+         .exclude(id=duplicate['first_id'])
+         .delete())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('lw2', '0028_keyset_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='post',
+            name='slug',
+            field=models.CharField(db_index=True, max_length=60),
+        ),
+        migrations.RunPython(remove_duplicate_votes, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='vote',
+            unique_together={('document_id', 'user')},
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['document_id'], name='lw2_notific_documen_db5a46_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tag',
+            index=models.Index(fields=['document_id', 'user'], name='lw2_tag_documen_64c424_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tag',
+            index=models.Index(fields=['user', 'created_at'], name='lw2_tag_user_id_9bbf83_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vote',
+            index=models.Index(fields=['user', 'voted_at'], name='lw2_vote_user_id_097217_idx'),
+        ),
+    ]
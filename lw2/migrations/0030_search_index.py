@@ -0,0 +1,51 @@
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    """Create the lw2_search full text index used by lw2.search and fill it with
+    the existing posts and comments. Databases we have no full text support for
+    are left without it and search falls back to substring matching."""
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+            if not cursor.fetchone()[0]:
+                return
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE lw2_search "
+            "USING fts5(document_id UNINDEXED, kind UNINDEXED, body)")
+        schema_editor.execute(
+            "INSERT INTO lw2_search (document_id, kind, body) "
+            "SELECT id, 'post', body FROM lw2_post")
+        schema_editor.execute(
+            "INSERT INTO lw2_search (document_id, kind, body) "
+            "SELECT id, 'comment', body FROM lw2_comment")
+    elif connection.vendor == 'postgresql':
+        schema_editor.execute(
+            "CREATE TABLE lw2_search ("
+            "document_id varchar(17) NOT NULL, "
+            "kind varchar(10) NOT NULL, "
+            "body tsvector NOT NULL, "
+            "PRIMARY KEY (kind, document_id))")
+        schema_editor.execute(
+            "CREATE INDEX lw2_search_body_gin ON lw2_search USING GIN (body)")
+        schema_editor.execute(
+            "INSERT INTO lw2_search (document_id, kind, body) "
+            "SELECT id, 'post', to_tsvector('english', body) FROM lw2_post")
+        schema_editor.execute(
+            "INSERT INTO lw2_search (document_id, kind, body) "
+            "SELECT id, 'comment', to_tsvector('english', body) FROM lw2_comment")
+
+def drop_search_index(apps, schema_editor):
+    schema_editor.execute("DROP TABLE IF EXISTS lw2_search")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lw2', '0029_document_id_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
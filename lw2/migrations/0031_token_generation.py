@@ -0,0 +1,23 @@
+# Generated by Django 2.1.7 on 2026-10-18 16:54
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0009_alter_user_last_name_max_length'),
+        ('lw2', '0030_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TokenGeneration',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='token_generation', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('generation', models.IntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 2.1.7 on 2026-10-18 16:55
+
+from django.db import migrations, models
+from lw2.threads import child_path, path_depth
+
+
+def fill_comment_paths(apps, schema_editor):
+    """Give existing comments their thread paths, parents before replies."""
+    Comment = apps.get_model('lw2', 'Comment')
+    comments = {id:(parent_id, posted_at) for id, parent_id, posted_at in
+                Comment.objects.values_list('id', 'parent_comment', 'posted_at')}
+    paths = {}
+
+    def path_of(id, seen=()):
+        if id not in paths:
+            parent_id, posted_at = comments[id]
+            parent_path = ""
+            # Orphaned and cyclic replies are moved to the top of the thread
+            if parent_id in comments and parent_id not in seen:
+                parent_path = path_of(parent_id, seen + (id,))
+            try:
+                paths[id] = child_path(parent_path, posted_at, id)
+            except ValueError:
+                paths[id] = child_path("", posted_at, id)
+        return paths[id]
+
+    for id in comments:
+        path = path_of(id)
+        Comment.objects.filter(id=id).update(path=path, depth=path_depth(path))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lw2', '0031_token_generation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='depth',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='path',
+            field=models.CharField(default='', max_length=2048),
+        ),
+        migrations.RunPython(fill_comment_paths, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', 'path'], name='lw2_comment_post_id_69af7c_idx'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 2.1.7 on 2026-10-18 16:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lw2', '0032_comment_paths'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vote',
+            name='pending',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='vote',
+            index=models.Index(fields=['pending'], name='lw2_vote_pending_3a5a20_idx'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 2.1.7 on 2026-10-18 17:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+from lw2.feeds import feed_scores
+
+
+def fill_feeds(apps, schema_editor):
+    Post = apps.get_model('lw2', 'Post')
+    FeedEntry = apps.get_model('lw2', 'FeedEntry')
+    FeedEntry.objects.bulk_create(
+        [FeedEntry(feed=feed, post_id=post.id, score=score)
+         for post in Post.objects.defer('body').iterator()
+         for feed, score in feed_scores(post)],
+        batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lw2', '0033_vote_pending'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeedEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('feed', models.CharField(max_length=16)),
+                ('score', models.FloatField()),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='feed_entries', to='lw2.Post')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='feedentry',
+            index=models.Index(fields=['feed', '-score'], name='lw2_feedent_feed_45a466_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='feedentry',
+            unique_together={('feed', 'post')},
+        ),
+        migrations.RunPython(fill_feeds, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.1.7 on 2026-10-18 17:04
+
+import datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lw2', '0034_feed_entries'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=16)),
+                ('document_id', models.CharField(max_length=17)),
+                ('created_at', models.DateTimeField(default=datetime.datetime.today)),
+            ],
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 2.1.7 on 2026-10-18 17:05
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def count_unread(apps, schema_editor):
+    Profile = apps.get_model('lw2', 'Profile')
+    Notification = apps.get_model('lw2', 'Notification')
+    unread = (Notification.objects
+              .filter(user=OuterRef('user'),
+                      created_at__gt=OuterRef('last_notifications_check'))
+              .order_by()
+              .values('user')
+              .annotate(total=Count('id'))
+              .values('total'))
+    Profile.objects.update(unread_notification_count=Coalesce(
+        Subquery(unread, output_field=IntegerField()), Value(0)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lw2', '0035_notification_events'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='unread_notification_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(count_unread, migrations.RunPython.noop),
+    ]
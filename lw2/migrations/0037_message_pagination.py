@@ -0,0 +1,43 @@
+# Generated by Django 2.1.7 on 2026-10-18 17:08
+
+from django.db import migrations, models
+from django.db.models import Max, OuterRef, Subquery
+
+
+def mark_read(apps, schema_editor):
+    # Conversations had no read markers, so count what's there as read rather
+    # than everyone finding their whole history unread
+    Participant = apps.get_model('lw2', 'Participant')
+    Message = apps.get_model('lw2', 'Message')
+    latest = (Message.objects
+              .filter(conversation=OuterRef('conversation'))
+              .order_by()
+              .values('conversation')
+              .annotate(latest=Max('created_at'))
+              .values('latest'))
+    Participant.objects.update(last_read_at=Subquery(latest))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lw2', '0036_unread_notification_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='participant',
+            name='last_read_at',
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='participant',
+            name='unread_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'created_at', 'id'], name='lw2_message_convers_345240_idx'),
+        ),
+        migrations.RunPython(mark_read, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 2.1.7 on 2026-10-18 17:12
+
+from django.db import migrations, models
+
+
+def fill_lineage_paths(apps, schema_editor):
+    """Give existing invite tree nodes their paths, parents before children."""
+    InviteTreeNode = apps.get_model('lw2', 'InviteTreeNode')
+    parents = dict(InviteTreeNode.objects.values_list('child', 'parent'))
+    paths = {}
+
+    def path_of(user_id, seen=()):
+        if user_id not in paths:
+            parent_id = parents.get(user_id)
+            # Cycles are cut where they close
+            if parent_id is None or user_id in seen:
+                paths[user_id] = "{}/".format(user_id)
+            else:
+                paths[user_id] = "{}{}/".format(path_of(parent_id, seen + (user_id,)),
+                                                user_id)
+        return paths[user_id]
+
+    for child_id in parents:
+        path = path_of(child_id)
+        InviteTreeNode.objects.filter(child_id=child_id).update(
+            path=path, depth=path.count("/") - 1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lw2', '0037_message_pagination'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='invitetreenode',
+            name='depth',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='invitetreenode',
+            name='path',
+            field=models.CharField(db_index=True, default='', max_length=2048),
+        ),
+        migrations.RunPython(fill_lineage_paths, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 2.1.7 on 2026-10-18 18:10
+
+from django.db import migrations
+from lw2.feeds import hot_score
+
+
+def fill_frontpage(apps, schema_editor):
+    """Add the published posts the frontpage feed used to leave out."""
+    Post = apps.get_model('lw2', 'Post')
+    FeedEntry = apps.get_model('lw2', 'FeedEntry')
+    FeedEntry.objects.bulk_create(
+        [FeedEntry(feed='frontpage', post_id=post.id, score=hot_score(post))
+         for post in (Post.objects.filter(draft=False)
+                      .exclude(feed_entries__feed='frontpage')
+                      .defer('body').iterator())],
+        batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lw2', '0038_invite_lineage'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_frontpage, migrations.RunPython.noop),
+    ]
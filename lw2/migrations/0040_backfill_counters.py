@@ -0,0 +1,31 @@
+# Generated by Django 2.1.7 on 2026-10-18 17:36
+
+from django.db import migrations
+from django.db.models import Count, OuterRef
+from lw2.counters import subquery_total
+
+
+def recount(apps, schema_editor):
+    """Count the comments and votes of posts from before comment_count and
+    vote_count were kept up to date, as recount_counters --no-scores does."""
+    Post = apps.get_model('lw2', 'Post')
+    Comment = apps.get_model('lw2', 'Comment')
+    Vote = apps.get_model('lw2', 'Vote')
+    Post.objects.update(
+        comment_count=subquery_total(
+            Comment.objects.filter(post=OuterRef('pk'), is_deleted=False),
+            'post', Count('id')),
+        vote_count=subquery_total(
+            Vote.objects.filter(document_id=OuterRef('pk'), pending=False),
+            'document_id', Count('id')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lw2', '0039_frontpage_feed'),
+    ]
+
+    operations = [
+        migrations.RunPython(recount, migrations.RunPython.noop),
+    ]
@@ -2,12 +2,66 @@ from datetime import date, datetime
 from django.db import models
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
-from .markdown import md
+from .markdown import cached_render, render_batch
+from .markdown import add_current_renders, get_current_renders, set_current_renders
+from .search import index_document, remove_document
+from .threads import MAX_PATH_LENGTH, child_path, path_depth
+from .thread_cache import bump_thread
 import re
 
 
 # Create your models here.
 
+def html_body(document):
+    """Return the rendered HTML of a post or comment body, preferring a 
+    rendering attached by prerender_html if it's still for the current body."""
+    prerendered = getattr(document, "_prerendered_html", None)
+    if prerendered:
+        body, html = prerendered
+        # A body of None means the rendering was looked up without loading it
+        if body is None or body == document.body:
+            return html
+    return cached_render(document.id, document.body)
+
+def prerender_html(documents):
+    """Render the bodies of many posts or comments in one batch and attach the
+    results to them, so that serializing the list afterwards doesn't render or 
+    hit the cache once per item. Returns the documents as a list.
+
+    Documents fetched with their body deferred are served from the renderings 
+    recorded as current when they were last saved. Bodies are only fetched (in 
+    one query) for the ones that aren't cached, whose renderings are then 
+    recorded unless a save has recorded a newer one meanwhile."""
+    documents = list(documents)
+    deferred = [document for document in documents
+                if "body" in document.get_deferred_fields()]
+    current = get_current_renders([document.id for document in deferred])
+    for document in deferred:
+        if document.id in current:
+            document._prerendered_html = (None, current[document.id])
+    uncached = [document for document in deferred
+                if document.id not in current]
+    if uncached:
+        bodies = dict(type(uncached[0]).objects.filter(
+            id__in=[document.id for document in uncached]).values_list('id', 'body'))
+        for document in uncached:
+            document.body = bodies[document.id]
+    unrendered = [document for document in documents
+                  if not hasattr(document, "_prerendered_html")]
+    rendered = render_batch([(document.id, document.body)
+                             for document in unrendered])
+    for document in unrendered:
+        document._prerendered_html = (document.body, rendered[document.id])
+    if uncached:
+        add_current_renders({document.id:rendered[document.id]
+                             for document in uncached})
+    return documents
+
+def remember_render(document):
+    """Warm the render cache for a post or comment that was just saved, and 
+    record the rendering as its current one for readers that defer the body."""
+    set_current_renders({document.id:cached_render(document.id, document.body)})
+
 class Profile(models.Model):
     """User profile information.
 
@@ -15,12 +69,15 @@ class Profile(models.Model):
     name is desirable.
     - karma: The users karma score, this may be removed in later versions.
     - last_notifications_check: The last time the user's client checked their notifications.
-    - moderator: Whether the user is a moderator or not. (May eventually be moved)"""
+    - moderator: Whether the user is a moderator or not. (May eventually be moved)
+    - unread_notification_count: How many of the user's notifications are newer
+    than last_notifications_check, kept up to date by lw2.notifications."""
     user = models.OneToOneField(User, related_name="profile", on_delete=models.CASCADE)
     display_name = models.CharField(null=True, max_length=40)
     karma = models.IntegerField(default=1)
     last_notifications_check = models.DateTimeField(default=datetime.today)
     moderator = models.BooleanField(default=False)
+    unread_notification_count = models.IntegerField(default=0)
     # TODO: Modularize this out into an extension somehow
     hypothesis_user = models.CharField(null=True, default=None, max_length=512)
     hypothesis_group = models.CharField(null=True, default=None, max_length=512)
@@ -29,7 +86,8 @@ class Profile(models.Model):
 class Post(models.Model):
     """A post object.
 
-    - id: A 17 character truncated base64-encoded md5 hash.
+    - id: A 17 character time ordered id, see lw2.ids. Older ones are truncated
+    base64-encoded md5 hashes.
     - posted_at: The time at which the post was made available, as opposed
     to draft creation.
     - frontpage_date: The time at which the post was put "on the front page",
@@ -47,6 +105,9 @@ class Post(models.Model):
 
     class Meta:
         ordering = ['-posted_at']
+        # Back keyset pagination over (posted_at, id)
+        indexes = [models.Index(fields=['posted_at', 'id']),
+                   models.Index(fields=['user', 'posted_at', 'id'])]
     id = models.CharField(primary_key=True, max_length=17)
     posted_at = models.DateTimeField(default=datetime.today)
     frontpage_date = models.DateTimeField(blank=True, null=True, default=None)
@@ -56,7 +117,7 @@ class Post(models.Model):
     title = models.CharField(default="Untitled (this should never appear)",
                              max_length=250)
     url = models.URLField(blank=True, null=True)
-    slug = models.CharField(max_length=60)
+    slug = models.CharField(max_length=60, db_index=True)
     base_score = models.IntegerField(default=1)
     body = models.TextField()
     vote_count = models.IntegerField(default=0)
@@ -66,13 +127,26 @@ class Post(models.Model):
 
     @property
     def html_body(self):
-        # TODO: Add caching
-        return md.convert(self.body)
+        return html_body(self)
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        if "body" not in self.get_deferred_fields():
+            # Warm the render cache so the first reader after an edit doesn't pay for it
+            remember_render(self)
+            index_document("post", self.id, self.body)
+        bump_thread(self.id)
+
+    def delete(self, *args, **kwargs):
+        remove_document("post", self.id)
+        bump_thread(self.id)
+        return super().delete(*args, **kwargs)
     
 class Comment(models.Model):
     """A comment on a Post. 
 
-    - id: A 17 character truncated base64-encoded md5 hash.
+    - id: A 17 character time ordered id, see lw2.ids. Older ones are truncated
+    base64-encoded md5 hashes.
     - user: A user object representing the comments author
     - post: The post object on which the comment was made.
     - parent_comment: If this comment is a reply to another, this field
@@ -80,7 +154,17 @@ class Comment(models.Model):
     - posted_at: The time at which the comment was posted.
     - base_score: The score of the comment object.
     - body: A markdown text comment body.
-    - is_deleted: Whether the post has been hidden from public consumption."""
+    - is_deleted: Whether the post has been hidden from public consumption.
+    - path: The comment's materialized path in its thread, see lw2.threads.
+    - depth: How many replies deep the comment is, top level comments being 0."""
+
+    class Meta:
+        # Back keyset pagination over (posted_at, id)
+        indexes = [models.Index(fields=['posted_at', 'id']),
+                   models.Index(fields=['post', 'posted_at', 'id']),
+                   models.Index(fields=['user', 'posted_at', 'id']),
+                   # Backs fetching a thread or subtree in order
+                   models.Index(fields=['post', 'path'])]
     id = models.CharField(primary_key=True, max_length=17)
     user = models.ForeignKey(User, related_name="comments",
                              null=True, on_delete=models.SET_NULL)
@@ -93,11 +177,29 @@ class Comment(models.Model):
     body = models.TextField()
     retracted = models.BooleanField(default=False)
     is_deleted = models.BooleanField(default=False)
+    path = models.CharField(max_length=MAX_PATH_LENGTH, default="")
+    depth = models.IntegerField(default=0)
 
     @property
     def html_body(self):
-        # TODO: Add caching
-        return md.convert(self.body)
+        return html_body(self)
+
+    def save(self, *args, **kwargs):
+        if not self.path:
+            parent_path = self.parent_comment.path if self.parent_comment_id else ""
+            self.path = child_path(parent_path, self.posted_at, self.id)
+            self.depth = path_depth(self.path)
+        super().save(*args, **kwargs)
+        if "body" not in self.get_deferred_fields():
+            # Warm the render cache so the first reader after an edit doesn't pay for it
+            remember_render(self)
+            index_document("comment", self.id, self.body)
+        bump_thread(self.post_id)
+
+    def delete(self, *args, **kwargs):
+        remove_document("comment", self.id)
+        bump_thread(self.post_id)
+        return super().delete(*args, **kwargs)
     
 def validate_tag_text(text):
     if "," in text or ";" in text:
@@ -114,6 +216,10 @@ class Tag(models.Model):
     - created_at: The date on which the tag was made.
     - text: The tag text, which is case sensitive on storage but searched casei
     """
+
+    class Meta:
+        indexes = [models.Index(fields=['document_id', 'user']),
+                   models.Index(fields=['user', 'created_at'])]
     user = models.ForeignKey(User, related_name="tags",
                              null=True, on_delete=models.SET_NULL)
     document_id = models.CharField(max_length=17)
@@ -134,16 +240,41 @@ class Vote(models.Model):
     - user: The user object that made the vote.
     - voted_at: The date on which the vote was made.
     - power: The number of points the vote is worth, defaults to 1
-    - vote_type: Whether the vote is an upvote or a downvote"""
+    - vote_type: Whether the vote is an upvote or a downvote
+    - pending: Whether the vote is yet to be added to its document's score,
+    see lw2.votes"""
+
+    class Meta:
+        # A user gets one vote per document, this also indexes document_id lookups
+        unique_together = (('document_id', 'user'),)
+        indexes = [models.Index(fields=['user', 'voted_at']),
+                   models.Index(fields=['pending'])]
     user = models.ForeignKey(User, related_name="votes", on_delete=models.CASCADE)
     document_id = models.CharField(max_length=17)
     voted_at = models.DateTimeField(default=datetime.today)
     vote_type = models.CharField(default="smallUpvote", max_length=25)
     power = models.IntegerField(default=1)
+    pending = models.BooleanField(default=False)
+
+class FeedEntry(models.Model):
+    """A post's place in one of the precomputed feeds, see lw2.feeds.
+
+    - feed: The name of the feed, e.g. 'frontpage' or 'hot'
+    - post: The post the entry places
+    - score: The post's rank in the feed, highest first"""
+    class Meta:
+        unique_together = (('feed', 'post'),)
+        indexes = [models.Index(fields=['feed', '-score'])]
+    feed = models.CharField(max_length=16)
+    post = models.ForeignKey(Post, related_name="feed_entries",
+                             on_delete=models.CASCADE)
+    score = models.FloatField()
 
 class Notification(models.Model):
     class Meta:
         ordering = ['-created_at']
+        indexes = [models.Index(fields=['user', 'created_at', 'id']),
+                   models.Index(fields=['document_id'])]
     user = models.ForeignKey(User, related_name="notifications",
                              on_delete=models.CASCADE)
     created_at = models.DateTimeField(default=datetime.today)
@@ -153,17 +284,38 @@ class Notification(models.Model):
     message = models.TextField()
     viewed = models.BooleanField(default=False)
     
+class NotificationEvent(models.Model):
+    """A queued event waiting to be turned into notifications, see
+    lw2.notifications.
+
+    - kind: The kind of document the event is about, 'comment' or 'message'
+    - document_id: The id of the new document
+    - created_at: When the event was queued"""
+    kind = models.CharField(max_length=16)
+    document_id = models.CharField(max_length=17)
+    created_at = models.DateTimeField(default=datetime.today)
+
 class Conversation(models.Model):
     created_at = models.DateTimeField(default=datetime.today)
     title = models.CharField(max_length=150)
 
 class Participant(models.Model):
+    """A user taking part in a conversation.
+
+    - last_read_at: Time of the newest message they've read, None if they
+    haven't read any. Messages from others posted after it are unread.
+    - unread_count: How many unread messages there are, see lw2.conversations"""
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     conversation = models.ForeignKey(Conversation,
                                      related_name="participants",
                                      on_delete=models.CASCADE)
+    last_read_at = models.DateTimeField(null=True, blank=True, default=None)
+    unread_count = models.IntegerField(default=0)
     
 class Message(models.Model):
+    class Meta:
+        # Backs paging through a conversation and counting its unread messages
+        indexes = [models.Index(fields=['conversation', 'created_at', 'id'])]
     user = models.ForeignKey(User,
                              null=True, on_delete=models.SET_NULL)
     conversation = models.ForeignKey(Conversation, related_name="messages",
@@ -189,6 +341,17 @@ class Ban(models.Model):
     until = models.DateTimeField()
     appeal_on = models.DateTimeField()
 
+class TokenGeneration(models.Model):
+    """The revocation generation of a user's logins.
+
+    - user: The user the generation belongs to
+    - generation: Bumped to revoke every access token and cached session the
+    user holds, tokens and sessions from an earlier generation are refused"""
+    user = models.OneToOneField(User, primary_key=True,
+                                related_name="token_generation",
+                                on_delete=models.CASCADE)
+    generation = models.IntegerField(default=0)
+
 class Invite(models.Model):
     """An invitation to join the forum.
 
@@ -209,6 +372,21 @@ class InviteTreeNode(models.Model):
     """A node in the invitation lineage tree.
 
     parent - The account which made the invite.
-    child - The account which accepted it."""
+    child - The account which accepted it.
+    path - The ids of child and everyone above it, from the root of the tree
+    down, each followed by a slash. See lw2.lineage.
+    depth - How many accounts are above child."""
     parent = models.ForeignKey(User, on_delete=models.PROTECT, related_name="inv_parent")
     child = models.ForeignKey(User, on_delete=models.PROTECT, related_name="inv_children")
+    path = models.CharField(max_length=2048, default="", db_index=True)
+    depth = models.IntegerField(default=0)
+
+    def save(self, *args, **kwargs):
+        if not self.path:
+            # A parent with no node of its own is the root of its tree
+            parent_path = (InviteTreeNode.objects.filter(child_id=self.parent_id)
+                           .values_list("path", flat=True).first()
+                           or "{}/".format(self.parent_id))
+            self.path = "{}{}/".format(parent_path, self.child_id)
+            self.depth = self.path.count("/") - 1
+        super().save(*args, **kwargs)
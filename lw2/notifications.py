@@ -0,0 +1,152 @@
+from collections import defaultdict
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.dispatch import Signal
+from .models import Comment, Message, Notification, NotificationEvent, Participant
+from .models import Profile
+from .counters import per_document
+import logging
+
+"""Notification fan-out.
+
+Writes that someone should hear about (a new comment, a new private message)
+only queue a NotificationEvent naming the document, a single insert however
+big the thread or conversation is. deliver_notifications later takes a batch
+of events off the queue, works out who each one notifies and bulk inserts
+their Notification rows.
+
+Delivery runs from the deliver_notifications management command. With
+NOTIFICATION_WORKER off, each request instead delivers the queue itself once its
+transaction commits. That adds the delivery to the request's latency, so it's
+only meant for a development setup with no worker running. Events of a kind
+with no notifier are logged and dropped rather than left to block the queue.
+
+Each profile also counts the user's notifications that are newer than their
+last_notifications_check. Delivery adds to the count and moving the check
+recounts it, so clients polling for unread notifications read a single
+column."""
+
+logger = logging.getLogger(__name__)
+
+# Sent with the notifications of each delivered batch, which bulk_create
+# otherwise creates without any post_save
+notifications_delivered = Signal(providing_args=["notifications"])
+
+def emit(kind, document_id):
+    """Queue an event about a new document of kind 'comment' or 'message'."""
+    emit_all(kind, [document_id])
+
+def emit_all(kind, document_ids):
+    """Queue an event for each of several new documents of the same kind, in a
+    single insert."""
+    NotificationEvent.objects.bulk_create(
+        [NotificationEvent(kind=kind, document_id=str(document_id))
+         for document_id in document_ids])
+    if not getattr(settings, "NOTIFICATION_WORKER", True):
+        transaction.on_commit(deliver_notifications)
+
+def comment_notifications(events):
+    comments = Comment.objects.filter(
+        id__in=[event.document_id for event in events]).select_related(
+            "user", "post", "parent_comment")
+    notifications = []
+    for comment in comments:
+        actor = comment.user.username if comment.user else "Someone"
+        notified = {comment.user_id}
+        parent = comment.parent_comment
+        if parent and parent.user_id and parent.user_id not in notified:
+            notified.add(parent.user_id)
+            notifications.append(Notification(
+                user_id=parent.user_id, document_id=comment.id,
+                document_type="comment", type="newReply",
+                message="{} replied to your comment".format(actor)))
+        post = comment.post
+        if post and post.user_id and post.user_id not in notified:
+            notifications.append(Notification(
+                user_id=post.user_id, document_id=comment.id,
+                document_type="comment", type="newComment",
+                message="{} commented on your post '{}'".format(actor, post.title)))
+    return notifications
+
+def message_notifications(events):
+    messages = list(Message.objects.filter(
+        id__in=[event.document_id for event in events]).select_related("user"))
+    participants = defaultdict(list)
+    for conversation_id, user_id in Participant.objects.filter(
+            conversation__in={message.conversation_id for message in messages}
+    ).values_list("conversation", "user"):
+        participants[conversation_id].append(user_id)
+    notifications = []
+    for message in messages:
+        sender = message.user.username if message.user else "Someone"
+        notifications.extend(
+            Notification(user_id=user_id, document_id=str(message.id),
+                         document_type="message", type="newMessage",
+                         message="{} sent you a message".format(sender))
+            for user_id in set(participants[message.conversation_id])
+            if user_id != message.user_id)
+    return notifications
+
+NOTIFIERS = {
+    "comment":comment_notifications,
+    "message":message_notifications,
+}
+
+def deliver_notifications(batch_size=None):
+    """Create the notifications for up to batch_size queued events and return
+    how many events were delivered."""
+    batch_size = batch_size or getattr(settings, "NOTIFICATION_BATCH_SIZE", 500)
+    with transaction.atomic():
+        events = list(NotificationEvent.objects.select_for_update(skip_locked=True)
+                      .order_by("id")[:batch_size])
+        if not events:
+            return 0
+        by_kind = defaultdict(list)
+        for event in events:
+            by_kind[event.kind].append(event)
+        notifications = []
+        for kind, kind_events in by_kind.items():
+            if kind not in NOTIFIERS:
+                logger.warning("Dropping %d notification events of unknown kind %r",
+                               len(kind_events), kind)
+                continue
+            notifications.extend(NOTIFIERS[kind](kind_events))
+        Notification.objects.bulk_create(notifications)
+        notifications_delivered.send(sender=Notification, notifications=notifications)
+        unread = defaultdict(int)
+        for notification in notifications:
+            unread[notification.user_id] += 1
+        if unread:
+            Profile.objects.filter(user_id__in=unread).update(
+                unread_notification_count=F("unread_notification_count") +
+                per_document(unread, key="user_id"))
+        NotificationEvent.objects.filter(
+            id__in=[event.id for event in events]).delete()
+    return len(events)
+
+def check_notifications(profile, checked_at):
+    """Move a profile's last_notifications_check to checked_at and recount its
+    unread notifications."""
+    with transaction.atomic():
+        if profile.pk is None:
+            profile.save()
+        # Waits for a delivery that is adding to the count to commit, so the
+        # recount includes its notifications
+        list(Profile.objects.select_for_update().filter(pk=profile.pk)
+             .values_list("pk"))
+        profile.last_notifications_check = checked_at
+        profile.unread_notification_count = Notification.objects.filter(
+            user_id=profile.user_id, created_at__gt=checked_at).count()
+        # Only these columns, the rest of profile may be stale
+        Profile.objects.filter(pk=profile.pk).update(
+            last_notifications_check=profile.last_notifications_check,
+            unread_notification_count=profile.unread_notification_count)
+
+def unread_notifications(user):
+    """How many unread notifications user has."""
+    try:
+        return user.profile.unread_notification_count
+    except Profile.DoesNotExist:
+        # Without a profile there's no check to compare to
+        return Notification.objects.filter(user=user).count()
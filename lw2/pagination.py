@@ -0,0 +1,61 @@
+import base64
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+"""Keyset (cursor) pagination for the GraphQL list queries.
+
+Lists are ordered newest first by a timestamp with the id as a tie breaker, and
+a cursor encodes the (timestamp, id) of one item. Paging after or before a
+cursor is then a range condition on an index over (timestamp, id), so a deep
+page costs the same as the first one, unlike OFFSET which has to walk every
+skipped row."""
+
+def make_cursor(timestamp, id):
+    raw = "{}|{}".format(timestamp.isoformat(), id)
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def parse_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        timestamp, id = raw.split("|", 1)
+    except ValueError:
+        raise ValueError("'{}' is not a valid cursor.".format(cursor))
+    return parse_datetime(timestamp), id
+
+def keyset_paginate(queryset, time_field, after=None, before=None, limit=None):
+    """Order queryset newest first by (time_field, id) and return the items
+    strictly after and/or before the given cursors, up to limit of them.
+
+    When paging backwards with a limit the page nearest the before cursor is
+    returned, still in newest first order."""
+    queryset = queryset.order_by("-" + time_field, "-id")
+    if after:
+        timestamp, id = parse_cursor(after)
+        queryset = queryset.filter(Q(**{time_field + "__lt":timestamp}) |
+                                   Q(**{time_field:timestamp, "id__lt":id}))
+    if before:
+        timestamp, id = parse_cursor(before)
+        queryset = queryset.filter(Q(**{time_field + "__gt":timestamp}) |
+                                   Q(**{time_field:timestamp, "id__gt":id}))
+        if limit:
+            page = list(queryset.reverse()[:limit])
+            page.reverse()
+            return page
+    if limit:
+        return queryset[:limit]
+    return queryset
+
+def paginate(queryset, time_field, terms, default_limit=None):
+    """Apply the limit and either the offset or the after/before cursors given in
+    a set of list terms."""
+    limit = terms.limit or default_limit
+    if terms.after or terms.before:
+        return keyset_paginate(queryset, time_field,
+                               after=terms.after,
+                               before=terms.before,
+                               limit=limit)
+    queryset = queryset.order_by("-" + time_field, "-id")
+    offset = terms.offset or 0
+    if limit:
+        return queryset[offset:offset + limit]
+    return queryset[offset:]
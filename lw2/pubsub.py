@@ -0,0 +1,171 @@
+from collections import defaultdict
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from .models import Comment
+from .notifications import notifications_delivered
+import queue
+import threading
+import time
+
+"""Publish/subscribe for the event stream.
+
+New comments are published on the channel of their post and delivered
+notifications on the channel of their user, both once the transaction that
+created them commits. The event stream view subscribes a client to the channels
+it watches and relays what arrives, so clients don't poll.
+
+The broker is set by EVENT_BROKER. LocalBroker hands messages straight to
+subscribers in the same process, which is all a single process deployment
+needs. With several processes use CacheBroker, which passes messages through
+the shared cache, or any class with the same publish and subscribe methods."""
+
+def post_channel(post_id):
+    return "post:{}".format(post_id)
+
+def user_channel(user_id):
+    return "user:{}".format(user_id)
+
+class LocalSubscription(object):
+    def __init__(self, broker, channels):
+        self.broker = broker
+        self.channels = channels
+        self.messages = queue.Queue()
+
+    def get(self, timeout):
+        """Wait up to timeout seconds for the next (channel, message), returning
+        None if nothing arrives."""
+        try:
+            return self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+class LocalBroker(object):
+    """Broker for subscribers in the publishing process."""
+    def __init__(self):
+        self.subscriptions = defaultdict(set)
+        self.lock = threading.Lock()
+
+    def publish(self, channel, message):
+        with self.lock:
+            subscriptions = list(self.subscriptions[channel])
+        for subscription in subscriptions:
+            subscription.messages.put((channel, message))
+
+    def subscribe(self, channels):
+        subscription = LocalSubscription(self, channels)
+        with self.lock:
+            for channel in channels:
+                self.subscriptions[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            for channel in subscription.channels:
+                self.subscriptions[channel].discard(subscription)
+                if not self.subscriptions[channel]:
+                    del self.subscriptions[channel]
+
+class CacheSubscription(object):
+    def __init__(self, broker, channels):
+        self.broker = broker
+        # Only messages published from now on
+        self.seen = {channel:broker.sequence(channel) for channel in channels}
+        self.pending = []
+
+    def get(self, timeout):
+        deadline = time.time() + timeout
+        while not self.pending:
+            self.poll()
+            if self.pending or time.time() >= deadline:
+                break
+            time.sleep(min(self.broker.poll_interval, max(0, deadline - time.time())))
+        if self.pending:
+            return self.pending.pop(0)
+        return None
+
+    def poll(self):
+        latest = cache.get_many([self.broker.sequence_key(channel)
+                                 for channel in self.seen])
+        keys = {}
+        for channel, seen in self.seen.items():
+            for number in range(seen + 1,
+                                latest.get(self.broker.sequence_key(channel), 0) + 1):
+                keys[self.broker.message_key(channel, number)] = (channel, number)
+            self.seen[channel] = latest.get(self.broker.sequence_key(channel), seen)
+        messages = cache.get_many(list(keys))
+        # In order within each channel. Messages that expired before we got to
+        # them are skipped
+        for key in sorted(messages, key=lambda key: keys[key][1]):
+            self.pending.append((keys[key][0], messages[key]))
+
+    def close(self):
+        pass
+
+class CacheBroker(object):
+    """Broker that works across processes sharing a cache. Each channel is a
+    numbered sequence of messages kept for EVENT_RETENTION seconds, which
+    subscribers poll every EVENT_POLL_INTERVAL seconds."""
+    def __init__(self):
+        self.poll_interval = getattr(settings, "EVENT_POLL_INTERVAL", 0.5)
+        self.retention = getattr(settings, "EVENT_RETENTION", 60)
+
+    def sequence_key(self, channel):
+        return "lw2:events:{}".format(channel)
+
+    def message_key(self, channel, number):
+        return "lw2:events:{}:{}".format(channel, number)
+
+    def sequence(self, channel):
+        return cache.get(self.sequence_key(channel), 0)
+
+    def publish(self, channel, message):
+        cache.add(self.sequence_key(channel), 0, None)
+        number = cache.incr(self.sequence_key(channel))
+        cache.set(self.message_key(channel, number), message, self.retention)
+
+    def subscribe(self, channels):
+        return CacheSubscription(self, channels)
+
+brokers = {}
+
+def get_broker():
+    path = getattr(settings, "EVENT_BROKER", "lw2.pubsub.LocalBroker")
+    if path not in brokers:
+        brokers[path] = import_string(path)()
+    return brokers[path]
+
+def publish(channel, message):
+    """Publish message on channel once the current transaction commits."""
+    transaction.on_commit(lambda: get_broker().publish(channel, message))
+
+def subscribe(channels):
+    return get_broker().subscribe(channels)
+
+@receiver(post_save, sender=Comment)
+def comment_saved(sender, instance, created, **kwargs):
+    if created and instance.post_id:
+        publish(post_channel(instance.post_id),
+                {"event":"comment",
+                 "_id":instance.id,
+                 "postId":instance.post_id,
+                 "parentCommentId":instance.parent_comment_id,
+                 "userId":instance.user_id and str(instance.user_id),
+                 "postedAt":instance.posted_at.isoformat()})
+
+@receiver(notifications_delivered)
+def notifications_sent(sender, notifications, **kwargs):
+    for notification in notifications:
+        publish(user_channel(notification.user_id),
+                {"event":"notification",
+                 "type":notification.type,
+                 "documentId":notification.document_id,
+                 "documentType":notification.document_type,
+                 "message":notification.message,
+                 "createdAt":notification.created_at.isoformat()})
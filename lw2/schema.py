@@ -1,29 +1,103 @@
 from graphene_django import DjangoObjectType
 import graphene
 from graphene.types.generic import GenericScalar
+from graphql.language import ast
+from promise import Promise
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate, login
+from django.conf import settings
+from django.db import transaction
 from django.db.models import Case, When, Max
 from .models import Profile,Vote, Notification, Conversation, Participant
 from .models import Message as MessageModel
 from .models import Post as PostModel
 from .models import Comment as CommentModel
-from .markdown import md
-from datetime import datetime, timezone
-
-import hashlib
-import base64
-
-def make_id(username, utc_timestamp):
-    hashable = username + str(utc_timestamp)
-    hash_raw = hashlib.md5(hashable.encode())
-    hash_b64 = base64.b64encode(hash_raw.digest()).decode()
-    return hash_b64[:17].replace("/","_").replace("+","-")
-
-def make_id_from_user(username):
-    """Wrapper around make_id that eliminates finnicky time handling code."""
-    return make_id(username,
-                   datetime.today().replace(tzinfo=timezone.utc).timestamp())
+from .models import prerender_html
+from .loaders import get_loaders, load_user, load_profile, load_viewer
+from .pagination import paginate, make_cursor
+from .threads import thread, thread_limit
+from .counters import create_comment
+from .votes import cast_vote, pending_score, write_behind
+from .view_counts import record_view
+from .feeds import FEEDS, feed
+from .notifications import emit, check_notifications, unread_notifications
+from .conversations import get_participant, inbox, inbox_message
+from .conversations import conversation_messages, send_message
+from .conversations import create_conversation, broadcast
+from .markdown import render
+from .auth_header import make_access_token
+from .ids import new_id
+from datetime import datetime
+
+def requested_fields(info):
+    """Return the names of the fields selected beneath the field being resolved,
+    following fragments. Names are as written in the query, e.g 'htmlBody'."""
+    fields = set()
+    def collect(selection_set):
+        for selection in selection_set.selections:
+            if isinstance(selection, ast.Field):
+                fields.add(selection.name.value)
+            elif isinstance(selection, ast.FragmentSpread):
+                collect(info.fragments[selection.name.value].selection_set)
+            else:
+                collect(selection.selection_set)
+    for field_ast in info.field_asts:
+        if field_ast.selection_set:
+            collect(field_ast.selection_set)
+    return fields
+
+# The relations worth joining (select_related) or batch fetching (prefetch_related)
+# when a list query asks for a given field of a post or comment
+SELECT_RELATED = {
+    PostModel: {"user":["user__profile"]},
+    CommentModel: {"user":["user__profile"],
+                   "post":["post"],
+                   "parentComment":["parent_comment"]},
+}
+PREFETCH_RELATED = {
+    PostModel: {"comments":["comments"]},
+    CommentModel: {},
+}
+
+def plan_query(info, queryset):
+    """Shape a post or comment queryset to fit the fields the query selects.
+
+    Relations that will be read are joined or prefetched up front rather than
+    queried per row, and the body column is deferred unless the body itself is
+    requested. htmlBody is then served by prerender_if_requested, which only 
+    fetches the bodies that aren't already rendered in the cache."""
+    fields = requested_fields(info)
+    model = queryset.model
+    select_related = [relation
+                      for field, relations in SELECT_RELATED[model].items()
+                      if field in fields
+                      for relation in relations]
+    prefetch_related = [relation
+                        for field, relations in PREFETCH_RELATED[model].items()
+                        if field in fields
+                        for relation in relations]
+    if select_related:
+        queryset = queryset.select_related(*select_related)
+    if prefetch_related:
+        queryset = queryset.prefetch_related(*prefetch_related)
+    if "body" not in fields:
+        queryset = queryset.defer("body")
+    return queryset
+
+def resolve_score(document, info):
+    """The score of a post or comment, counting the requesting user's votes on
+    it that haven't been flushed yet."""
+    if not (write_behind() and info.context.user.is_authenticated):
+        return document.base_score
+    return get_loaders(info).user_votes.load(document.id).then(
+        lambda votes: pending_score(document, votes))
+
+def prerender_if_requested(info, documents):
+    """Batch render the bodies of a list of posts or comments if the query asks
+    for their htmlBody."""
+    if "htmlBody" in requested_fields(info):
+        return prerender_html(documents)
+    return documents
     
 class UserType(DjangoObjectType):
     class Meta:
@@ -37,6 +111,8 @@ class UserType(DjangoObjectType):
     display_name = graphene.String()
     karma = graphene.Int()
     last_notifications_check = graphene.types.datetime.Date()
+    unread_notification_count = graphene.Int(
+        description="Notifications since lastNotificationsCheck, only shown to the user themselves.")
 
     def resolve__id(self, info):
         return str(self.id)
@@ -45,27 +121,35 @@ class UserType(DjangoObjectType):
         return self.username
 
     def resolve_display_name(self, info):
-        try:
-            display_name = self.profile.display_name
-        except AttributeError:
-            print("User {} has no profile!".format(self.username))
-            display_name = self.username
-        if display_name:
-            return display_name
-        else:
-            return self.username
+        def display_name(profile):
+            if profile is None:
+                print("User {} has no profile!".format(self.username))
+                return self.username
+            return profile.display_name or self.username
+        return load_profile(info, self).then(display_name)
 
     def resolve_karma(self, info):
-        try:
-            return self.profile.karma
-        except AttributeError:
-            raise ValueError("User {} has no profile!".format(self.username))
+        def karma(profile):
+            if profile is None:
+                raise ValueError("User {} has no profile!".format(self.username))
+            return profile.karma
+        return load_profile(info, self).then(karma)
 
     def resolve_last_notifications_check(self, info):
-        try:
-            return self.profile.last_notifications_check
-        except AttributeError:
-            raise ValueError("User {} has no profile!".format(self.username))
+        def last_notifications_check(profile):
+            if profile is None:
+                raise ValueError("User {} has no profile!".format(self.username))
+            return profile.last_notifications_check
+        return load_profile(info, self).then(last_notifications_check)
+
+    def resolve_unread_notification_count(self, info):
+        if info.context.user.id != self.id:
+            return None
+        def unread_notification_count(profile):
+            if profile is None:
+                return unread_notifications(self)
+            return profile.unread_notification_count
+        return load_profile(info, self).then(unread_notification_count)
 
 class UsersInput(graphene.InputObjectType):
     last_notifications_check = graphene.types.datetime.DateTime()
@@ -92,9 +176,9 @@ class UsersEdit(graphene.Mutation):
             profile = Profile(user=user)
                               
         if set.last_notifications_check:
-            profile.last_notifications_check = set.last_notifications_check
-
-        profile.save()
+            check_notifications(profile, set.last_notifications_check)
+        else:
+            profile.save()
         return UsersEdit(_id=str(user.id))
         
                
@@ -106,16 +190,21 @@ class Login(graphene.Mutation):
     user_id = graphene.Int()
     session_key = graphene.String()
     expiration = graphene.Float()
+    access_token = graphene.String()
+    access_token_expiration = graphene.Float()
     
     @staticmethod
     def mutate(root, info, username=None, password=None):
         user = authenticate(info.context, username=username, password=password)
         if user is not None:
             login(info.context, user)
+            access_token, access_token_expiration = make_access_token(user)
             return Login(user_id=user.id,
                          session_key=info.context.session.session_key,
                          expiration=(
-                             info.context.session.get_expiry_date().timestamp())
+                             info.context.session.get_expiry_date().timestamp()),
+                         access_token=access_token,
+                         access_token_expiration=access_token_expiration
             )
                          
         else:
@@ -154,36 +243,42 @@ class Comment(DjangoObjectType):
         description="Whether this comment has been deleted from view.")
     af = graphene.Boolean(
         description="Legacy field for whether we're on alignment forum, always false.")
+    cursor = graphene.String(
+        description="Pass as after or before in CommentsList terms to page from this comment.")
     
     def resolve__id(self, info):
         return self.id
+
+    def resolve_cursor(self, info):
+        return make_cursor(self.posted_at, self.id)
+
+    def resolve_user(self, info):
+        return load_user(info, self)
     
     def resolve_user_id(self, info):
-        return str(self.user.id)
+        if self.user_id is None:
+            return None
+        return str(self.user_id)
 
     def resolve_post_id(self, info):
-        return self.post.id
+        return self.post_id
 
     def resolve_parent_comment_id(self, info):
-        try:
-            return self.parent_comment.id
-        except AttributeError:
-            return None
+        return self.parent_comment_id
 
     def resolve_html_body(self, info):
         if self.is_deleted:
             return "<p>[This post has been deleted]</p>"
-        return md.convert(self.body)
+        return self.html_body
 
     def resolve_vote_count(self, info):
-        return Vote.objects.filter(document_id=self.id).count()
+        return get_loaders(info).vote_counts.load(self.id)
 
     def resolve_current_user_votes(self, info):
-        try:
-            return Vote.objects.filter(user=info.context.user,
-                                       document_id=self.id)
-        except IndexError:
-            return []
+        return get_loaders(info).user_votes.load(self.id)
+
+    def resolve_base_score(self, info):
+        return resolve_score(self, info)
 
     def resolve_retracted(self, info):
         return self.retracted
@@ -227,8 +322,7 @@ class CommentsNew(graphene.Mutation):
         
         posted_at = datetime.today()
         
-        _id = make_id(user.username,
-                      posted_at.replace(tzinfo=timezone.utc).timestamp())
+        _id = new_id()
         
         comment = CommentModel(
             id = _id,
@@ -237,8 +331,9 @@ class CommentsNew(graphene.Mutation):
             parent_comment = parent_comment,
             posted_at = posted_at,
             body=document.body)
-        #TODO: Am I supposed to call save here or is there framework stuff I'm missing?
-        comment.save()
+        with transaction.atomic():
+            create_comment(comment)
+            emit("comment", comment.id)
 
         return CommentsNew(comment=comment)
 
@@ -289,20 +384,33 @@ class Post(DjangoObjectType):
         may or may not exist in accordius.""")
     af = graphene.Boolean(
         description="Legacy field for whether we're in alignment forum, always false.")
+    cursor = graphene.String(
+        description="Pass as after or before in PostsList terms to page from this post.")
 
     def resolve__id(self,info):
         return self.id
+
+    def resolve_cursor(self, info):
+        return make_cursor(self.posted_at, self.id)
+
+    def resolve_user(self, info):
+        return load_user(info, self)
     
     def resolve_user_id(self, info):
-        return str(self.user.id)
+        if self.user_id is None:
+            return None
+        return str(self.user_id)
 
     def resolve_html_body(self, info):
         """Create an HTML text from the Markdown post body."""
-        return md.convert(self.body)
+        return self.html_body
 
     def resolve_comment_count(self, info):
-        """Derived field that returns the number of comments on a given post."""
-        return self.comments.count()
+        """Number of comments on a given post, as counted when they're made."""
+        return self.comment_count
+
+    def resolve_base_score(self, info):
+        return resolve_score(self, info)
     
     def resolve_meta(self, info):
         """Legacy field that says whether the post goes into the 'meta' section,
@@ -350,8 +458,7 @@ class PostsNew(graphene.Mutation):
         if not document.title:
             raise ValueError("Can't make a post with an empty title!")
         posted_at = datetime.today()
-        _id = make_id(user.username,
-                      posted_at.replace(tzinfo=timezone.utc).timestamp())
+        _id = new_id()
         slug = document.title.strip().lower().replace(" ", "-")[:60]
         post = PostModel(id=_id,
                          posted_at=posted_at,
@@ -424,56 +531,25 @@ class NewVote(graphene.Mutation):
     def mutate(root, info, document_id=None, vote_type=None,
                collection_name=None):
         if collection_name.lower() == "comments":
-            if Vote.objects.filter(document_id=document_id):
-                raise ValueError("User already voted on this")
-            comment = CommentModel.objects.get(id=document_id)
-            #TODO: Enforce valid vote types
-            vote = Vote(user=info.context.user,
-                        document_id=document_id,
-                        voted_at=datetime.today(),
-                        vote_type=vote_type)
-            if "Upvote" in vote_type:
-                comment.base_score += 1
-            elif "Downvote" in vote_type:
-                comment.base_score -= 1
-            else:
-                raise ValueError(
-                    "'{}' does not appear to be upvote or downvote".format(
-                        vote_type)
-                )
-            vote.save()
-            comment.save()
-            return comment
+            document_model = CommentModel
         elif collection_name.lower() == "posts":
-            if Vote.objects.filter(document_id=document_id):
-                raise ValueError("User already voted on this")
-            post = PostModel.objects.get(id=document_id)
-            #TODO: Enforce valid vote types
-            vote = Vote(user=info.context.user,
-                        document_id=document_id,
-                        voted_at=datetime.today(),
-                        vote_type=vote_type)
-            if "Upvote" in vote_type:
-                post.base_score += 1
-            elif "Downvote" in vote_type:
-                post.base_score -= 1
-            else:
-                raise ValueError(
-                    "'{}' does not appear to be upvote or downvote".format(
-                        vote_type)
-                )
-            vote.save()
-            post.save()
-            return post
+            document_model = PostModel
         else:
             raise ValueError("Collection '{}' is not handled by accordius!".format(
                 collection_name))
+        document = document_model.objects.get(id=document_id)
+        #TODO: Enforce valid vote types
+        cast_vote(info.context.user, document_model, document_id, vote_type)
+        document.refresh_from_db()
+        return document
                 
     
 class CommentsTerms(graphene.InputObjectType):
     """Search terms for the comments_total and the comments_list."""
     limit = graphene.Int()
     offset = graphene.Int()
+    after = graphene.String(description="Cursor of the comment to list comments after.")
+    before = graphene.String(description="Cursor of the comment to list comments before.")
     post_id = graphene.String()
     user_id = graphene.String()
     view = graphene.String()
@@ -482,9 +558,12 @@ class PostsTerms(graphene.InputObjectType):
     """Search terms for the posts_list."""
     limit = graphene.Int()
     offset = graphene.Int()
+    after = graphene.String(description="Cursor of the post to list posts after.")
+    before = graphene.String(description="Cursor of the post to list posts before.")
     post_id = graphene.String()
     user_id = graphene.String()
-    view = graphene.String()
+    view = graphene.String(
+        description="One of the feeds 'frontpage', 'curated', 'new', 'top' or 'hot', which page by offset.")
     # Legacy field for LW 2 compatibility
     # Should be boolean, but sometimes presents as null so generic required 
     meta = graphene.Boolean()
@@ -493,12 +572,28 @@ class NotificationsTerms(graphene.InputObjectType):
     """Search terms for the notifications."""
     limit = graphene.Int()
     offset = graphene.Int()
+    after = graphene.String(
+        description="Cursor of the notification to list notifications after.")
+    before = graphene.String(
+        description="Cursor of the notification to list notifications before.")
     user_id = graphene.String()
     view = graphene.String()
 
 class MessagesTerms(graphene.InputObjectType):
     conversation_id = graphene.String()
     view = graphene.String()
+    limit = graphene.Int()
+    after = graphene.String(
+        description="Cursor of the message to list earlier messages than.")
+    before = graphene.String(
+        description="Cursor of the message to list later messages than.")
+
+class ConversationsTerms(graphene.InputObjectType):
+    limit = graphene.Int()
+    after = graphene.String(
+        description="Cursor of the conversation to list conversations after.")
+    before = graphene.String(
+        description="Cursor of the conversation to list conversations before.")
     
 class NotificationType(DjangoObjectType):
     class Meta:
@@ -507,10 +602,14 @@ class NotificationType(DjangoObjectType):
     _id = graphene.String(name="_id")
     title = graphene.String()
     link = graphene.String()
+    cursor = graphene.String()
 
     def resolve__id(self, info):
         return str(self.id)
 
+    def resolve_cursor(self, info):
+        return make_cursor(self.created_at, self.id)
+
     def resolve_title(self, info):
         # Just do a dummy resolver for now
         return "Test title"
@@ -522,18 +621,27 @@ class NotificationType(DjangoObjectType):
 class ParticipantType(DjangoObjectType):
     class Meta:
         model = Participant
+        # Only the participant themselves should see these, through
+        # ConversationType
+        exclude_fields = ('last_read_at', 'unread_count')
 
     display_name = graphene.String()
     slug = graphene.String()
 
     def resolve_display_name(self, info):
-        display_name = self.user.profile.get(user=self.user).display_name
-        if display_name:
-            return display_name
-        else:
-            return self.user.username
+        loaders = get_loaders(info)
+        def display_name(user_and_profile):
+            user, profile = user_and_profile
+            if profile and profile.display_name:
+                return profile.display_name
+            else:
+                return user.username
+        return Promise.all([loaders.users.load(self.user_id),
+                            loaders.profiles.load(self.user_id)]).then(display_name)
+
     def resolve_slug(self, info):
-        return self.user.username
+        return get_loaders(info).users.load(self.user_id).then(
+            lambda user: user.username)
     
 class ConversationsInput(graphene.InputObjectType):
     participant_ids = graphene.List(graphene.String)
@@ -542,15 +650,49 @@ class ConversationsInput(graphene.InputObjectType):
 class ConversationType(DjangoObjectType):
     class Meta:
         model = Conversation
+        # A conversation's messages are read a page at a time from MessagesList
+        exclude_fields = ('messages',)
 
     _id = graphene.String(name="_id")
     participants = graphene.List(ParticipantType)
+    latest_message = graphene.Field(lambda: Message)
+    unread_count = graphene.Int()
+    last_read_at = graphene.types.datetime.DateTime()
+    cursor = graphene.String()
+
+    # ConversationsSingle and ConversationsList set viewer to the Participant of
+    # the user asking, which carries their read marker and, in
+    # ConversationsList, the latest message. Conversations reached any other
+    # way load it
     
     def resolve__id(self, info):
         return str(self.id)
 
     def resolve_participants(self, info):
-        return self.participants.all()
+        return get_loaders(info).participants.load(self.id)
+
+    def resolve_latest_message(self, info):
+        def latest_message(viewer):
+            if viewer is None:
+                return None
+            if hasattr(viewer, "latest_message_id"):
+                return inbox_message(viewer)
+            return self.messages.order_by("-created_at", "-id").first()
+        return load_viewer(info, self).then(latest_message)
+
+    def resolve_unread_count(self, info):
+        return load_viewer(info, self).then(
+            lambda viewer: viewer and viewer.unread_count)
+
+    def resolve_last_read_at(self, info):
+        return load_viewer(info, self).then(
+            lambda viewer: viewer and viewer.last_read_at)
+
+    def resolve_cursor(self, info):
+        viewer = getattr(self, "viewer", None)
+        if hasattr(viewer, "last_activity"):
+            return make_cursor(viewer.last_activity, viewer.id)
+        return None
     
 class ConversationsNew(graphene.Mutation):
     class Arguments:
@@ -566,14 +708,9 @@ class ConversationsNew(graphene.Mutation):
                     repr(document)
                     )
             )
-        convo = Conversation(title=document.title)
-        convo.save()
-        #TODO: Delete convo if we get error here
-        for participant_id in document.participant_ids:
-            user = User.objects.get(id=int(participant_id))
-            participant = Participant(user=user,
-                                      conversation=convo)
-            participant.save()
+        if not info.context.user.is_authenticated:
+            raise ValueError("You need to be logged in to start a conversation")
+        convo = create_conversation(document.title, document.participant_ids or [])
         return ConversationsNew(_id=convo.id)
     
 class MessagesInput(graphene.InputObjectType):
@@ -588,18 +725,24 @@ class Message(DjangoObjectType):
     user_id = graphene.String()
     html_body = graphene.String()
     posted_at = graphene.types.datetime.DateTime()
+    cursor = graphene.String()
     
     def resolve__id(self, info):
         return str(self.id)
+
+    def resolve_cursor(self, info):
+        return make_cursor(self.created_at, self.id)
     
     def resolve_user_id(self, info):
-        return str(self.user.id)
+        if self.user_id is None:
+            return None
+        return str(self.user_id)
 
     def resolve_posted_at(self, info):
         return self.created_at
     
     def resolve_html_body(self, info):
-        return md.convert(self.body)
+        return render(self.body)
 
 class MessagesNew(graphene.Mutation):
     class Arguments:
@@ -617,14 +760,41 @@ class MessagesNew(graphene.Mutation):
             )
         if not info.context.user.is_authenticated:
             raise ValueError("You need to be logged in to send private messages")
-        
-        conversation = Conversation.objects.get(id=int(document.conversation_id))
-        message_text = document.body
-        message = MessageModel(user=info.context.user,
-                               conversation=conversation,
-                               body=message_text)
-        message.save()
+        message = send_message(info.context.user, document.conversation_id,
+                               document.body)
         return MessagesNew(_id=message.id)
+
+class MessagesBroadcastInput(graphene.InputObjectType):
+    participant_ids = graphene.List(graphene.String)
+    title = graphene.String()
+    body = graphene.String()
+
+class MessagesBroadcast(graphene.Mutation):
+    """Send the same message to many users, each in a new conversation of their
+    own with the sender. Only moderators can broadcast."""
+    class Arguments:
+        document = MessagesBroadcastInput()
+
+    _ids = graphene.List(graphene.String, name="_ids")
+    conversation_ids = graphene.List(graphene.String)
+
+    @staticmethod
+    def mutate(root, info, document=None):
+        if not document:
+            raise ValueError(
+                "No broadcast variables were passed, got '{}' instead.".format(
+                    repr(document)
+                    )
+            )
+        user = info.context.user
+        if not (user.is_authenticated and
+                Profile.objects.filter(user=user, moderator=True).exists()):
+            raise ValueError("Only moderators can broadcast messages")
+        messages = broadcast(user, document.participant_ids or [],
+                             document.title, document.body)
+        return MessagesBroadcast(
+            _ids=[str(message.id) for message in messages],
+            conversation_ids=[str(message.conversation_id) for message in messages])
         
     
 class APIDescriptions(object):
@@ -680,6 +850,18 @@ class Query(object):
                                    name="CommentsList")
     comments_new = graphene.Field(Comment,
                                   _id = graphene.String(name="_id"))
+    comments_tree = graphene.Field(
+        graphene.List(Comment),
+        post_id = graphene.String(required=True),
+        comment_id = graphene.String(
+            description="Only return this comment and the replies under it."),
+        max_depth = graphene.Int(
+            description="How many levels of replies to include below the top."),
+        after = graphene.String(
+            description="ID of the last comment of the previous page."),
+        limit = graphene.Int(),
+        name="CommentsTree",
+        description="A post's comments in thread order, depth first.")
 
     comments_edit = graphene.Field(Comment,
                                    _id = graphene.String(name="_id"))
@@ -695,9 +877,16 @@ class Query(object):
     conversations_single = graphene.Field(ConversationType,
                                           document_id = graphene.String(),
                                           name="ConversationsSingle")
-    messages_list = graphene.Field(graphene.List(Message),
-                                   terms = graphene.Argument(MessagesTerms),
-                                   name="MessagesList")
+    conversations_list = graphene.Field(
+        graphene.List(ConversationType),
+        terms = graphene.Argument(ConversationsTerms),
+        name="ConversationsList",
+        description="The logged in user's conversations, most recently active first.")
+    messages_list = graphene.Field(
+        graphene.List(Message),
+        terms = graphene.Argument(MessagesTerms),
+        name="MessagesList",
+        description="A page of a conversation's messages, oldest first. Without cursors this is the latest page, which also marks the conversation read.")
     
     def resolve_users_single(self, info, **kwargs):
         id = kwargs.get('id')
@@ -722,26 +911,38 @@ class Query(object):
     def resolve_posts_single(self, info, **kwargs):
         id = kwargs.get('document_id')
         if id:
-            return PostModel.objects.get(id=id)
+            post = PostModel.objects.get(id=id)
+            record_view(info.context, post.id)
+            return post
 
         raise ValueError("No post with ID '{}' found.".format(id))
         
     def resolve_all_posts(self, info, **kwargs):
         #TODO: Figure out a better way to maintain compatibility here
         #...If there is one.
-        return PostModel.objects.all()
+        return prerender_if_requested(info, plan_query(info, PostModel.objects.all()))
 
     def resolve_posts_list(self, info, **kwargs):
         args = kwargs.get("terms")
+        posts = PostModel.objects.all()
         if args.user_id:
             user = User.objects.get(id=args.user_id)
-            return PostModel.objects.filter(user=user)
-        posts = PostModel.objects.all()
-        if args.limit and args.offset:
-            return posts[args.offset:args.offset + args.limit]
-        elif args.limit:
-            return posts[:args.limit]
-        return posts
+            posts = posts.filter(user=user)
+        if args.view in FEEDS:
+            # Feeds are ranked by score rather than time, so they page by offset
+            if args.after or args.before:
+                raise ValueError(
+                    "The '{}' view pages by offset, not after or before.".format(
+                        args.view))
+            posts = feed(args.view, plan_query(info, posts))
+            offset = args.offset or 0
+            if args.limit:
+                posts = posts[offset:offset + args.limit]
+            else:
+                posts = posts[offset:]
+        else:
+            posts = paginate(plan_query(info, posts), "posted_at", args)
+        return prerender_if_requested(info, posts)
 
     def resolve_comment(self, info, **kwargs):
         id = kwargs.get('id')
@@ -752,7 +953,7 @@ class Query(object):
         raise ValueError("No comment with ID '{}' found.".format(id))
 
     def resolve_all_comments(self, info, **kwargs):
-        return CommentModel.objects.select_related('post').all()
+        return prerender_if_requested(info, plan_query(info, CommentModel.objects.all()))
 
     def resolve_comments_total(self, info, **kwargs):
         args = dict(kwargs.get('terms'))
@@ -763,19 +964,40 @@ class Query(object):
             return 0
 
     def resolve_comments_list(self, info, **kwargs):
-        args = dict(kwargs.get('terms'))
+        terms = kwargs.get('terms')
+        args = dict(terms)
         if "user_id" in args:
             user = User.objects.get(id=int(args["user_id"]))
-            return CommentModel.objects.filter(user=user)
+            comments = CommentModel.objects.filter(user=user)
         elif "post_id" in args:
             try:
                 document = PostModel.objects.get(id=args["post_id"])
-                return document.comments.all()
             except:
                 return graphene.List(Comment, resolver=lambda x,y: [])
+            comments = document.comments.all()
         else:
-            return CommentModel.objects.all().order_by('-posted_at')
-
+            # Don't let an unbounded sitewide listing pull the whole table
+            comments = paginate(plan_query(info, CommentModel.objects.all()),
+                                "posted_at", terms,
+                                default_limit=getattr(
+                                    settings, "COMMENTS_LIST_DEFAULT_LIMIT", 50))
+            return prerender_if_requested(info, comments)
+        comments = paginate(plan_query(info, comments), "posted_at", terms)
+        return prerender_if_requested(info, comments)
+
+    def resolve_comments_tree(self, info, post_id, comment_id=None, max_depth=None,
+                              after=None, limit=None):
+        comments = CommentModel.objects.filter(post_id=post_id)
+        try:
+            comments = thread(plan_query(info, comments),
+                              root_id=comment_id,
+                              max_depth=max_depth,
+                              after_id=after,
+                              limit=thread_limit(limit))
+        except CommentModel.DoesNotExist:
+            raise ValueError("Comment '{}' is not on post '{}'.".format(
+                after or comment_id, post_id))
+        return prerender_if_requested(info, comments)
             
     def resolve_vote(self, info, **kwargs):
         id = kwargs.get('id')
@@ -793,27 +1015,44 @@ class Query(object):
             )
         if args.view == "userNotifications":
             user = User.objects.get(id=args.user_id)
-            #TODO: Implement offset
-            if args.limit:
-                return Notification.objects.filter(user=user)[:args.limit]
-            else:
-                return Notification.objects.filter(user=user)
+            return paginate(Notification.objects.filter(user=user),
+                            "created_at", args)
 
     def resolve_conversations_single(self, info, **kwargs):
         document_id = kwargs["document_id"]
         if document_id:
-            return Conversation.objects.get(id=int(document_id))
+            participant = get_participant(info.context.user, document_id)
+            conversation = participant.conversation
+            conversation.viewer = participant
+            return conversation
         else:
             raise ValueError("Expected document id, instead got '{}'".format(
                 repr(document_id)
                 )
             )
 
+    def resolve_conversations_list(self, info, **kwargs):
+        terms = kwargs.get("terms", {})
+        if not info.context.user.is_authenticated:
+            raise ValueError("Need to be logged in to read private messages!")
+        conversations = []
+        for participant in inbox(info.context.user,
+                                 after=terms.get("after"),
+                                 before=terms.get("before"),
+                                 limit=terms.get("limit") or getattr(
+                                     settings, "CONVERSATIONS_LIST_DEFAULT_LIMIT", 50)):
+            participant.conversation.viewer = participant
+            conversations.append(participant.conversation)
+        return conversations
+
     def resolve_messages_list(self, info, **kwargs):
-        #if not info.context.user.is_authenticated:
-        #    raise ValueError("Need to be logged in to read private messages!")
-        convo_id = kwargs["terms"].conversation_id
-        return Conversation.objects.get(id=int(convo_id)).messages.all()
+        terms = kwargs["terms"]
+        participant = get_participant(info.context.user, terms.conversation_id)
+        return conversation_messages(
+            participant,
+            after=terms.after,
+            before=terms.before,
+            limit=terms.limit or getattr(settings, "MESSAGES_LIST_DEFAULT_LIMIT", 50))
     
 
 class Mutations(object):
@@ -826,4 +1065,5 @@ class Mutations(object):
     comments_edit = CommentsEdit.Field(name="CommentsEdit")
     conversations_new = ConversationsNew.Field(name="ConversationsNew")
     messages_new = MessagesNew.Field(name="MessagesNew")
+    messages_broadcast = MessagesBroadcast.Field(name="MessagesBroadcast")
 
@@ -1,6 +1,12 @@
+import base64
+import html
 import json
 import re
+from django.conf import settings
+from django.db import connection
 from django.db.models import Q 
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
 
 """Search Syntax Quick Guide
 
@@ -79,3 +85,241 @@ def mk_operation(op):
     else:
         operation["Q"] = Q(body__icontains=op)
     return operation
+
+
+def search_terms(parsed_operations):
+    """Restate the parsed operations as the search backends consume them.
+
+    Returns (groups, exclusions). Every group must match, and a group matches
+    if any one of its terms does, so AND operations are groups of one term and OR
+    operations are groups of two. A document matching any exclusion is dropped.
+    Terms are (text, exact) pairs, exact being True for double quoted terms."""
+    def term(op):
+        if len(op) > 1 and op[0] == op[-1] == "\"":
+            return (op[1:-1], True)
+        return (op, False)
+    groups = []
+    exclusions = []
+    for and_op in parsed_operations["and_ops"]:
+        if and_op[0] == "-":
+            if and_op[1:]:
+                exclusions.append(term(and_op[1:]))
+        else:
+            groups.append([term(and_op)])
+    for or_op in parsed_operations["or_ops"]:
+        groups.append([term(op.lstrip("-")) for op in or_op if op.lstrip("-")])
+    return groups, exclusions
+
+def ranked(queryset, ids):
+    """Return the documents in queryset with the given ids, in the order given."""
+    documents = queryset.in_bulk(ids)
+    return [documents[id] for id in ids if id in documents]
+
+def page(queryset, offset=0, limit=None):
+    if limit is None:
+        return queryset[offset:]
+    return queryset[offset:offset + limit]
+
+class LikeBackend(object):
+    """Substring matching with LIKE filters. Needs no index, but every search is
+    a full table scan and results aren't ranked. Used when the database has no
+    full text search we support."""
+    def index(self, kind, document_id, body):
+        pass
+
+    def remove(self, kind, document_id):
+        pass
+
+    def search(self, queryset, kind, parsed_operations, offset=0, limit=None):
+        for _filter in mk_search_filters(parsed_operations):
+            if _filter["exclude"]:
+                queryset = queryset.exclude(_filter["Q"])
+            else:
+                queryset = queryset.filter(_filter["Q"])
+        return page(queryset, offset, limit)
+
+class FullTextBackend(object):
+    """Shared logic for backends that keep document bodies in the lw2_search 
+    table created by migration 0030. Subclasses give the SQL to match groups of
+    terms and to order matches by relevance."""
+    def search(self, queryset, kind, parsed_operations, offset=0, limit=None):
+        """Return the documents of queryset matching the parsed search, skipping
+        the first offset of them and returning at most limit. With any terms to
+        match this is a list ordered by relevance, otherwise (only exclusions) 
+        it's the filtered queryset in its usual order.
+
+        Paging happens in the index query, so only the documents on the page are
+        fetched from their table."""
+        groups, exclusions = search_terms(parsed_operations)
+        excluded_sql = ""
+        excluded_params = []
+        if exclusions:
+            match_sql, match_params = self.match_sql([exclusions])
+            excluded_sql = ("SELECT document_id FROM lw2_search "
+                            "WHERE kind = %s AND " + match_sql)
+            excluded_params = [kind] + match_params
+        if not groups:
+            if exclusions:
+                queryset = queryset.exclude(id__in=RawSQL(excluded_sql,
+                                                          excluded_params))
+            return page(queryset, offset, limit)
+        match_sql, match_params = self.match_sql(groups)
+        rank_sql, rank_params = self.rank_sql(groups)
+        sql = "SELECT document_id FROM lw2_search WHERE kind = %s AND " + match_sql
+        params = [kind] + match_params
+        if exclusions:
+            sql += " AND document_id NOT IN (" + excluded_sql + ")"
+            params += excluded_params
+        sql += " ORDER BY " + rank_sql
+        params += rank_params
+        if limit is not None:
+            sql += " LIMIT %s OFFSET %s"
+            params += [limit, offset]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            ids = [row[0] for row in cursor.fetchall()]
+        return ranked(queryset, ids)
+
+class SQLiteFTSBackend(FullTextBackend):
+    """SQLite FTS5 full text search, ranked by bm25."""
+    def index(self, kind, document_id, body):
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM lw2_search WHERE kind = %s AND document_id = %s",
+                           [kind, document_id])
+            cursor.execute("INSERT INTO lw2_search (document_id, kind, body) VALUES (%s, %s, %s)",
+                           [document_id, kind, body])
+
+    def remove(self, kind, document_id):
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM lw2_search WHERE kind = %s AND document_id = %s",
+                           [kind, document_id])
+
+    def fts_query(self, groups):
+        def fts_term(term):
+            text, exact = term
+            # Quoting every term stops FTS5 reading punctuation in it as syntax
+            quoted = '"' + text.replace('"', '""') + '"'
+            # Inexact terms match as prefixes, the closest FTS5 has to substrings
+            return quoted if exact else quoted + "*"
+        return " AND ".join("(" + " OR ".join(fts_term(term) for term in group) + ")"
+                            for group in groups)
+
+    def match_sql(self, groups):
+        return "lw2_search MATCH %s", [self.fts_query(groups)]
+
+    def rank_sql(self, groups):
+        # FTS5's rank column is the bm25 score of the MATCH in the same query
+        return "rank", []
+
+class PostgresBackend(FullTextBackend):
+    """PostgreSQL tsvector full text search over a GIN index, ranked by 
+    ts_rank."""
+    def index(self, kind, document_id, body):
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO lw2_search (document_id, kind, body) "
+                           "VALUES (%s, %s, to_tsvector('english', %s)) "
+                           "ON CONFLICT (kind, document_id) DO UPDATE SET body = EXCLUDED.body",
+                           [document_id, kind, body])
+
+    def remove(self, kind, document_id):
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM lw2_search WHERE kind = %s AND document_id = %s",
+                           [kind, document_id])
+
+    def tsquery_sql(self, groups):
+        sql = []
+        params = []
+        for group in groups:
+            group_sql = []
+            for text, exact in group:
+                if exact:
+                    group_sql.append("phraseto_tsquery('english', %s)")
+                else:
+                    group_sql.append("plainto_tsquery('english', %s)")
+                params.append(text)
+            sql.append("(" + " || ".join(group_sql) + ")")
+        return " && ".join(sql), params
+
+    def match_sql(self, groups):
+        query_sql, params = self.tsquery_sql(groups)
+        return "body @@ (" + query_sql + ")", params
+
+    def rank_sql(self, groups):
+        query_sql, params = self.tsquery_sql(groups)
+        return "ts_rank(body, " + query_sql + ") DESC", params
+
+_search_table = {}
+
+def has_search_table():
+    """Whether migration 0030 created the lw2_search table, it doesn't on SQLite 
+    builds without FTS5."""
+    if connection.alias not in _search_table:
+        _search_table[connection.alias] = (
+            "lw2_search" in connection.introspection.table_names())
+    return _search_table[connection.alias]
+
+def get_backend():
+    """Return the search backend named by the SEARCH_BACKEND setting, or the best
+    one the database supports if it isn't set."""
+    backend_path = getattr(settings, "SEARCH_BACKEND", None)
+    if backend_path:
+        return import_string(backend_path)()
+    if connection.vendor == "postgresql" and has_search_table():
+        return PostgresBackend()
+    if connection.vendor == "sqlite" and has_search_table():
+        return SQLiteFTSBackend()
+    return LikeBackend()
+
+def index_document(kind, document_id, body):
+    """Add or update a document in the search index."""
+    get_backend().index(kind, document_id, body)
+
+def remove_document(kind, document_id):
+    get_backend().remove(kind, document_id)
+
+def search(queryset, kind, search_string, offset=0, limit=None):
+    """Search the documents of the given kind ('post' or 'comment') in queryset
+    with a search string using the syntax above, optionally a page at a time."""
+    return get_backend().search(queryset, kind, parse_search_string(search_string),
+                                offset=offset, limit=limit)
+
+def make_page_cursor(offset):
+    """Make the opaque cursor for the page of search results starting at offset.
+    Ranked results have no stable key to page on, so this is a position."""
+    return base64.urlsafe_b64encode(str(offset).encode()).decode()
+
+def parse_page_cursor(cursor):
+    if not cursor:
+        return 0
+    try:
+        offset = int(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("'{}' is not a valid cursor.".format(cursor))
+    if offset < 0:
+        raise ValueError("'{}' is not a valid cursor.".format(cursor))
+    return offset
+
+def highlight(body, search_string, words=30):
+    """Make a short plain text snippet of body around the first place it matches
+    one of the terms of search_string, with matches wrapped in <b> tags. Falls 
+    back to the start of the body if no term appears in it verbatim."""
+    groups, exclusions = search_terms(parse_search_string(search_string))
+    texts = [text for group in groups for text, exact in group if text]
+    tokens = body.split()
+    if not texts:
+        return html.escape(" ".join(tokens[:words]))
+    term_re = re.compile("|".join(re.escape(text) for text in texts), re.IGNORECASE)
+    start = 0
+    for position, token in enumerate(tokens):
+        if term_re.search(token):
+            start = max(0, position - words // 3)
+            break
+    snippet = html.escape(" ".join(tokens[start:start + words]))
+    term_re = re.compile("|".join(re.escape(html.escape(text)) for text in texts),
+                         re.IGNORECASE)
+    snippet = term_re.sub(lambda match: "<b>" + match.group(0) + "</b>", snippet)
+    if start > 0:
+        snippet = "... " + snippet
+    if start + words < len(tokens):
+        snippet += " ..."
+    return snippet
@@ -1,21 +1,21 @@
 from django.contrib.auth.models import User
+from django.db import models, transaction
 from lw2.models import *
+from lw2.counters import create_comment
+from lw2.votes import cast_vote
+from lw2.notifications import emit
+from lw2.ids import new_id
+import lw2.search as wl_search
 from rest_framework import serializers
 import datetime
-import hashlib
-import base64
 import random
 
-def make_id(username, utc_timestamp):
-    hashable = username + str(utc_timestamp)
-    hash_raw = hashlib.md5(hashable.encode())
-    hash_b64 = base64.b64encode(hash_raw.digest()).decode()
-    return hash_b64[:17].replace("/","_").replace("+","-")
-
-def make_id_from_user(username):
-    """Wrapper around make_id that eliminates finnicky time handling code."""
-    return make_id(username,
-                   datetime.datetime.today().replace(tzinfo=datetime.timezone.utc).timestamp())
+class PrerenderedListSerializer(serializers.ListSerializer):
+    """List serializer that renders the markdown bodies of every item in one 
+    batch before serializing them, rather than one at a time per htmlBody."""
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.Manager) else data
+        return super().to_representation(prerender_html(iterable))
 
 class UserSerializer(serializers.HyperlinkedModelSerializer):
     code = serializers.CharField(write_only=True)
@@ -37,24 +37,25 @@ class UserSerializer(serializers.HyperlinkedModelSerializer):
             raise ValueError("This invite has expired.")
         if invite.used_by:
             raise ValueError("This invite has been used.")
-        #TODO: Filter out characters which aren't ascii, or something
-        #TODO: Force users not to use stupid weak passwords
-        new_user = User.objects.create_user(validated_data.pop('username'),
-                                            password=validated_data.pop('password'),
-                                            email=validated_data.pop('email'))
+        with transaction.atomic():
+            #TODO: Filter out characters which aren't ascii, or something
+            #TODO: Force users not to use stupid weak passwords
+            new_user = User.objects.create_user(validated_data.pop('username'),
+                                                password=validated_data.pop('password'),
+                                                email=validated_data.pop('email'))
 
-        invite.used_date = datetime.datetime.now()
-        invite.used_by = new_user
-        invite.save()
+            invite.used_date = datetime.datetime.now()
+            invite.used_by = new_user
+            invite.save()
 
-        invite_tree_node = InviteTreeNode()
-        invite_tree_node.parent = invite.creator
-        invite_tree_node.child = new_user
-        invite_tree_node.save()
+            invite_tree_node = InviteTreeNode()
+            invite_tree_node.parent = invite.creator
+            invite_tree_node.child = new_user
+            invite_tree_node.save()
 
-        user_profile = Profile()
-        user_profile.user = new_user
-        user_profile.save()
+            user_profile = Profile()
+            user_profile.user = new_user
+            user_profile.save()
         
         return new_user
 
@@ -77,6 +78,7 @@ class PostSerializer(serializers.ModelSerializer):
     draft = serializers.BooleanField(default=False, read_only=True)
     class Meta:
         model = Post
+        list_serializer_class = PrerenderedListSerializer
         fields = ('_id', 'userId', 'postedAt', 'title',
                   'url', 'slug', 'body', 'baseScore',
                   'voteCount', 'commentCount', 'viewCount', 'meta',
@@ -99,12 +101,14 @@ class PostSerializer(serializers.ModelSerializer):
             url = None
         title = validated_data.pop("title")
         slug = title.strip().lower().replace(" ", "-")[:60]
-        new_post = Post(id=make_id_from_user(user.username),
+        new_post = Post(id=new_id(),
                         user=user,
                         title=title,
                         url=url,
                         slug=slug,
-                        body=validated_data.pop("body"))
+                        body=validated_data.pop("body"),
+                        # Published at once, as with PostsNew
+                        draft=False)
         new_post.full_clean()
         new_post.save()
         return new_post
@@ -120,30 +124,60 @@ class CommentSerializer(serializers.ModelSerializer):
     retracted = serializers.BooleanField(default=False)
     answer = serializers.BooleanField(default=False, read_only=True)
     htmlBody = serializers.CharField(source="html_body", read_only=True)
-    isDeleted = serializers.BooleanField(default=False, source="is_deleted")
+    # Deleting goes through destroy so the post's comment count follows
+    isDeleted = serializers.BooleanField(default=False, source="is_deleted",
+                                         read_only=True)
+    depth = serializers.IntegerField(read_only=True)
     class Meta:
         model = Comment
+        list_serializer_class = PrerenderedListSerializer
         fields = ('_id', 'userId', 'postId', 'parentCommentId',
                   'postedAt', 'baseScore', 'body', 'retracted',
-                  'answer', 'htmlBody', 'isDeleted')
+                  'answer', 'htmlBody', 'isDeleted', 'depth')
 
     def create(self, validated_data):
         print(validated_data)
         user = self.context["request"].user
         post = Post.objects.get(id=validated_data["post"]["id"])
-        if "parentCommentId" in validated_data:
+        if validated_data.get("parent_comment", {}).get("id"):
             parent = Comment.objects.get(id=validated_data["parent_comment"]["id"])
         else:
             parent = None
         new_comment = Comment(
-            id=make_id_from_user(user.username),
+            id=new_id(),
             user=user,
             post=post,
             parent_comment=parent,
             body=validated_data["body"])
-        new_comment.save()
+        with transaction.atomic():
+            create_comment(new_comment)
+            emit("comment", new_comment.id)
         return new_comment
     
+class SearchResultSerializer(serializers.ModelSerializer):
+    """Compact search result without a rendered body, with a snippet of the body
+    around the match instead. Expects the search string as 'query' in the
+    serializer context."""
+    _id = serializers.CharField(source="id", read_only=True)
+    userId = serializers.CharField(source="user.id", read_only=True)
+    author = serializers.CharField(source="user.username", read_only=True)
+    baseScore = serializers.IntegerField(source="base_score", read_only=True)
+    snippet = serializers.SerializerMethodField()
+
+    def get_snippet(self, document):
+        return wl_search.highlight(document.body, self.context["query"])
+
+class PostSearchResultSerializer(SearchResultSerializer):
+    class Meta:
+        model = Post
+        fields = ('_id', 'title', 'userId', 'author', 'baseScore', 'snippet')
+
+class CommentSearchResultSerializer(SearchResultSerializer):
+    postId = serializers.CharField(source="post_id", read_only=True)
+    class Meta:
+        model = Comment
+        fields = ('_id', 'postId', 'userId', 'author', 'baseScore', 'snippet')
+    
 class TagSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         model = Tag
@@ -195,56 +229,19 @@ class VoteSerializer(serializers.HyperlinkedModelSerializer):
         vote_type = validated_data.pop("vote_type")
         collection_name = validated_data.pop("collection_name")
         if collection_name.lower() == "comments":
-            if Vote.objects.filter(document_id=document_id):
-                return HttpResponse("User already voted on this",
-                                    status_code=409)
-            comment = Comment.objects.get(id=document_id)
-            #TODO: Enforce valid vote types
-            vote = Vote(user=self.context["request"].user,
-                        document_id=document_id,
-                        voted_at=datetime.datetime.today(),
-                        vote_type=vote_type)
-            if "Upvote" in vote_type:
-                comment.base_score += 1
-            elif "Downvote" in vote_type:
-                comment.base_score -= 1
-            else:
-                return HttpResponse(
-                    "'{}' does not appear to be upvote or downvote".format(
-                        vote_type),
-                    status_code=400
-                )
-            vote.save()
-            comment.save()
-            return vote
+            document_model = Comment
         elif collection_name.lower() == "posts":
-            if Vote.objects.filter(document_id=document_id):
-                return HttpResponse("User already voted on this",
-                                    status_code=409)
-            post = Post.objects.get(id=document_id)
-            #TODO: Enforce valid vote types
-            vote = Vote(user=self.context["request"].user,
-                        document_id=document_id,
-                        voted_at=datetime.datetime.today(),
-                        vote_type=vote_type)
-            if "Upvote" in vote_type:
-                post.base_score += 1
-            elif "Downvote" in vote_type:
-                post.base_score -= 1
-            else:
-                return HttpResponse(
-                    "'{}' does not appear to be upvote or downvote".format(
-                        vote_type),
-                    status_code=400
-                )
-            vote.save()
-            post.save()
-            return vote
+            document_model = Post
         else:
-            return HttpResponse(
-                "Collection '{}' is not handled by accordius!".format(
-                    collection_name),
-                status_code=400)
+            raise serializers.ValidationError(
+                "Collection '{}' is not handled by accordius!".format(collection_name))
+        document_model.objects.get(id=document_id)
+        #TODO: Enforce valid vote types
+        try:
+            return cast_vote(self.context["request"].user, document_model,
+                             document_id, vote_type)
+        except ValueError as error:
+            raise serializers.ValidationError(str(error))
         
 class BanSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
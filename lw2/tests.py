@@ -1,9 +1,38 @@
-from django.test import TestCase
-from django.test import Client
+from django.test import TestCase, TransactionTestCase
+from django.test import Client, RequestFactory
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from django.contrib.auth import logout
 from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.utils import timezone
 from lw2.models import *
+from django.core.management import call_command
+import lw2.search as wl_search
+import lw2.thread_cache as wl_thread_cache
+import lw2.auth_header as auth_header
+from lw2.counters import apply_vote, create_comment, delete_comment
+from lw2.threads import thread
+from lw2.votes import cast_vote, flush_votes
+from lw2.view_counts import ViewBuffer, view_buffer
+from lw2.feeds import feed
+from lw2.notifications import check_notifications, deliver_notifications, emit
+from lw2.pubsub import LocalBroker, CacheBroker
+from lw2.conversations import send_message
+import lw2.lineage as lineage
+import lw2.annotations as annotations
+from lw2.ids import IdGenerator, new_id
+import lw2.pubsub as pubsub
+from lw2.markdown import render_cache_key, render, render_batch, get_renderer
+from lw2.markdown import add_current_renders
 from datetime import datetime, timedelta
+import io
 import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
 import pdb
 
 c = Client()
@@ -98,6 +127,159 @@ class PostTestCase(TestCase):
         self.assertEquals(len(tags), 3)
         self.assertEquals(set(["my","tag","set"]), set([tag["text"] for tag in tags]))
 
+class RenderCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('testuser', 'jd@jdpressman.com', 'testpassword')
+        self.post1 = Post.objects.create(id='ccccccccccccccccc', user=self.user,
+                                         title='My Fruit Post',
+                                         url=None, slug="test-slug-1",
+                                         base_score=5,
+                                         body="My Apple Orange Mango")
+
+    def test_html_body_served_from_cache(self):
+        """Test that a rendered body is read back from the cache rather than 
+        being converted again."""
+        cache.set(render_cache_key(self.post1.id, self.post1.body),
+                  "<p>From the cache</p>")
+        self.assertEqual(self.post1.html_body, "<p>From the cache</p>")
+
+    def test_html_body_changes_with_body(self):
+        """Test that editing a post's body doesn't serve the old rendering."""
+        self.post1.body = "My Dog Cat Panda"
+        self.post1.save()
+        self.assertEqual(Post.objects.get(id=self.post1.id).html_body,
+                         "<p>My Dog Cat Panda</p>")
+
+    def test_render_batch_serial(self):
+        """Test that batch rendering serves cache hits and renders misses."""
+        cache.set(render_cache_key("ddddddddddddddddd", "My Dog Cat Panda"),
+                  "<p>From the cache</p>")
+        rendered = render_batch([("ddddddddddddddddd", "My Dog Cat Panda"),
+                                 ("eeeeeeeeeeeeeeeee", "My *Apple*")])
+        self.assertEqual(rendered["ddddddddddddddddd"], "<p>From the cache</p>")
+        self.assertEqual(rendered["eeeeeeeeeeeeeeeee"], "<p>My <em>Apple</em></p>")
+
+    @override_settings(MARKDOWN_RENDER_PROCESSES=2, MARKDOWN_RENDER_POOL_THRESHOLD=1)
+    def test_render_batch_pool(self):
+        """Test that batch rendering through the process pool gives the same 
+        output as rendering serially."""
+        documents = [("pool{}".format(i), "Pool *body* {}".format(i))
+                     for i in range(20)]
+        rendered = render_batch(documents)
+        for document_id, text in documents:
+            self.assertEqual(rendered[document_id], render(text))
+
+    def test_posts_list_prerendered(self):
+        """Test that PostsList serves htmlBody for a batch rendered list."""
+        response = c.post("/graphql/", {"query":"""
+        { PostsList(terms: {limit: 10}) { _id htmlBody } }"""})
+        posts = json.loads(response.content.decode("UTF-8"))["data"]["PostsList"]
+        self.assertEqual(posts[0]["htmlBody"], "<p>My Apple Orange Mango</p>")
+        
+    def test_stale_render_not_recorded(self):
+        """Test that a reader recording the rendering of a body it loaded before
+        an edit doesn't replace the rendering recorded by the edit."""
+        self.post1.body = "My Dog Cat Panda"
+        self.post1.save()
+        add_current_renders({self.post1.id:"<p>My Apple Orange Mango</p>"})
+        post = prerender_html(Post.objects.filter(id=self.post1.id).defer("body"))[0]
+        self.assertEqual(post.html_body, "<p>My Dog Cat Panda</p>")
+        
+class RendererTestCase(TestCase):
+    def test_renderer_per_thread(self):
+        """Test that each thread renders with its own markdown instance."""
+        renderers = []
+        thread = threading.Thread(target=lambda: renderers.append(get_renderer()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(renderers[0], get_renderer())
+
+    def test_render_resets_state(self):
+        """Test that document metadata doesn't leak into the next render."""
+        render("Title: Secret\n\nMy Apple Orange Mango")
+        self.assertEqual(render("My Dog Cat Panda"), "<p>My Dog Cat Panda</p>")
+        self.assertEqual(get_renderer().Meta, {})
+        
+class DataLoaderTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('testuser', 'jd@jdpressman.com', 'testpassword')
+        Profile.objects.create(user=self.user, display_name="Test User")
+        self.post1 = Post.objects.create(id='aaaaaaaaaaaaaaaaa', user=self.user,
+                                         title='My Fruit Post',
+                                         url=None, slug="test-slug-1",
+                                         base_score=5,
+                                         body="My Apple Orange Mango")
+
+    def comments_list(self):
+        response = Client().post("/graphql/", {"query":"""
+        { CommentsList(terms: {postId: "aaaaaaaaaaaaaaaaa"}) {
+        _id userId voteCount user { displayName karma } } }"""})
+        return json.loads(response.content.decode("UTF-8"))["data"]["CommentsList"]
+
+    def test_comments_list_query_count(self):
+        """Test that the number of queries made by CommentsList doesn't grow
+        with the number of comments."""
+        for i in range(5):
+            comment = Comment.objects.create(id="comment{}".format(i),
+                                             user=self.user,
+                                             post=self.post1,
+                                             body="My Test Comment")
+            Vote.objects.create(user=self.user, document_id=comment.id)
+        # Post lookup, comments joined with authors and profiles, vote counts
+        with self.assertNumQueries(3):
+            comments = self.comments_list()
+        self.assertEqual(len(comments), 5)
+        self.assertEqual(comments[0]["voteCount"], 1)
+        self.assertEqual(comments[0]["userId"], str(self.user.id))
+        self.assertEqual(comments[0]["user"]["displayName"], "Test User")
+
+    def test_body_deferred_html_from_cache(self):
+        """Test that htmlBody is served without loading bodies when the 
+        renderings are cached, and is still correct when they aren't."""
+        Comment.objects.create(id="comment0", user=self.user,
+                               post=self.post1, body="My *Test* Comment")
+        query = """{ CommentsList(terms: {postId: "aaaaaaaaaaaaaaaaa"}) { _id htmlBody } }"""
+        # Post lookup, comments without bodies
+        with self.assertNumQueries(2):
+            response = Client().post("/graphql/", {"query":query})
+        comments = json.loads(response.content.decode("UTF-8"))["data"]["CommentsList"]
+        self.assertEqual(comments[0]["htmlBody"], "<p>My <em>Test</em> Comment</p>")
+        cache.clear()
+        response = Client().post("/graphql/", {"query":query})
+        comments = json.loads(response.content.decode("UTF-8"))["data"]["CommentsList"]
+        self.assertEqual(comments[0]["htmlBody"], "<p>My <em>Test</em> Comment</p>")
+
+class PaginationTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('testuser', 'jd@jdpressman.com', 'testpassword')
+        for i in range(5):
+            Post.objects.create(id="post{}".format(i), user=self.user,
+                                title="Post {}".format(i),
+                                posted_at=datetime(2019, 1, 1 + i),
+                                slug="post-{}".format(i),
+                                body="My Apple Orange Mango")
+
+    def posts_list(self, terms):
+        response = Client().post("/graphql/", {"query":"""
+        query PostsList($terms: PostsTerms) {
+        PostsList(terms: $terms) { _id cursor } }""",
+                                               "variables":json.dumps({"terms":terms})})
+        return json.loads(response.content.decode("UTF-8"))["data"]["PostsList"]
+
+    def test_posts_list_after(self):
+        """Test that paging after a cursor continues where the last page ended."""
+        page1 = self.posts_list({"limit":2})
+        self.assertEqual([post["_id"] for post in page1], ["post4", "post3"])
+        page2 = self.posts_list({"limit":2, "after":page1[-1]["cursor"]})
+        self.assertEqual([post["_id"] for post in page2], ["post2", "post1"])
+
+    def test_posts_list_before(self):
+        """Test that paging before a cursor returns the page nearest to it."""
+        posts = self.posts_list({})
+        page = self.posts_list({"limit":2, "before":posts[3]["cursor"]})
+        self.assertEqual([post["_id"] for post in page], ["post3", "post2"])
+
 class CommentTestCase(TestCase):
     def setUp(self):
         self.user = User.objects.create_user('testuser', 'jd@jdpressman.com', 'testpassword')
@@ -201,6 +383,59 @@ class SearchTestCase(TestCase):
         self.assertEquals(len(search_data), 1)
         self.assertEquals(search_data[0]["title"], "My Animal Post")
 
+    def test_search_uses_full_text_index(self):
+        self.assertIsInstance(wl_search.get_backend(), wl_search.SQLiteFTSBackend)
+
+    def test_post_search_ranked(self):
+        """Test that results are ordered by relevance."""
+        Post.objects.create(id='ccccccccccccccccc', user=User.objects.get(),
+                            title='My Panda Post',
+                            url=None, slug="test-slug-3",
+                            body="Panda Panda Panda")
+        search = c.get('/api/post_search/?query=Panda')
+        search_data = json.loads(search.content.decode("UTF-8"))
+        self.assertEquals([post["title"] for post in search_data],
+                          ["My Panda Post", "My Animal Post"])
+
+    def test_post_search_follows_edits(self):
+        """Test that the index is updated when a post is edited or deleted."""
+        post = Post.objects.get(id='aaaaaaaaaaaaaaaaa')
+        post.body = "My Kiwi"
+        post.save()
+        search = c.get('/api/post_search/?query=Apple')
+        self.assertEquals(json.loads(search.content.decode("UTF-8")), [])
+        search = c.get('/api/post_search/?query=Kiwi')
+        self.assertEquals(len(json.loads(search.content.decode("UTF-8"))), 1)
+        post.delete()
+        search = c.get('/api/post_search/?query=Kiwi')
+        self.assertEquals(json.loads(search.content.decode("UTF-8")), [])
+
+    def test_post_search_pages(self):
+        """Test that search results can be paged through with limit and cursor."""
+        search = c.get('/api/post_search/?query=My&limit=1')
+        page1 = json.loads(search.content.decode("UTF-8"))
+        self.assertEquals(len(page1), 1)
+        search = c.get('/api/post_search/?query=My&limit=1&cursor=' +
+                       search["X-Next-Cursor"])
+        page2 = json.loads(search.content.decode("UTF-8"))
+        self.assertEquals(len(page2), 1)
+        self.assertNotEqual(page1[0]["_id"], page2[0]["_id"])
+        self.assertFalse(search.has_header("X-Next-Cursor"))
+
+    def test_post_search_compact(self):
+        """Test that compact results have a highlighted snippet and no body."""
+        search = c.get('/api/post_search/?query=Apple&compact=true')
+        search_data = json.loads(search.content.decode("UTF-8"))
+        self.assertEquals(search_data[0]["author"], "testuser")
+        self.assertEquals(search_data[0]["snippet"], "My <b>Apple</b> Orange Mango")
+        self.assertFalse("htmlBody" in search_data[0])
+
+    @override_settings(SEARCH_BACKEND="lw2.search.LikeBackend")
+    def test_post_search_like_backend(self):
+        search = c.get('/api/post_search/?query=Apple+OR+Panda')
+        search_data = json.loads(search.content.decode("UTF-8"))
+        self.assertEquals(len(search_data), 2)
+
 class InviteTestCase(TestCase):
     """Test the user invite and signup API's."""
     def setUp(self):
@@ -324,6 +559,67 @@ class TagTestCase(TestCase):
         to have on this case."""
         pass
 
+class CounterTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('testuser', 'jd@jdpressman.com', 'testpassword')
+        self.post1 = Post.objects.create(id='aaaaaaaaaaaaaaaaa', user=self.user,
+                                         title='My Fruit Post',
+                                         url=None, slug="test-slug-1",
+                                         base_score=5,
+                                         body="My Apple Orange Mango")
+
+    def test_comment_count_maintained(self):
+        """Test that creating and deleting comments keeps comment_count right."""
+        comment = Comment(id="comment0", user=self.user, post=self.post1,
+                          body="My Test Comment")
+        create_comment(comment)
+        self.post1.refresh_from_db()
+        self.assertEqual(self.post1.comment_count, 1)
+        delete_comment(comment)
+        delete_comment(comment)
+        self.post1.refresh_from_db()
+        self.assertEqual(self.post1.comment_count, 0)
+
+    def test_comment_delete_by_update_refused(self):
+        """Test that a comment can't be deleted by setting isDeleted, which would
+        skip the comment_count decrement, only through DELETE."""
+        comment = Comment(id="comment0", user=self.user, post=self.post1,
+                          body="My Test Comment")
+        create_comment(comment)
+        client = Client()
+        client.login(username="testuser", password="testpassword")
+        response = client.patch("/api/comments/comment0/",
+                                json.dumps({"isDeleted":True}),
+                                content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        comment.refresh_from_db()
+        self.assertFalse(comment.is_deleted)
+        client.delete("/api/comments/comment0/")
+        comment.refresh_from_db()
+        self.post1.refresh_from_db()
+        self.assertTrue(comment.is_deleted)
+        self.assertEqual(self.post1.comment_count, 0)
+
+    def test_vote_counters_maintained(self):
+        """Test that a vote updates a post's score and vote count in place."""
+        apply_vote(Vote(user=self.user, document_id=self.post1.id,
+                        vote_type="smallUpvote"), Post, 1)
+        self.post1.refresh_from_db()
+        self.assertEqual(self.post1.base_score, 6)
+        self.assertEqual(self.post1.vote_count, 1)
+
+    def test_recount_counters(self):
+        """Test that the recount_counters command repairs drifted counters."""
+        Comment.objects.create(id="comment0", user=self.user, post=self.post1,
+                               body="My Test Comment")
+        Vote.objects.create(user=self.user, document_id=self.post1.id,
+                            vote_type="smallDownvote")
+        call_command("recount_counters", stdout=io.StringIO())
+        self.post1.refresh_from_db()
+        self.assertEqual(self.post1.comment_count, 1)
+        self.assertEqual(self.post1.vote_count, 1)
+        self.assertEqual(self.post1.base_score, 0)
+        
 #TODO: Add unit tests for changing votes
 class VoteTestCase(TestCase):
     def setUp(self):
@@ -394,3 +690,844 @@ class VoteTestCase(TestCase):
         response1 = c.get("/api/votes/")
         post1_updated = Post.objects.all()[0]
         self.assertEqual(post1_updated.base_score,4)
+
+class SessionCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        auth_header.session_users.entries.clear()
+        self.user = User.objects.create_user('testuser', 'jd@jdpressman.com', 'testpassword')
+        client = Client()
+        response = client.post("/graphql/", {"query":"""
+        mutation Login($user: String, $password: String) {
+        Login(username: $user, password: $password) {
+        sessionKey
+        accessToken
+        }
+        } """,
+                                             "variables":"""{
+                                             "user":"testuser",
+                                             "password":"testpassword"
+                                             }"""})
+        login = json.loads(response.content.decode("UTF-8"))["data"]["Login"]
+        self.session_key = login["sessionKey"]
+        self.access_token = login["accessToken"]
+
+    def test_cached_session_takes_no_queries(self):
+        """Test that a session resolved once is served without touching the database."""
+        self.assertEqual(auth_header.get_session_user(self.session_key), self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(auth_header.get_session_user(self.session_key), self.user)
+        auth_header.session_users.entries.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(auth_header.get_session_user(self.session_key), self.user)
+
+    def test_password_change_revokes_session(self):
+        """Test that changing a password stops the cached session from resolving."""
+        auth_header.get_session_user(self.session_key)
+        self.user.set_password("newpassword")
+        self.user.save()
+        self.assertIsNone(auth_header.get_session_user(self.session_key))
+
+    def test_ban_revokes_session(self):
+        """Test that banning a user stops the cached session from resolving."""
+        auth_header.get_session_user(self.session_key)
+        now = timezone.now()
+        Ban.objects.create(user=self.user, reason="Spam", ban_message="Spam",
+                           until=now + timedelta(days=1), appeal_on=now)
+        self.assertIsNone(auth_header.get_session_user(self.session_key))
+
+    def test_invalid_session_is_anonymous(self):
+        """Test that a request with an unknown session key carries on anonymously."""
+        self.assertIsNone(auth_header.get_session_user("notasessionkey"))
+        response = Client().get("/api/votes/", HTTP_AUTHORIZATION="notasessionkey")
+        self.assertEqual(response.status_code, 200)
+
+    def test_access_token_skips_sessions(self):
+        """Test that an access token resolves from the cache without any queries."""
+        self.assertEqual(auth_header.get_token_user(self.access_token), self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(auth_header.get_token_user(self.access_token), self.user)
+        self.assertIsNone(auth_header.get_token_user(self.access_token + "x"))
+
+    def test_access_token_revoked(self):
+        """Test that revoking a user's logins invalidates their access tokens."""
+        auth_header.revoke_user_sessions(self.user.id)
+        self.assertIsNone(auth_header.get_token_user(self.access_token))
+        token, expires = auth_header.make_access_token(self.user)
+        self.assertEqual(auth_header.get_token_user(token), self.user)
+
+    def test_stale_generation_replaced(self):
+        """Test that an old generation cached by a concurrent reader during a
+        revocation is replaced once the revocation commits."""
+        auth_header.revoke_user_sessions(self.user.id)
+        cache.set(auth_header.generation_key(self.user.id), 0)
+        self.assertEqual(auth_header.get_token_user(self.access_token), self.user)
+        # What the revocation runs on commit
+        auth_header.store_generation(self.user.id)
+        self.assertIsNone(auth_header.get_token_user(self.access_token))
+        auth_header.user_generation(self.user.id)
+        self.assertEqual(cache.get(auth_header.generation_key(self.user.id)), 1)
+
+    def test_header_logout_deletes_session(self):
+        """Test that logging out with a session key in the header deletes that
+        session."""
+        auth_header.get_session_user(self.session_key)
+        request = RequestFactory().get("/", HTTP_AUTHORIZATION=self.session_key)
+        request.session = Client().session
+        request.user = self.user
+        logout(request)
+        self.assertFalse(Session.objects.filter(session_key=self.session_key).exists())
+        self.assertIsNone(auth_header.get_session_user(self.session_key))
+
+    @override_settings(ACCESS_TOKEN_AGE=-1)
+    def test_access_token_expired(self):
+        """Test that an expired access token is turned away."""
+        token, expires = auth_header.make_access_token(self.user)
+        self.assertIsNone(auth_header.get_token_user(token))
+
+class ThreadTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('testuser', 'jd@jdpressman.com', 'testpassword')
+        self.post1 = Post.objects.create(id='aaaaaaaaaaaaaaaaa', user=self.user,
+                                         title='My Fruit Post',
+                                         url=None, slug="test-slug-1",
+                                         body="My Apple Orange Mango")
+        start = timezone.now()
+        def reply(id, minutes, parent=None):
+            return Comment.objects.create(id=id, user=self.user, post=self.post1,
+                                          parent_comment=parent, body=id,
+                                          posted_at=start + timedelta(minutes=minutes))
+        top = reply("top", 0)
+        child = reply("child", 1, top)
+        reply("grandchild", 3, child)
+        reply("second", 2)
+
+    def tree(self, **kwargs):
+        return [(comment.id, comment.depth) for comment in
+                thread(Comment.objects.filter(post=self.post1), **kwargs)]
+
+    def test_thread_order(self):
+        """Test that a thread comes back depth first with each comment's depth."""
+        self.assertEqual(self.tree(), [("top", 0), ("child", 1), ("grandchild", 2),
+                                       ("second", 0)])
+        self.assertEqual(self.tree(root_id="child"), [("child", 1), ("grandchild", 2)])
+        self.assertEqual(self.tree(max_depth=1), [("top", 0), ("child", 1), ("second", 0)])
+        self.assertEqual(self.tree(after_id="child", limit=1), [("grandchild", 2)])
+
+    def test_comments_tree_query(self):
+        """Test that the CommentsTree query returns a subtree in one query."""
+        with self.assertNumQueries(2):
+            response = Client().post("/graphql/", {"query":"""
+            {CommentsTree(postId:"aaaaaaaaaaaaaaaaa", commentId:"top", maxDepth:1) {
+            _id
+            depth
+            }}"""})
+        tree = json.loads(response.content.decode("UTF-8"))["data"]["CommentsTree"]
+        self.assertEqual(tree, [{"_id":"top", "depth":0}, {"_id":"child", "depth":1}])
+
+    def test_thread_action(self):
+        """Test that the REST thread action pages through a thread."""
+        response = Client().get("/api/posts/aaaaaaaaaaaaaaaaa/thread/",
+                                {"after":"top", "limit":2})
+        comments = json.loads(response.content.decode("UTF-8"))
+        self.assertEqual([(comment["_id"], comment["depth"]) for comment in comments],
+                         [("child", 1), ("grandchild", 2)])
+        response = Client().get("/api/posts/aaaaaaaaaaaaaaaaa/thread/",
+                                {"comment":"missing"})
+        self.assertEqual(response.status_code, 404)
+
+class ThreadCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('testuser', 'jd@jdpressman.com', 'testpassword')
+        self.post1 = Post.objects.create(id='aaaaaaaaaaaaaaaaa', user=self.user,
+                                         title='My Fruit Post',
+                                         url=None, slug="test-slug-1",
+                                         body="My Apple Orange Mango")
+        self.comment = Comment.objects.create(id="comment0", user=self.user,
+                                              post=self.post1, body="First")
+
+    def thread(self):
+        response = Client().post("/graphql/", {"query":"""
+        query Thread($postId: String) {
+        CommentsList(terms:{postId:$postId}) {
+        _id
+        baseScore
+        }}""", "variables":json.dumps({"postId":self.post1.id})})
+        return json.loads(response.content.decode("UTF-8"))["data"]["CommentsList"]
+
+    def test_anonymous_thread_cached(self):
+        """Test that a repeated anonymous thread read doesn't touch the database."""
+        self.thread()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.thread(), [{"_id":"comment0", "baseScore":1}])
+
+    def test_thread_invalidated(self):
+        """Test that new comments and votes retire the cached thread."""
+        self.thread()
+        create_comment(Comment(id="comment1", user=self.user, post=self.post1,
+                               body="Second"))
+        self.assertEqual(len(self.thread()), 2)
+        apply_vote(Vote(user=self.user, document_id="comment0",
+                        vote_type="smallUpvote"), Comment, 1)
+        self.assertIn({"_id":"comment0", "baseScore":2}, self.thread())
+
+    def test_thread_query_detection(self):
+        """Test that only queries confined to one post's thread are cached."""
+        def post_id(query, variables, operation_name):
+            return wl_thread_cache.parse_thread_query(query, variables, operation_name)[0]
+        self.assertEqual(post_id('{PostsSingle(documentId:"a") {title} '
+                                 'CommentsList(terms:{postId:"a"}) {_id}}', None, None),
+                         "a")
+        self.assertIsNone(post_id('{PostsSingle(documentId:"a") {title} '
+                                  'CommentsList(terms:{postId:"b"}) {_id}}', None, None))
+        self.assertIsNone(post_id('{CommentsList(terms:{userId:"1"}) {_id}}', None, None))
+        self.assertIsNone(post_id('mutation {CommentsTree(postId:"a") {_id}}', None, None))
+
+@override_settings(VOTE_WRITE_BEHIND=True)
+class WriteBehindVoteTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('testuser', 'jd@jdpressman.com', 'testpassword')
+        self.other = User.objects.create_user('otheruser', 'jd@jdpressman.com', 'testpassword')
+        self.post1 = Post.objects.create(id='aaaaaaaaaaaaaaaaa', user=self.user,
+                                         title='My Fruit Post',
+                                         url=None, slug="test-slug-1",
+                                         base_score=5,
+                                         body="My Apple Orange Mango")
+        self.comment = Comment.objects.create(id="comment0", user=self.user,
+                                              post=self.post1, body="First")
+
+    def test_one_vote_per_user(self):
+        """Test that a user can vote on a document once, and others still can."""
+        cast_vote(self.user, Post, self.post1.id, "smallUpvote")
+        with self.assertRaises(ValueError):
+            cast_vote(self.user, Post, self.post1.id, "smallDownvote")
+        cast_vote(self.other, Post, self.post1.id, "smallUpvote")
+
+    def test_flush_votes(self):
+        """Test that pending votes only reach scores when flushed, in one batch."""
+        cast_vote(self.user, Post, self.post1.id, "smallUpvote")
+        cast_vote(self.other, Post, self.post1.id, "smallUpvote")
+        cast_vote(self.user, Comment, self.comment.id, "smallDownvote")
+        self.post1.refresh_from_db()
+        self.assertEqual(self.post1.base_score, 5)
+        self.assertEqual(flush_votes(), 3)
+        self.assertEqual(flush_votes(), 0)
+        self.post1.refresh_from_db()
+        self.comment.refresh_from_db()
+        self.assertEqual((self.post1.base_score, self.post1.vote_count), (7, 2))
+        self.assertEqual(self.comment.base_score, 0)
+
+    def test_voter_sees_pending_vote(self):
+        """Test that the voter sees their own vote counted before it's flushed."""
+        client = Client()
+        client.login(username="testuser", password="testpassword")
+        response = client.post("/graphql/", {"query":"""
+        mutation {
+        vote(documentId:"aaaaaaaaaaaaaaaaa", voteType:"smallUpvote",
+             collectionName:"posts") {
+        ... on Post { baseScore }
+        }}"""})
+        vote = json.loads(response.content.decode("UTF-8"))["data"]["vote"]
+        self.assertEqual(vote["baseScore"], 6)
+        self.post1.refresh_from_db()
+        self.assertEqual(self.post1.base_score, 5)
+
+class ViewCountTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        view_buffer.take()
+        self.user = User.objects.create_user('testuser', 'jd@jdpressman.com', 'testpassword')
+        self.post1 = Post.objects.create(id='aaaaaaaaaaaaaaaaa', user=self.user,
+                                         title='My Fruit Post',
+                                         url=None, slug="test-slug-1",
+                                         body="My Apple Orange Mango")
+
+    def view(self, client):
+        return client.post("/graphql/", {"query":"""
+        {PostsSingle(documentId:"aaaaaaaaaaaaaaaaa") {
+        title
+        viewCount
+        }}"""})
+
+    def test_views_deduped_and_buffered(self):
+        """Test that views are counted once per viewer and written in one go."""
+        anonymous = Client()
+        self.view(anonymous)
+        self.view(anonymous)
+        logged_in = Client()
+        logged_in.login(username="testuser", password="testpassword")
+        self.view(logged_in)
+        self.post1.refresh_from_db()
+        self.assertEqual(self.post1.view_count, 0)
+        with self.assertNumQueries(1):
+            self.assertEqual(view_buffer.flush(), 2)
+        self.post1.refresh_from_db()
+        self.assertEqual(self.post1.view_count, 2)
+
+    @override_settings(VIEW_FLUSH_INTERVAL=0)
+    def test_views_flushed_when_due(self):
+        """Test that a view recorded after the flush interval writes the buffer out."""
+        self.view(Client())
+        self.post1.refresh_from_db()
+        self.assertEqual(self.post1.view_count, 1)
+
+class ViewFlushTestCase(TransactionTestCase):
+    @override_settings(VIEW_FLUSH_INTERVAL=0.2)
+    def test_views_flushed_without_traffic(self):
+        """Test that buffered views are written out once the flush interval
+        passes, without another view coming in to trigger it."""
+        user = User.objects.create_user('testuser', 'jd@jdpressman.com', 'testpassword')
+        post = Post.objects.create(id='aaaaaaaaaaaaaaaaa', user=user,
+                                   title='My Fruit Post', url=None,
+                                   slug="test-slug-1", body="My Apple Orange Mango")
+        buffer = ViewBuffer()
+        buffer.add(post.id)
+        post.refresh_from_db()
+        self.assertEqual(post.view_count, 0)
+        deadline = time.time() + 5
+        while post.view_count == 0 and time.time() < deadline:
+            time.sleep(0.05)
+            post.refresh_from_db()
+        self.assertEqual(post.view_count, 1)
+
+class FeedTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('testuser', 'jd@jdpressman.com', 'testpassword')
+        now = timezone.now()
+        def post(id, score, days_ago, draft=False, **kwargs):
+            return Post.objects.create(id=id, user=self.user, title=id, slug=id,
+                                       body=id, base_score=score, draft=draft,
+                                       posted_at=now - timedelta(days=days_ago),
+                                       **kwargs)
+        self.old = post("old", 100, 3, curated_date=now)
+        self.recent = post("recent", 2, 0, frontpage_date=now)
+        self.middle = post("middle", 10, 0.5, frontpage_date=now)
+        post("draft", 1000, 0, draft=True)
+
+    def ids(self, name):
+        return [post.id for post in feed(name)]
+
+    def test_feeds(self):
+        """Test that feeds hold the right published posts in the right order."""
+        self.assertEqual(self.ids("new"), ["recent", "middle", "old"])
+        self.assertEqual(self.ids("top"), ["old", "middle", "recent"])
+        self.assertEqual(self.ids("hot"), ["recent", "middle", "old"])
+        self.assertEqual(self.ids("frontpage"), ["recent", "middle", "old"])
+        self.assertEqual(self.ids("curated"), ["old"])
+
+    def test_votes_refresh_feeds(self):
+        """Test that votes move a post within the feeds without a rebuild."""
+        for i in range(20):
+            voter = User.objects.create_user('voter{}'.format(i), 'jd@jdpressman.com', 'x')
+            apply_vote(Vote(user=voter, document_id="middle",
+                            vote_type="smallUpvote"), Post, 1)
+        self.assertEqual(self.ids("frontpage"), ["middle", "recent", "old"])
+
+    def test_rest_posts_in_feeds(self):
+        """Test that posts made through the REST API are published to the feeds."""
+        client = Client()
+        client.login(username="testuser", password="testpassword")
+        response = client.post("/api/posts/", {"title":"Rest", "body":"Rest"})
+        post_id = json.loads(response.content.decode("UTF-8"))["_id"]
+        self.assertEqual(self.ids("new")[0], post_id)
+        self.assertIn(post_id, self.ids("frontpage"))
+
+    def test_feed_cursors_refused(self):
+        """Test that feed views refuse cursors rather than ignore them."""
+        response = Client().post("/graphql/", {"query":"""
+        {PostsList(terms:{view:"frontpage", after:"abc", limit:5}) {
+        _id
+        }}"""})
+        self.assertIsNotNone(json.loads(response.content.decode("UTF-8")).get("errors"))
+
+    def test_posts_list_view(self):
+        """Test that PostsList serves a feed when given its view."""
+        response = Client().post("/graphql/", {"query":"""
+        {PostsList(terms:{view:"frontpage", offset:1, limit:5}) {
+        _id
+        }}"""})
+        posts = json.loads(response.content.decode("UTF-8"))["data"]["PostsList"]
+        self.assertEqual(posts, [{"_id":"middle"}, {"_id":"old"}])
+
+class NotificationFanoutTestCase(TestCase):
+    def setUp(self):
+        self.author = User.objects.create_user('author', 'jd@jdpressman.com', 'testpassword')
+        self.reader = User.objects.create_user('reader', 'jd@jdpressman.com', 'testpassword')
+        self.other = User.objects.create_user('other', 'jd@jdpressman.com', 'testpassword')
+        self.post1 = Post.objects.create(id='aaaaaaaaaaaaaaaaa', user=self.author,
+                                         title='My Fruit Post',
+                                         url=None, slug="test-slug-1",
+                                         body="My Apple Orange Mango")
+
+    def notified(self):
+        return sorted((notification.user.username, notification.type)
+                      for notification in Notification.objects.all())
+
+    def test_comment_notifications(self):
+        """Test that comments notify the post author and the replied to commenter."""
+        comment = Comment(id="comment0", user=self.reader, post=self.post1, body="Hi")
+        create_comment(comment)
+        emit("comment", comment.id)
+        create_comment(Comment(id="comment1", user=self.author, post=self.post1,
+                               parent_comment=comment, body="Hello"))
+        emit("comment", "comment1")
+        self.assertEqual(Notification.objects.count(), 0)
+        self.assertEqual(deliver_notifications(), 2)
+        self.assertEqual(self.notified(), [("author", "newComment"),
+                                           ("reader", "newReply")])
+        self.assertEqual(deliver_notifications(), 0)
+
+    def test_reply_to_deleted_author(self):
+        """Test that a reply to a comment whose author is gone only notifies the
+        post author, and doesn't hold up the queue."""
+        create_comment(Comment(id="comment0", user=None, post=self.post1, body="Hi"))
+        create_comment(Comment(id="comment1", user=self.reader, post=self.post1,
+                               parent_comment_id="comment0", body="Hello"))
+        emit("comment", "comment1")
+        self.assertEqual(deliver_notifications(), 1)
+        self.assertEqual(self.notified(), [("author", "newComment")])
+        self.assertEqual(NotificationEvent.objects.count(), 0)
+
+    def test_message_notifications(self):
+        """Test that a message notifies every other participant in one delivery."""
+        conversation = Conversation.objects.create(title="Fruit")
+        for user in (self.author, self.reader, self.other):
+            Participant.objects.create(user=user, conversation=conversation)
+        client = Client()
+        client.login(username="author", password="testpassword")
+        client.post("/graphql/", {"query":"""
+        mutation {
+        MessagesNew(document:{conversationId:"%s", body:"Hi all"}) { _id }
+        }""" % conversation.id})
+        deliver_notifications()
+        self.assertEqual(self.notified(), [("other", "newMessage"),
+                                           ("reader", "newMessage")])
+
+    def test_unread_counts(self):
+        """Test that unread counts follow deliveries and notification checks."""
+        for user in (self.author, self.reader):
+            Profile.objects.create(user=user, last_notifications_check=timezone.now())
+        create_comment(Comment(id="comment0", user=self.reader, post=self.post1,
+                               body="Hi"))
+        emit("comment", "comment0")
+        deliver_notifications()
+        client = Client()
+        client.login(username="author", password="testpassword")
+        with self.assertNumQueries(3):
+            response = client.get("/api/unread_notifications/")
+        self.assertEqual(json.loads(response.content.decode("UTF-8")), {"unread":1})
+        client.post("/graphql/", {"query":"""
+        mutation Check($id: String, $check: DateTime) {
+        usersEdit(documentId:$id, set:{lastNotificationsCheck:$check}) { _id }
+        }""", "variables":json.dumps({"id":str(self.author.id),
+                                       "check":timezone.now().isoformat()})})
+        response = client.post("/graphql/", {"query":"""
+        {UsersSingle(_id:%d) { unreadNotificationCount }}""" % self.author.id})
+        user = json.loads(response.content.decode("UTF-8"))["data"]["UsersSingle"]
+        self.assertEqual(user["unreadNotificationCount"], 0)
+        self.assertEqual(Client().get("/api/unread_notifications/").status_code, 403)
+
+    def test_unknown_kind_dropped(self):
+        """Test that an event of an unknown kind is dropped rather than blocking
+        the events queued after it."""
+        create_comment(Comment(id="comment0", user=self.reader, post=self.post1,
+                               body="Hi"))
+        NotificationEvent.objects.create(kind="retired", document_id="gone")
+        emit("comment", "comment0")
+        with self.assertLogs("lw2.notifications", "WARNING"):
+            self.assertEqual(deliver_notifications(), 2)
+        self.assertFalse(NotificationEvent.objects.exists())
+        self.assertEqual(self.notified(), [("author", "newComment")])
+
+    def test_check_keeps_other_columns(self):
+        """Test that checking notifications only writes the check and the count,
+        not a stale copy of the rest of the profile."""
+        profile = Profile.objects.create(user=self.author,
+                                         last_notifications_check=timezone.now())
+        Profile.objects.filter(pk=profile.pk).update(karma=10,
+                                                     unread_notification_count=3)
+        check_notifications(profile, timezone.now())
+        profile.refresh_from_db()
+        self.assertEqual(profile.karma, 10)
+        self.assertEqual(profile.unread_notification_count, 0)
+
+class EventStreamTestCase(TransactionTestCase):
+    # Commits for real so that publishing on commit happens
+    def setUp(self):
+        self.author = User.objects.create_user('author', 'jd@jdpressman.com', 'testpassword')
+        self.reader = User.objects.create_user('reader', 'jd@jdpressman.com', 'testpassword')
+        self.post1 = Post.objects.create(id='aaaaaaaaaaaaaaaaa', user=self.author,
+                                         title='My Fruit Post',
+                                         url=None, slug="test-slug-1",
+                                         body="My Apple Orange Mango")
+
+    def test_brokers(self):
+        """Test that both brokers deliver to subscribers of the channel only."""
+        cache.clear()
+        for broker in (LocalBroker(), CacheBroker()):
+            broker.publish("post:a", {"event":"early"})
+            subscription = broker.subscribe(["post:a", "user:1"])
+            broker.publish("post:b", {"event":"elsewhere"})
+            broker.publish("post:a", {"event":"comment"})
+            broker.publish("user:1", {"event":"notification"})
+            # Messages are only ordered within a channel
+            self.assertEqual(sorted([subscription.get(1), subscription.get(1)]),
+                             [("post:a", {"event":"comment"}),
+                              ("user:1", {"event":"notification"})])
+            self.assertIsNone(subscription.get(0))
+            subscription.close()
+
+    def test_published_events(self):
+        """Test that new comments and delivered notifications are published."""
+        subscription = pubsub.subscribe([pubsub.post_channel(self.post1.id),
+                                         pubsub.user_channel(self.author.id)])
+        try:
+            create_comment(Comment(id="comment0", user=self.reader, post=self.post1,
+                                   body="Hi"))
+            channel, message = subscription.get(1)
+            self.assertEqual((message["event"], message["_id"]), ("comment", "comment0"))
+            emit("comment", "comment0")
+            deliver_notifications()
+            channel, message = subscription.get(1)
+            self.assertEqual(channel, pubsub.user_channel(self.author.id))
+            self.assertEqual((message["event"], message["type"]),
+                             ("notification", "newComment"))
+            self.assertIsNone(subscription.get(0))
+        finally:
+            subscription.close()
+
+    @override_settings(EVENT_STREAM_HEARTBEAT=0.1, EVENT_STREAM_TIMEOUT=5)
+    def test_event_stream(self):
+        """Test that the event stream relays comments on a watched post."""
+        self.assertEqual(Client().get("/events").status_code, 400)
+        response = Client().get("/events", {"post":self.post1.id})
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        events = iter(response.streaming_content)
+        self.assertEqual(next(events), b"retry: 1000\n\n")
+        self.assertEqual(next(events), b": heartbeat\n\n")
+        create_comment(Comment(id="comment0", user=self.reader, post=self.post1,
+                               body="Hi"))
+        event = next(events).decode("UTF-8")
+        self.assertTrue(event.startswith("event: comment\ndata: "))
+        self.assertEqual(json.loads(event.split("data: ")[1])["_id"], "comment0")
+        response.close()
+
+    @override_settings(EVENT_STREAM_MAX_STREAMS=1)
+    def test_event_stream_limit(self):
+        """Test that a process turns away streams over its limit until one
+        closes."""
+        first = Client().get("/events", {"post":self.post1.id})
+        self.assertEqual(first.status_code, 200)
+        second = Client().get("/events", {"post":self.post1.id})
+        self.assertEqual(second.status_code, 503)
+        first.close()
+        third = Client().get("/events", {"post":self.post1.id})
+        self.assertEqual(third.status_code, 200)
+        third.close()
+
+class MessagingTestCase(TestCase):
+    def setUp(self):
+        self.author = User.objects.create_user('author', 'jd@jdpressman.com', 'testpassword')
+        self.reader = User.objects.create_user('reader', 'jd@jdpressman.com', 'testpassword')
+        self.other = User.objects.create_user('other', 'jd@jdpressman.com', 'testpassword')
+        self.conversation = self.converse("Fruit", self.author, self.reader)
+
+    def converse(self, title, *users):
+        conversation = Conversation.objects.create(title=title)
+        for user in users:
+            Participant.objects.create(user=user, conversation=conversation)
+        return conversation
+
+    def query(self, username, query, variables=None):
+        client = Client()
+        client.login(username=username, password="testpassword")
+        response = client.post("/graphql/", {"query":query,
+                                             "variables":json.dumps(variables or {})})
+        return json.loads(response.content.decode("UTF-8"))
+
+    def messages(self, username, **terms):
+        terms["conversationId"] = str(self.conversation.id)
+        return self.query(username, """
+        query Messages($terms: MessagesTerms) {
+        MessagesList(terms:$terms) { body cursor }}""", {"terms":terms})
+
+    def inbox(self, username):
+        return self.query(username, """
+        {ConversationsList(terms:{}) {
+          title unreadCount cursor
+          latestMessage { body userId }
+          participants { displayName }
+        }}""")["data"]["ConversationsList"]
+
+    def test_message_pages(self):
+        """Test that messages page backwards from the latest, oldest first."""
+        for number in range(5):
+            send_message(self.author, self.conversation.id, "Message {}".format(number))
+        page = self.messages("reader", limit=2)["data"]["MessagesList"]
+        self.assertEqual([message["body"] for message in page],
+                         ["Message 3", "Message 4"])
+        page = self.messages("reader", limit=2, after=page[0]["cursor"])
+        self.assertEqual([message["body"] for message in page["data"]["MessagesList"]],
+                         ["Message 1", "Message 2"])
+
+    def test_message_permissions(self):
+        """Test that only participants can read or post to a conversation."""
+        send_message(self.author, self.conversation.id, "Secret")
+        self.assertIsNotNone(self.messages("other").get("errors"))
+        self.assertIsNotNone(self.messages("nobody").get("errors"))
+        with self.assertRaises(ValueError):
+            send_message(self.other, self.conversation.id, "Let me in")
+        self.assertEqual(Message.objects.count(), 1)
+
+    def test_inbox(self):
+        """Test that the inbox lists conversations by activity with their unread
+        counts, in a number of queries independent of the number of
+        conversations."""
+        fruit = self.conversation
+        self.converse("Vegetables", self.reader, self.other)
+        send_message(self.author, fruit.id, "Apple")
+        send_message(self.author, fruit.id, "Orange")
+        inbox = self.inbox("reader")
+        self.assertEqual([(conversation["title"], conversation["unreadCount"])
+                          for conversation in inbox],
+                         [("Fruit", 2), ("Vegetables", 0)])
+        self.assertEqual(inbox[0]["latestMessage"], {"body":"Orange",
+                                                     "userId":str(self.author.id)})
+        self.assertEqual(sorted(participant["displayName"]
+                                for participant in inbox[0]["participants"]),
+                         ["author", "reader"])
+        self.assertEqual(self.inbox("author")[0]["unreadCount"], 0)
+        self.messages("reader")
+        self.assertEqual(self.inbox("reader")[0]["unreadCount"], 0)
+        send_message(self.author, fruit.id, "Mango")
+        self.assertEqual(self.inbox("reader")[0]["unreadCount"], 1)
+        with CaptureQueriesContext(connection) as few:
+            self.inbox("reader")
+        for number in range(3):
+            self.converse("More {}".format(number), self.reader, self.author)
+        with CaptureQueriesContext(connection) as many:
+            self.assertEqual(len(self.inbox("reader")), 5)
+        self.assertEqual(len(few), len(many))
+
+    def test_conversations_new(self):
+        """Test that a conversation with an unknown participant isn't created."""
+        query = """
+        mutation New($ids: [String]) {
+        ConversationsNew(document:{title:"Plans", participantIds:$ids}) { _id }}"""
+        response = self.query("author", query, {"ids":[str(self.author.id), "999"]})
+        self.assertIsNotNone(response.get("errors"))
+        self.assertFalse(Conversation.objects.filter(title="Plans").exists())
+        response = self.query("author", query, {"ids":[str(self.author.id),
+                                                       str(self.other.id)]})
+        conversation = Conversation.objects.get(
+            id=response["data"]["ConversationsNew"]["_id"])
+        self.assertEqual(sorted(conversation.participants.values_list("user__username",
+                                                                      flat=True)),
+                         ["author", "other"])
+
+    def test_broadcast(self):
+        """Test that a moderator broadcast reaches each user in their own
+        conversation."""
+        query = """
+        mutation Broadcast($ids: [String]) {
+        MessagesBroadcast(document:{title:"Notice", body:"Be nice",
+                                    participantIds:$ids}) { _ids conversationIds }}"""
+        ids = [str(self.reader.id), str(self.other.id)]
+        self.assertIsNotNone(self.query("author", query, {"ids":ids}).get("errors"))
+        Profile.objects.create(user=self.author, moderator=True)
+        response = self.query("author", query, {"ids":ids})
+        self.assertEqual(len(response["data"]["MessagesBroadcast"]["_ids"]), 2)
+        for username in ("reader", "other"):
+            notice = self.inbox(username)[0]
+            self.assertEqual((notice["title"], notice["unreadCount"]), ("Notice", 1))
+            self.assertEqual(notice["latestMessage"]["body"], "Be nice")
+            self.assertEqual(sorted(participant["displayName"]
+                                    for participant in notice["participants"]),
+                             sorted(["author", username]))
+        self.assertEqual(self.inbox("author")[0]["unreadCount"], 0)
+        deliver_notifications()
+        self.assertEqual(Notification.objects.filter(type="newMessage").count(), 2)
+
+    def test_conversation_through_message(self):
+        """Test that a conversation reached through a message shows the reader's
+        own unread count and latest message."""
+        send_message(self.author, self.conversation.id, "Apple")
+        send_message(self.reader, self.conversation.id, "Orange")
+        response = self.query("author", """
+        query Messages($terms: MessagesTerms) {
+        MessagesList(terms:$terms) {
+          conversation { unreadCount lastReadAt latestMessage { body } }
+        }}""", {"terms":{"conversationId":str(self.conversation.id)}})
+        self.assertIsNone(response.get("errors"))
+        conversation = response["data"]["MessagesList"][0]["conversation"]
+        self.assertEqual(conversation["latestMessage"], {"body":"Orange"})
+        self.assertIsNotNone(conversation["lastReadAt"])
+        self.assertEqual(conversation["unreadCount"], 0)
+
+    def test_participant_read_state_hidden(self):
+        """Test that other participants' read markers and unread counts can't
+        be queried."""
+        for field in ("lastReadAt", "unreadCount"):
+            response = self.query("author", """
+            {ConversationsSingle(documentId:"%s") { participants { %s } }}""" % (
+                self.conversation.id, field))
+            self.assertIsNotNone(response.get("errors"))
+            self.assertIsNone(response.get("data"))
+
+    def test_conversation_messages_not_exposed(self):
+        """Test that a conversation's messages can't be read in one unpaginated
+        list, only through MessagesList."""
+        response = self.query("author", """
+        {ConversationsSingle(documentId:"%s") { messages { body } }}""" % (
+            self.conversation.id))
+        self.assertIsNotNone(response.get("errors"))
+        self.assertIsNone(response.get("data"))
+
+class LineageTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.users = {}
+        for name in ("root", "a", "b", "c", "d"):
+            self.users[name] = User.objects.create_user(name, 'jd@jdpressman.com',
+                                                        'testpassword')
+        for parent, child in (("root", "a"), ("a", "b"), ("b", "c"), ("root", "d")):
+            InviteTreeNode.objects.create(parent=self.users[parent],
+                                          child=self.users[child])
+
+    def names(self, users):
+        return [user.username for user in users]
+
+    def test_lineage(self):
+        """Test ancestors, descendants, depth and subtree size from the paths."""
+        users = self.users
+        self.assertEqual(self.names(lineage.ancestors(users["c"].id)), ["root", "a", "b"])
+        self.assertEqual(lineage.lineage_depth(users["c"].id), 3)
+        self.assertEqual(lineage.lineage_depth(users["root"].id), 0)
+        self.assertEqual(self.names(node.child for node in
+                                    lineage.descendants(users["a"].id)), ["b", "c"])
+        self.assertEqual(self.names(node.child for node in
+                                    lineage.descendants(users["a"].id, max_depth=1)),
+                         ["b"])
+        self.assertEqual(lineage.subtree_size(users["root"].id), 4)
+        with self.assertNumQueries(1):
+            # The path is cached, leaving just the users
+            lineage.ancestors(users["c"].id)
+
+    def test_lineage_api(self):
+        """Test that only moderators can see a user's lineage."""
+        client = Client()
+        client.login(username="a", password="testpassword")
+        url = "/api/users/{}/lineage/".format(self.users["a"].id)
+        self.assertEqual(client.get(url).status_code, 403)
+        Profile.objects.create(user=self.users["a"], moderator=True)
+        response = json.loads(client.get(url).content.decode("UTF-8"))
+        self.assertEqual(response["depth"], 1)
+        self.assertEqual([user["username"] for user in response["ancestors"]], ["root"])
+        self.assertEqual(response["subtreeSize"], 2)
+        self.assertEqual([(user["username"], user["depth"])
+                          for user in response["descendants"]], [("b", 1), ("c", 2)])
+
+    def test_signup_path(self):
+        """Test that signing up with an invite extends the inviter's path."""
+        Profile.objects.create(user=self.users["c"])
+        invite = Invite.objects.create(creator=self.users["c"], code="lineagecode",
+                                       expires=timezone.now() + timedelta(days=1))
+        Client().post("/api/users/", {"username":"e", "password":"testpassword",
+                                      "email":"jd@jdpressman.com",
+                                      "code":invite.code})
+        e = User.objects.get(username="e")
+        node = InviteTreeNode.objects.get(child=e)
+        self.assertEqual(node.path, "{}/{}/{}/{}/{}/".format(
+            *[self.users[name].id for name in ("root", "a", "b", "c")], e.id))
+        self.assertEqual(node.depth, 4)
+
+class StubAnnotationServer(object):
+    """A local stand in for the hypothes.is API, answering searches with status
+    and body and counting them."""
+    def __init__(self):
+        stub = self
+        self.status = 200
+        self.body = '{"rows": [], "total": 0}'
+        self.requests = []
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.requests.append(self.path)
+                self.send_response(stub.status)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(stub.body.encode())
+            def log_message(self, *args):
+                pass
+        self.server = HTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:{}/api".format(self.server.server_port)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class AnnotationProxyTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        annotations.breaker.succeeded()
+        self.stub = StubAnnotationServer()
+        self.addCleanup(self.stub.close)
+        self.settings = override_settings(HYPOTHESIS_API_URL=self.stub.url,
+                                          ANNOTATION_BREAKER_THRESHOLD=2)
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+        user = User.objects.create_user('testuser', 'jd@jdpressman.com', 'testpassword')
+        Profile.objects.create(user=user, hypothesis_user="acct:test@hypothes.is",
+                               hypothesis_group="__world__",
+                               hypothesis_api_key="key")
+        self.url = "/api/annotations/?userid={}&limit=5".format(user.id)
+
+    def test_cached_search(self):
+        """Test that repeated searches are answered from the cache."""
+        for i in range(3):
+            response = Client().get(self.url)
+            self.assertEqual(response.content.decode("UTF-8"), self.stub.body)
+        self.assertEqual(len(self.stub.requests), 1)
+        self.assertIn("limit=5", self.stub.requests[0])
+
+    def test_stale_while_down(self):
+        """Test that stale results are served while upstream fails, and that the
+        breaker stops calling it."""
+        with override_settings(ANNOTATION_CACHE_TTL=0):
+            Client().get(self.url)
+            self.stub.status = 500
+            for i in range(4):
+                response = Client().get(self.url)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.content.decode("UTF-8"), self.stub.body)
+                # Let the background refresh finish before the next one
+                for thread in threading.enumerate():
+                    if thread.name == "annotation-refresh":
+                        thread.join()
+        self.assertEqual(len(self.stub.requests), 3)
+        cache.clear()
+        response = Client().get(self.url)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(len(self.stub.requests), 3)
+
+class IdTestCase(TestCase):
+    def test_ids(self):
+        """Test that ids are unique, in order and in the old 17 character URL safe
+        format, even when many are made in the same millisecond."""
+        ids = [new_id() for i in range(20000)]
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertEqual(sorted(ids), ids)
+        for id in ids[:100]:
+            self.assertRegex(id, "^[A-Za-z0-9_-]{17}$")
+
+    def test_clock_step_back(self):
+        """Test that ids keep increasing when the clock goes backwards."""
+        # Its own generator, so the shared one's clock is left alone
+        generator = IdGenerator()
+        first = generator.new_id()
+        # As if the clock had since been set back ten seconds
+        generator.last_time += 10000
+        second = generator.new_id()
+        self.assertGreater(second, first)
+        self.assertGreater(generator.new_id(), second)
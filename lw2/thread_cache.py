@@ -0,0 +1,123 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from graphql.language import ast
+from graphql.language.parser import parse
+from graphql.error import GraphQLError
+import hashlib
+import json
+import time
+
+"""Cache for the serialized responses of thread reads, a post and its comments.
+
+Every post has a version number in the cache. Anything that changes what a
+thread read returns (saving the post, creating, editing, retracting or deleting
+a comment on it, voting on either) bumps the version, and responses are cached
+under the version they were built at, so a bump retires all of them at once.
+Because currentUserVotes differs per reader, responses are cached separately for
+anonymous readers, who share one copy, and for each logged in user.
+
+Changes that aren't tied to a post, like an author renaming themselves, are
+only picked up once THREAD_CACHE_TIMEOUT runs out."""
+
+# Top level GraphQL fields that read a single post's thread
+THREAD_FIELDS = {"PostsSingle", "CommentsTree", "CommentsList", "CommentsTotal"}
+
+def cache_timeout():
+    return getattr(settings, "THREAD_CACHE_TIMEOUT", 300)
+
+def version_key(post_id):
+    return "lw2:thread-version:{}".format(post_id)
+
+def thread_version(post_id):
+    version = cache.get(version_key(post_id))
+    if version is None:
+        # Start from the clock rather than 0 so a version evicted from the cache
+        # can't come back and match responses cached under it before
+        cache.add(version_key(post_id), int(time.time() * 1000000), None)
+        version = cache.get(version_key(post_id))
+    return version
+
+def _bump(post_id):
+    try:
+        cache.incr(version_key(post_id))
+    except ValueError:
+        # Not cached, the next read starts a fresh version anyway
+        pass
+
+def bump_thread(post_id):
+    """Retire the cached responses for a post's thread.
+
+    The version is bumped right away and again once the current transaction
+    commits, so a read that lands in between can't cache the uncommitted
+    state under the newer version."""
+    if post_id is None:
+        return
+    _bump(post_id)
+    transaction.on_commit(lambda: _bump(post_id))
+
+def response_key(post_id, user, *request):
+    """Cache key for the response to a thread read made by user, request being
+    whatever identifies what was asked for."""
+    reader = "user{}".format(user.id) if user.is_authenticated else "anonymous"
+    digest = hashlib.md5(json.dumps(request, sort_keys=True).encode()).hexdigest()
+    return "lw2:thread:{}:{}:{}:{}".format(post_id, thread_version(post_id),
+                                           reader, digest)
+
+def get_response(key):
+    return cache.get(key)
+
+def set_response(key, response):
+    cache.set(key, response, cache_timeout())
+
+def argument_value(node, variables):
+    if isinstance(node, ast.Variable):
+        return (variables or {}).get(node.name.value)
+    if isinstance(node, ast.ObjectValue):
+        return {field.name.value:argument_value(field.value, variables)
+                for field in node.fields}
+    if isinstance(node, (ast.StringValue, ast.IntValue)):
+        return node.value
+    return None
+
+def field_post_id(field, variables):
+    arguments = {argument.name.value:argument_value(argument.value, variables)
+                 for argument in field.arguments}
+    name = field.name.value
+    if name == "PostsSingle":
+        return arguments.get("documentId") or arguments.get("_id")
+    if name == "CommentsTree":
+        return arguments.get("postId")
+    terms = arguments.get("terms")
+    # Listing a user's comments isn't a thread read
+    if isinstance(terms, dict) and not terms.get("userId"):
+        return terms.get("postId")
+    return None
+
+def parse_thread_query(query, variables, operation_name):
+    """Return the post id and the set of top level fields if a GraphQL query
+    only reads the thread of one post, otherwise (None, None)."""
+    if not query:
+        return None, None
+    try:
+        document = parse(query)
+    except (GraphQLError, TypeError):
+        return None, None
+    operations = [definition for definition in document.definitions
+                  if isinstance(definition, ast.OperationDefinition)]
+    if operation_name:
+        operations = [operation for operation in operations
+                      if operation.name and operation.name.value == operation_name]
+    if len(operations) != 1 or operations[0].operation != "query":
+        return None, None
+    post_ids = set()
+    fields = set()
+    for selection in operations[0].selection_set.selections:
+        if not (isinstance(selection, ast.Field) and
+                selection.name.value in THREAD_FIELDS):
+            return None, None
+        post_ids.add(field_post_id(selection, variables))
+        fields.add(selection.name.value)
+    if len(post_ids) != 1 or None in post_ids:
+        return None, None
+    return post_ids.pop(), fields
@@ -0,0 +1,73 @@
+from django.conf import settings
+import hashlib
+
+"""Materialized paths for comment threads.
+
+Each comment stores the path from the top of its thread down to itself as a
+string of fixed width segments, one per level. A segment is the comment's post
+time in milliseconds followed by a few characters of a hash of its id, all
+lowercase base 36, so sorting a post's comments by path yields the thread in
+depth first order with siblings oldest first. A subtree is every comment whose
+path starts with its root's, so fetching a whole thread, or any branch of it, is
+a single range scan on the (post, path) index."""
+
+SEGMENT_WIDTH = 13
+# Keeps the path short enough for a btree index entry on every backend
+MAX_PATH_LENGTH = 2048
+MAX_DEPTH = MAX_PATH_LENGTH // SEGMENT_WIDTH - 1
+
+DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+def base36(number, width):
+    digits = []
+    for i in range(width):
+        number, digit = divmod(number, 36)
+        digits.append(DIGITS[digit])
+    return "".join(reversed(digits))
+
+def path_segment(posted_at, id):
+    milliseconds = int(posted_at.timestamp() * 1000)
+    tiebreak = int(hashlib.md5(id.encode()).hexdigest()[:5], 16)
+    return base36(milliseconds, 9) + base36(tiebreak, 4)
+
+def child_path(parent_path, posted_at, id):
+    """Return the path of a comment posted at posted_at under the comment with
+    parent_path, or at the top of the thread if parent_path is empty."""
+    path = (parent_path or "") + path_segment(posted_at, id)
+    if len(path) > MAX_PATH_LENGTH:
+        raise ValueError("This thread is nested too deeply to reply any further.")
+    return path
+
+def path_depth(path):
+    """Depth of a comment with the given path, top level comments being 0."""
+    return len(path) // SEGMENT_WIDTH - 1
+
+def thread_limit(limit=None):
+    """Clamp a requested thread page size to COMMENT_THREAD_MAX_SIZE."""
+    max_size = getattr(settings, "COMMENT_THREAD_MAX_SIZE", 500)
+    return min(limit or max_size, max_size)
+
+def thread(comments, root_id=None, max_depth=None, after_id=None, limit=None):
+    """Order a post's comments as a thread, depth first.
+
+    - root_id: Only return this comment and the replies under it.
+    - max_depth: Leave out replies more than this many levels below the top of
+    the thread, or below the root comment if given.
+    - after_id: The id of the last comment of a previous page, to continue from.
+    - limit: Return at most this many comments.
+
+    Raises the model's DoesNotExist if root_id or after_id isn't one of
+    comments."""
+    top = 0
+    if root_id:
+        path, top = comments.values_list("path", "depth").get(id=root_id)
+        comments = comments.filter(path__startswith=path)
+    if max_depth is not None:
+        comments = comments.filter(depth__lte=top + max_depth)
+    if after_id:
+        comments = comments.filter(
+            path__gt=comments.values_list("path", flat=True).get(id=after_id))
+    comments = comments.order_by("path")
+    if limit:
+        return comments[:limit]
+    return comments
@@ -1,6 +1,5 @@
 from django.conf.urls import url, include
 from django.views.decorators.csrf import csrf_exempt
-from graphene_django.views import GraphQLView
 from rest_framework import routers
 from lw2.models import Tag
 from lw2 import views
@@ -17,10 +16,13 @@ router.register(r'bans', views.BanViewSet)
 router.register(r'invites', views.InviteViewSet)
 router.register(r'my_invites', views.InviteList, basename="my-invites")
 router.register(r'annotations', views.AnnotationList, basename="annotations")
+router.register(r'unread_notifications', views.UnreadNotificationsView,
+                basename="unread-notifications")
 
 urlpatterns = [
-    url(r'^graphql', csrf_exempt(GraphQLView.as_view())),
-    url(r'^graphiql', csrf_exempt(GraphQLView.as_view(graphiql=True))),
+    url(r'^graphql', csrf_exempt(views.ThreadCachingGraphQLView.as_view())),
+    url(r'^graphiql', csrf_exempt(views.ThreadCachingGraphQLView.as_view(graphiql=True))),
+    url(r'^events', views.EventStreamView.as_view()),
     url(r'^api/', include(router.urls)),
     url(r'^api-auth/', include('rest_framework.urls', namespace='rest_framework')),
 ]
@@ -0,0 +1,104 @@
+from collections import Counter
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.db.models import F
+from .models import Post
+from .counters import per_document
+import atexit
+import hashlib
+import logging
+import os
+import threading
+import time
+
+"""Buffered counting of post views.
+
+A view is counted at most once per viewer per VIEW_DEDUPE_WINDOW seconds,
+checked with an add to the shared cache. A viewer is a logged in user, or
+else a session, or else an IP address. Counted views collect in a per-process
+buffer. Each process writes its buffer out with a single UPDATE once
+VIEW_FLUSH_INTERVAL seconds have passed since its last write, once it holds
+VIEW_BUFFER_SIZE posts, or when the process exits. A background thread checks
+every interval, so a process that stops getting views still writes out the ones
+it has. So reading a post almost never writes to the database, and view_count
+lags by at most about one flush interval."""
+
+logger = logging.getLogger(__name__)
+
+def viewer_key(request):
+    if request.user.is_authenticated:
+        viewer = "user:{}".format(request.user.id)
+    elif request.session.session_key:
+        viewer = "session:{}".format(request.session.session_key)
+    else:
+        viewer = "ip:{}".format(request.META.get("REMOTE_ADDR"))
+    return hashlib.md5(viewer.encode()).hexdigest()
+
+class ViewBuffer(object):
+    """Views counted by this process and not yet written to the database."""
+    def __init__(self):
+        self.counts = Counter()
+        self.lock = threading.Lock()
+        self.last_flush = time.time()
+        self.timer_pid = None
+
+    def interval(self):
+        return getattr(settings, "VIEW_FLUSH_INTERVAL", 30)
+
+    def add(self, post_id):
+        self.start_timer()
+        with self.lock:
+            self.counts[post_id] += 1
+            due = (time.time() - self.last_flush >= self.interval() or
+                   len(self.counts) >= getattr(settings, "VIEW_BUFFER_SIZE", 1000))
+        if due:
+            self.flush()
+
+    def start_timer(self):
+        """Start the thread that flushes the buffer when it's due, unless this
+        process already has it."""
+        with self.lock:
+            # Threads don't survive a fork, so a forked child starts its own
+            if self.timer_pid == os.getpid():
+                return
+            self.timer_pid = os.getpid()
+        threading.Thread(target=self.run_timer, name="view-flush", daemon=True).start()
+
+    def run_timer(self):
+        while True:
+            time.sleep(max(0.01, self.last_flush + self.interval() - time.time()))
+            if time.time() - self.last_flush < self.interval():
+                continue
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Couldn't write out buffered views")
+            finally:
+                close_old_connections()
+
+    def take(self):
+        with self.lock:
+            counts, self.counts = self.counts, Counter()
+            self.last_flush = time.time()
+            return counts
+
+    def flush(self):
+        """Write out the buffered views and return how many there were."""
+        counts = self.take()
+        if counts:
+            Post.objects.filter(id__in=counts).update(
+                view_count=F("view_count") + per_document(counts))
+        return sum(counts.values())
+
+view_buffer = ViewBuffer()
+atexit.register(view_buffer.flush)
+
+def record_view(request, post_id):
+    """Count a view of a post by whoever made request, unless they've already
+    been counted within the dedupe window. Returns whether it was counted."""
+    key = "lw2:viewed:{}:{}".format(post_id, viewer_key(request))
+    if not cache.add(key, 1, getattr(settings, "VIEW_DEDUPE_WINDOW", 30 * 60)):
+        return False
+    view_buffer.add(post_id)
+    return True
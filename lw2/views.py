@@ -1,29 +1,67 @@
 from django.shortcuts import render
 from django.views import View
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
 from django.utils.datastructures import MultiValueDictKeyError
 from rest_framework import viewsets, filters, generics
 from rest_framework.permissions import DjangoModelPermissions
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, BasePermission
 from rest_framework.authentication import SessionAuthentication, BasicAuthentication
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.renderers import JSONRenderer
 from rest_framework.decorators import action
+from graphene_django.views import GraphQLView
 from lw2.models import *
 from lw2.serializers import *
+from lw2.counters import delete_comment
+from lw2.threads import thread, thread_limit
+import lw2.thread_cache as thread_cache
+from lw2.view_counts import record_view
+from lw2.notifications import unread_notifications
+import lw2.lineage as lineage
+import lw2.annotations as annotations
+import lw2.pubsub as pubsub
 import lw2.search as wl_search
 import datetime
 import json
-import h_annot # TODO: Modularize this out as some kind of extension
+import threading
 
 
+class ThreadCachingGraphQLView(GraphQLView):
+    """GraphQL endpoint that serves queries reading a single post's thread from
+    the thread cache."""
+    def get_response(self, request, data, show_graphiql=False):
+        query, variables, operation_name, id = self.get_graphql_params(request, data)
+        post_id, fields = thread_cache.parse_thread_query(query, variables,
+                                                          operation_name)
+        if post_id is None or show_graphiql or self.batch:
+            return super().get_response(request, data, show_graphiql)
+        key = thread_cache.response_key(post_id, request.user,
+                                        query, variables, operation_name)
+        response = thread_cache.get_response(key)
+        if response is not None and "PostsSingle" in fields:
+            # Resolving PostsSingle counts the view, which a cached response skips
+            record_view(request, post_id)
+        if response is None:
+            response = super().get_response(request, data, show_graphiql)
+            result, status_code = response
+            if status_code == 200 and "errors" not in json.loads(result):
+                thread_cache.set_response(key, response)
+        return response
+
 class CsrfExemptSessionAuthentication(SessionAuthentication):
     """The API doesn't actually communicate with a users browser, so CSRF 
     doesn't make sense."""
     def enforce_csrf(self, request):
         return
 
+class IsModerator(BasePermission):
+    def has_permission(self, request, view):
+        return (request.user.is_authenticated and
+                Profile.objects.filter(user=request.user, moderator=True).exists())
+
 class UserViewSet(viewsets.ModelViewSet):
     """
     API endpoint that allows users to be viewed or edited.
@@ -31,6 +69,34 @@ class UserViewSet(viewsets.ModelViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
 
+    @action(detail=True, permission_classes=[IsModerator])
+    def lineage(self, request, pk=None):
+        """The user's invite lineage: who invited them and so on up to the root,
+        and everyone they invited and so on, in depth first order. The max_depth
+        parameter limits how many levels below the user are listed and at most
+        INVITE_LINEAGE_MAX_SIZE are."""
+        try:
+            user_id = int(pk)
+            max_depth = request.GET.get("max_depth")
+            max_depth = int(max_depth) if max_depth else None
+        except ValueError:
+            return HttpResponse("User id and max_depth must be integers.", status=400)
+        if not User.objects.filter(id=user_id).exists():
+            return HttpResponse("No user with id {}".format(pk), status=404)
+        depth = lineage.lineage_depth(user_id)
+        nodes = lineage.descendants(user_id, max_depth).select_related("child")
+        return Response(
+            {"depth":depth,
+             "ancestors":[{"id":user.id, "username":user.username}
+                          for user in lineage.ancestors(user_id)],
+             "subtreeSize":lineage.subtree_size(user_id),
+             "descendants":[{"id":node.child_id,
+                             "username":node.child.username,
+                             "invitedBy":node.parent_id,
+                             "depth":node.depth - depth}
+                            for node in nodes[:getattr(
+                                    settings, "INVITE_LINEAGE_MAX_SIZE", 1000)]]})
+
 class PostViewSet(viewsets.ModelViewSet):
     """
     API endpoint that allows posts to be viewed or edited.
@@ -39,6 +105,11 @@ class PostViewSet(viewsets.ModelViewSet):
     queryset = Post.objects.all()
     serializer_class = PostSerializer
 
+    def retrieve(self, request, pk=None):
+        response = super().retrieve(request, pk=pk)
+        record_view(request, pk)
+        return response
+
     # TODO: Convert this to use a custom permission class
     @action(detail=True, methods=['get', 'post'])
     def update_tagset(self, request, pk=None):
@@ -92,6 +163,45 @@ class PostViewSet(viewsets.ModelViewSet):
             new_tag.full_clean()
             new_tag.save()
         return HttpResponse("Tags updated")
+
+    @action(detail=True, methods=['get'])
+    def thread(self, request, pk=None):
+        """Return the comments on a post in thread order, depth first, each with
+        its depth.
+
+        Parameters:
+
+        comment: Only return this comment and the replies under it.
+        max_depth: How many levels of replies to include below the top.
+        after: ID of the last comment of the previous page.
+        limit: The most comments to return, capped at COMMENT_THREAD_MAX_SIZE."""
+        try:
+            max_depth = request.query_params.get("max_depth")
+            max_depth = int(max_depth) if max_depth else None
+            limit = int(request.query_params.get("limit") or 0)
+        except ValueError:
+            return HttpResponse("max_depth and limit must be integers.", status=400)
+        root_id = request.query_params.get("comment")
+        after_id = request.query_params.get("after")
+        # Nothing in the payload depends on who's asking, so everyone shares
+        # the anonymous copy
+        key = thread_cache.response_key(pk, AnonymousUser(),
+                                        root_id, max_depth, after_id, limit)
+        payload = thread_cache.get_response(key)
+        if payload is None:
+            comments = Comment.objects.filter(post_id=pk, is_deleted=False)
+            try:
+                comments = thread(
+                    comments.select_related("user", "post", "parent_comment"),
+                    root_id=root_id,
+                    max_depth=max_depth,
+                    after_id=after_id,
+                    limit=thread_limit(limit))
+            except Comment.DoesNotExist:
+                return HttpResponse("No such comment on post {}".format(pk), status=404)
+            payload = CommentSerializer(comments, many=True).data
+            thread_cache.set_response(key, payload)
+        return Response(payload)
     
 class CommentViewSet(viewsets.ModelViewSet):
     """
@@ -108,8 +218,7 @@ class CommentViewSet(viewsets.ModelViewSet):
         comment = self.queryset.get(id=pk)
         if comment.user != request.user:
             raise ValueError("Only a comments author can delete their comment")
-        comment.is_deleted = True
-        comment.save()
+        delete_comment(comment)
         return HttpResponse("Comment deleted")
     
 class TagViewSet(viewsets.ModelViewSet):
@@ -160,49 +269,192 @@ class InviteList(viewsets.ViewSet):
         if user.is_authenticated:
             return Response(invite_serializer.data)
 
-# TODO: Refactor these to both inherit from one class or use same underlying method
-# definition
-class PostSearchView(viewsets.ViewSet):
-    """Search posts with a query string ?query=
+class UnreadNotificationsView(viewsets.ViewSet):
+    """
+    API endpoint that returns how many notifications the logged in user hasn't
+    seen, for clients to poll.
+    """
+    permission_classes = (IsAuthenticated,)
 
-    See search.py for a quick guide to the search syntax rules."""
     def list(self, request):
+        return Response({"unread":unread_notifications(request.user)})
+
+class StreamSlots(object):
+    """Counts the event streams open in this process."""
+    def __init__(self):
+        self.open = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.open >= getattr(settings, "EVENT_STREAM_MAX_STREAMS", 10):
+                return False
+            self.open += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.open -= 1
+
+stream_slots = StreamSlots()
+
+class EventStream(object):
+    """The body of an event stream response. Closing it, which Django does once
+    the response is finished or the client goes away, gives back its slot."""
+    def __init__(self, events, subscription):
+        self.events = events
+        self.subscription = subscription
+        self.closed = False
+
+    def __iter__(self):
+        return self.events
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.events.close()
+        # The events never ran if the client left before the first one
+        self.subscription.close()
+        stream_slots.release()
+
+class EventStreamView(View):
+    """
+    Server-sent event stream of new comments on the posts given by the post
+    parameters and, for a logged in user, their new notifications. Each event
+    is a JSON object with an "event" of "comment" or "notification". The
+    stream ends after EVENT_STREAM_TIMEOUT seconds and the client reconnects.
+
+    A stream holds the worker serving it for as long as it's open, so serve
+    /events with threaded or gevent workers, not one sync worker per process.
+    Each process keeps at most EVENT_STREAM_MAX_STREAMS open, leaving its other
+    workers for regular requests, and turns further clients away with a 503.
+    """
+    max_posts = 20
+
+    def get(self, request):
+        post_ids = request.GET.getlist("post")
+        if len(post_ids) > self.max_posts:
+            return HttpResponse("Can watch at most {} posts.".format(self.max_posts),
+                                status=400)
+        channels = [pubsub.post_channel(post_id) for post_id in post_ids]
+        if request.user.is_authenticated:
+            channels.append(pubsub.user_channel(request.user.id))
+        if not channels:
+            return HttpResponse("Nothing to watch.", status=400)
+        if not stream_slots.acquire():
+            response = HttpResponse("Too many event streams open, try again later.",
+                                    status=503)
+            response["Retry-After"] = "10"
+            return response
+        # Subscribe now so nothing published after the request is missed
+        subscription = pubsub.subscribe(channels)
+        response = StreamingHttpResponse(EventStream(self.events(subscription),
+                                                     subscription),
+                                         content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+    def events(self, subscription):
+        deadline = datetime.datetime.now() + datetime.timedelta(
+            seconds=getattr(settings, "EVENT_STREAM_TIMEOUT", 300))
+        heartbeat = getattr(settings, "EVENT_STREAM_HEARTBEAT", 15)
         try:
-            parsed_search = wl_search.parse_search_string(request.GET["query"])
-        except MultiValueDictKeyError:
-            raise ValueError("Didn't specify a query string. Use ?query=")
-        filters = wl_search.mk_search_filters(parsed_search)
-        posts = Post.objects.all()
-        for _filter in filters:
-            if _filter["exclude"]:
-                posts = posts.exclude(_filter["Q"])
-            else:
-                posts = posts.filter(_filter["Q"])
-        post_serializer = PostSerializer(posts, context={'request': request}, many=True)
-        return HttpResponse(JSONRenderer().render(post_serializer.data),
-                            content_type="application/json")
-        
-class CommentSearchView(viewsets.ViewSet):
-    """Search comments with a query string ?query=
+            yield "retry: 1000\n\n"
+            while datetime.datetime.now() < deadline:
+                received = subscription.get(heartbeat)
+                if received is None:
+                    # Keeps proxies from closing an idle connection
+                    yield ": heartbeat\n\n"
+                else:
+                    channel, message = received
+                    yield "event: {}\ndata: {}\n\n".format(message["event"],
+                                                             json.dumps(message))
+        finally:
+            subscription.close()
+
+def search_error(code, message):
+    return HttpResponse(
+        json.dumps({"code":code,
+                    "message":message,
+                    "blame":"client",
+                    "retry":False}),
+        status=400,
+        content_type="application/json")
+
+class SearchView(viewsets.ViewSet):
+    """Shared implementation of the search endpoints. Subclasses set the model, 
+    the kind of document in the search index and the serializers to use.
+
+    Parameters:
+
+    query: The search string, see search.py for the syntax.
+    limit: How many results to return, at most SEARCH_MAX_PAGE_SIZE.
+    cursor: The X-Next-Cursor header of the previous page, to get the next one.
+    compact: If true, return just the id, title, author, score and a highlighted
+    snippet of each result instead of the full document."""
+    model = None
+    kind = None
+    serializer_class = None
+    compact_serializer_class = None
 
-    See search.py for a quick guide to the search syntax rules."""
     def list(self, request):
         try:
-            parsed_search = wl_search.parse_search_string(request.GET["query"])
+            query = request.GET["query"]
         except MultiValueDictKeyError:
             raise ValueError("Didn't specify a query string. Use ?query=")
-        filters = wl_search.mk_search_filters(parsed_search)
-        comments = Comment.objects.all()
-        for _filter in filters:
-            if _filter["exclude"]:
-                comments = comments.exclude(_filter["Q"])
-            else:
-                comments = comments.filter(_filter["Q"])
-        comment_serializer = CommentSerializer(comments,
+        max_page_size = getattr(settings, "SEARCH_MAX_PAGE_SIZE", 100)
+        try:
+            limit = int(request.GET.get("limit",
+                                        getattr(settings, "SEARCH_PAGE_SIZE", 20)))
+            limit = max(1, min(limit, max_page_size))
+        except ValueError:
+            return search_error("search_limit_malformed",
+                                "The value '{}' is not an integer value.".format(
+                                    request.GET["limit"]))
+        try:
+            offset = wl_search.parse_page_cursor(request.GET.get("cursor"))
+        except ValueError as e:
+            return search_error("search_cursor_malformed", str(e))
+        queryset = self.model.objects.select_related('user')
+        # Fetch one extra result to find out if there's another page
+        results = list(wl_search.search(queryset, self.kind, query,
+                                        offset=offset, limit=limit + 1))
+        next_page = len(results) > limit
+        results = results[:limit]
+        if request.GET.get("compact", "").lower() in ("1", "true"):
+            serializer = self.compact_serializer_class(
+                results,
+                context={'request': request, 'query': query},
+                many=True)
+        else:
+            serializer = self.serializer_class(results,
                                                context={'request': request},
                                                many=True)
-        return HttpResponse(JSONRenderer().render(comment_serializer.data),
-                            content_type="application/json")
+        response = HttpResponse(JSONRenderer().render(serializer.data),
+                                content_type="application/json")
+        if next_page:
+            response["X-Next-Cursor"] = wl_search.make_page_cursor(offset + limit)
+        return response
+
+class PostSearchView(SearchView):
+    """Search posts with a query string ?query=
+
+    See search.py for a quick guide to the search syntax rules."""
+    model = Post
+    kind = "post"
+    serializer_class = PostSerializer
+    compact_serializer_class = PostSearchResultSerializer
+        
+class CommentSearchView(SearchView):
+    """Search comments with a query string ?query=
+
+    See search.py for a quick guide to the search syntax rules."""
+    model = Comment
+    kind = "comment"
+    serializer_class = CommentSerializer
+    compact_serializer_class = CommentSearchResultSerializer
 
 class AnnotationList(viewsets.ViewSet):
     """Get a list of hypothes.is annotations for a given user."""
@@ -251,10 +503,17 @@ class AnnotationList(viewsets.ViewSet):
                 ),
                 status=404
             )
-        return HttpResponse(
-            h_annot.api.search(user.profile.hypothesis_api_key,
-                               user=user.profile.hypothesis_user,
-                               group=user.profile.hypothesis_group,
-                               limit=limit),
-            content_type="application/json"
+        try:
+            results = annotations.search(user.profile, limit)
+        except annotations.AnnotationsUnavailable as error:
+            return HttpResponse(
+                json.dumps(
+                    {"code":"annotation_search_unavailable",
+                     "message":str(error),
+                     "blame":"server",
+                     "retry":error.retry}
+                ),
+                status=503 if error.retry else 502,
+                content_type="application/json"
             )
+        return HttpResponse(results, content_type="application/json")
@@ -0,0 +1,94 @@
+from collections import defaultdict
+from datetime import datetime
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from .models import Post, Comment, Vote
+from .counters import apply_vote, per_document, vote_post_id
+from .thread_cache import bump_thread
+from .feeds import refresh_feeds
+
+"""Vote ingestion.
+
+With VOTE_WRITE_BEHIND off, a vote is saved and its document's score updated in
+one transaction by counters.apply_vote. With it on, the vote row is saved marked
+pending and nothing else is touched, so a burst of votes on a popular post no
+longer queues up on that post's row lock. flush_votes, run periodically by the
+flush_votes management command, then applies the pending votes in batches, one
+UPDATE per table adding each document's summed delta. Run one flusher at a
+time, two could lock the same documents in different orders.
+
+Either way the (document_id, user) unique constraint turns away a second vote by
+the same user. Until their vote is flushed, the voter sees it counted through
+pending_score, so their own vote never seems to vanish."""
+
+def write_behind():
+    return getattr(settings, "VOTE_WRITE_BEHIND", False)
+
+def vote_delta(vote_type):
+    """The change in score a vote of vote_type makes."""
+    if "Upvote" in vote_type:
+        return 1
+    elif "Downvote" in vote_type:
+        return -1
+    raise ValueError("'{}' does not appear to be upvote or downvote".format(vote_type))
+
+def cast_vote(user, document_model, document_id, vote_type):
+    """Record user's vote on the Post or Comment with document_id and return it.
+
+    Raises ValueError if the vote type isn't an upvote or downvote, or if the
+    user has already voted on the document."""
+    delta = vote_delta(vote_type)
+    vote = Vote(user=user,
+                document_id=document_id,
+                voted_at=datetime.today(),
+                vote_type=vote_type)
+    try:
+        if write_behind():
+            vote.pending = True
+            with transaction.atomic():
+                vote.save()
+            # The score is unchanged but the voter's currentUserVotes isn't
+            bump_thread(vote_post_id(document_model, document_id))
+        else:
+            apply_vote(vote, document_model, delta)
+    except IntegrityError:
+        raise ValueError("User already voted on this")
+    return vote
+
+def pending_score(document, votes):
+    """The score of document as seen by the user who cast votes on it, counting
+    those still waiting to be flushed."""
+    return document.base_score + sum(vote_delta(vote.vote_type)
+                                     for vote in votes if vote.pending)
+
+def flush_votes(batch_size=None):
+    """Apply up to batch_size pending votes to the scores of the documents they
+    were cast on and return how many were applied."""
+    batch_size = batch_size or getattr(settings, "VOTE_FLUSH_BATCH_SIZE", 1000)
+    with transaction.atomic():
+        votes = list(Vote.objects.select_for_update(skip_locked=True)
+                     .filter(pending=True)
+                     .order_by("id")
+                     .values_list("id", "document_id", "vote_type")[:batch_size])
+        if not votes:
+            return 0
+        scores = defaultdict(int)
+        counts = defaultdict(int)
+        for id, document_id, vote_type in votes:
+            scores[document_id] += vote_delta(vote_type)
+            counts[document_id] += 1
+        Post.objects.filter(id__in=scores).update(
+            base_score=F("base_score") + per_document(scores),
+            vote_count=F("vote_count") + per_document(counts))
+        Comment.objects.filter(id__in=scores).update(
+            base_score=F("base_score") + per_document(scores))
+        Vote.objects.filter(id__in=[vote[0] for vote in votes]).update(pending=False)
+        voted_posts = set(Post.objects.filter(id__in=scores)
+                          .values_list("id", flat=True))
+        refresh_feeds(voted_posts)
+        post_ids = set(Comment.objects.filter(id__in=scores)
+                       .values_list("post_id", flat=True))
+        for post_id in post_ids | voted_posts:
+            bump_thread(post_id)
+    return len(votes)